@@ -0,0 +1,177 @@
+"""
+    Bounded cache for the responses of the metrics API.  Responses are keyed
+    by the key signature of their request (see engine.get_key_signature), a
+    list of "<param> <==> <value>" strings.
+
+    The cache is bounded by a number of entries and by the total size of the
+    responses.  When either bound is exceeded entries are evicted, the least
+    recently used (LRU) or the least frequently used (LFU) first.  Entries
+    may also expire a time to live (TTL) after they are stored.  The cache
+    may be shared by threads: ::
+
+        >>> cache = ResultCache(max_entries=2, policy=LRU)
+        >>> cache.set(['cohort_expr <==> 1', 'metric <==> bytes_added'], r1)
+        >>> cache.get(['cohort_expr <==> 1', 'metric <==> bytes_added'])
+        r1
+"""
+
+__author__ = "ryan faulkner"
+__date__ = "01/21/2013"
+__license__ = "GPL (version 2 or later)"
+
+import cPickle
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
+
+from config import logging
+
+# Eviction policies
+LRU = 'lru'
+LFU = 'lfu'
+EVICTION_POLICIES = [LRU, LFU]
+
+# Default bounds, a bound of 0 is unlimited
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_TTL = 7 * 24 * 3600     # seconds
+
+
+class ResultCache(object):
+    """ Bounded mapping of request key signatures to responses """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL, policy=LRU):
+        if not policy in EVICTION_POLICIES:
+            logging.error(__name__ + '::Invalid eviction policy "%s". Using '
+                                     'default (%s).' % (policy, LRU))
+            policy = LRU
+
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._policy = policy
+
+        # Entries in order of use, the least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def __len__(self): return len(self._entries)
+
+    @property
+    def size(self):
+        """ Total size in bytes of the cached responses """
+        return self._size
+
+    def keys(self):
+        """ The key signatures, as lists, of the cached responses """
+        with self._lock:
+            self.purge()
+            return [list(key_sig) for key_sig in self._entries]
+
+    def get(self, key_sig):
+        """ Returns the response stored for `key_sig` or None """
+        key_sig = tuple(key_sig)
+        with self._lock:
+            entry = self._entries.get(key_sig)
+            if entry is None:
+                return None
+            if entry.is_expired():
+                self.remove(key_sig)
+                return None
+
+            entry.hits += 1
+            del self._entries[key_sig]
+            self._entries[key_sig] = entry
+            return entry.data
+
+    def set(self, key_sig, data):
+        """ Stores the response `data` for `key_sig` """
+        expires = time.time() + self._ttl if self._ttl else None
+        self._insert(tuple(key_sig), _CacheEntry(data, get_size(data),
+                                                 expires))
+
+    def update(self, cache):
+        """ Stores the unexpired entries of another ResultCache """
+        with self._lock:
+            for key_sig, entry in cache._entries.items():
+                if not entry.is_expired():
+                    self._insert(key_sig, entry)
+
+    def remove(self, key_sig):
+        with self._lock:
+            entry = self._entries.pop(tuple(key_sig), None)
+            if entry is not None:
+                self._size -= entry.size
+
+    def purge(self):
+        """ Removes the expired entries """
+        with self._lock:
+            for key_sig in [key_sig for key_sig, entry in
+                            self._entries.iteritems() if entry.is_expired()]:
+                self.remove(key_sig)
+
+    def _insert(self, key_sig, entry):
+        with self._lock:
+            self.remove(key_sig)
+            if self._max_bytes and entry.size > self._max_bytes:
+                logging.error(__name__ + '::Response of %s bytes exceeds the '
+                                         'cache size, not cached.' %
+                                         entry.size)
+                return
+            self._entries[key_sig] = entry
+            self._size += entry.size
+            self._evict()
+
+    def _evict(self):
+        """ Removes entries until the cache is within its bounds """
+        if not self._is_full():
+            return
+        self.purge()
+        while self._is_full():
+            if self._policy == LFU and len(self._entries) > 1:
+                # Ties go to the least recently used entry.  The entry just
+                # stored, which has no hits yet, is kept
+                key_sig = min(islice(self._entries, len(self._entries) - 1),
+                              key=lambda k: self._entries[k].hits)
+            else:
+                key_sig = next(iter(self._entries))
+            logging.debug(__name__ + '::Evicting response for %s.' %
+                                     str(key_sig))
+            self.remove(key_sig)
+
+    def _is_full(self):
+        return (self._max_entries and
+                len(self._entries) > self._max_entries) or \
+               (self._max_bytes and self._size > self._max_bytes)
+
+
+class _CacheEntry(object):
+    """ A cached response along with its size, expiry time and hit count """
+
+    def __init__(self, data, size, expires):
+        self.data = data
+        self.size = size
+        self.expires = expires
+        self.hits = 0
+
+    def is_expired(self):
+        return self.expires is not None and time.time() >= self.expires
+
+
+def get_size(data):
+    """ Size in bytes of a response, the body of HTTP response objects """
+    if hasattr(data, 'data'):
+        return len(data.data)
+    return len(cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL))
@@ -0,0 +1,93 @@
+"""
+    Cache of cohort membership.  The user ids of a cohort (a tag of the
+    `usertags` table) are held as a sorted numpy integer array along with
+    the `utm_touched` time of the cohort in `usertags_meta`.  A cached
+    membership is only valid while `utm_touched` is unchanged: ::
+
+        >>> cache = CohortCache()
+        >>> ids = cache.get(utm_id, utm_touched)
+        >>> if ids is None:
+        ...     ids = cache.put(utm_id, utm_touched, fetch_ids(utm_id))
+
+    Request jobs run in separate processes, so the memberships are also
+    persisted to a shelve (see src.utils.locked_shelf), unless `persist` is
+    False, and are loaded from it by processes that have not seen the
+    cohort yet.
+"""
+
+__author__ = "ryan faulkner"
+__date__ = "01/24/2013"
+__license__ = "GPL (version 2 or later)"
+
+import numpy as np
+
+import config.settings as settings
+from config import logging
+from src.utils.locked_shelf import LockedShelf
+
+STORE_FILE = 'cohort_cache'
+
+
+class CohortCache(object):
+    """ Cohort memberships, by utm_id, in memory and on disk """
+
+    def __init__(self, path=None, persist=True):
+        self._members = dict()      # utm_id -> (utm_touched, ids)
+        self._path = None
+        if persist:
+            self._path = path if path else settings.__data_file_dir__ + \
+                STORE_FILE
+
+    def get(self, utm_id, utm_touched):
+        """
+            Returns the sorted array of user ids of cohort `utm_id` or None
+            if it is not cached or the cohort was touched since.
+        """
+        if utm_touched is None: return None
+
+        key = str(utm_id)
+        entry = self._members.get(key)
+        if (entry is None or entry[0] != utm_touched) and self._path:
+            entry = self._load(key)
+            if entry is not None:
+                self._members[key] = entry
+
+        if entry is None or entry[0] != utm_touched:
+            return None
+        return entry[1]
+
+    def put(self, utm_id, utm_touched, ids):
+        """ Caches the user ids `ids` of cohort `utm_id`, touched at
+            `utm_touched`, and returns them as a sorted array """
+        ids = np.unique(np.array(list(ids), dtype=np.int64))
+        if utm_touched is None: return ids
+
+        key = str(utm_id)
+        self._members[key] = (utm_touched, ids)
+        if self._path:
+            self._save(key, (utm_touched, ids))
+        return ids
+
+    def _load(self, key):
+        try:
+            store = LockedShelf(self._path, protocol=2)
+        except Exception as e:
+            logging.error(__name__ + '::Could not open the cohort cache: %s'
+                                     % e)
+            return None
+        try:
+            return store[key] if store.has_key(key) else None
+        finally:
+            store.close()
+
+    def _save(self, key, entry):
+        try:
+            store = LockedShelf(self._path, protocol=2)
+        except Exception as e:
+            logging.error(__name__ + '::Could not open the cohort cache: %s'
+                                     % e)
+            return
+        try:
+            store[key] = entry
+        finally:
+            store.close()
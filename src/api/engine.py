@@ -7,15 +7,17 @@ __email__ = "rfaulkner@wikimedia.org"
 __date__ = "january 11 2012"
 __license__ = "GPL (version 2 or later)"
 
-from flask import escape, redirect, url_for
+from flask import escape, redirect, url_for, Response
 from src.utils.record_type import *
-from dateutil.parser import parse as date_parse
+from src.utils.timestamp import parse_timestamp as date_parse
 from datetime import timedelta, datetime
 from re import search
 from collections import OrderedDict, namedtuple
 
+import config.settings as settings
 import src.etl.data_loader as dl
 import src.metrics.metrics_manager as mm
+from cohort_cache import CohortCache
 
 from config import logging
 
@@ -26,7 +28,7 @@ MW_UNAME_REGEX = r'[a-zA-Z_\.\+ ]'
 # Define standard variable names in the query string - store in named tuple
 RequestMeta = recordtype('RequestMeta',
     'cohort_expr cohort_gen_timestamp metric time_series aggregator '
-    'restrict project namespace date_start date_end interval t n')
+    'restrict project namespace date_start date_end interval t n window')
 
 def RequestMetaFactory(cohort_expr, cohort_gen_timestamp, metric):
     """
@@ -54,6 +56,7 @@ REQUEST_META_QUERY_STR = ['aggregator', 'time_series', 'project', 'namespace',
                           'date_start', 'date_end', 'interval', 't', 'n',
                           'time_unit','time_unit_count', 'look_ahead',
                           'look_back', 'threshold_type', 'restrict',
+                          'window',
                           ]
 REQUEST_META_BASE = ['cohort_expr', 'metric']
 
@@ -73,7 +76,8 @@ common_params = [varMapping('date_start','date_start'),
                  varMapping('namespace','namespace'),
                  varMapping('interval','interval'),
                  varMapping('time_series','time_series'),
-                 varMapping('aggregator','aggregator')]
+                 varMapping('aggregator','aggregator'),
+                 varMapping('window','window')]
 
 QUERY_PARAMS_BY_METRIC = {
     'blocks' : common_params,
@@ -155,15 +159,10 @@ def get_users(cohort_expr):
     else:
         logging.info(__name__ + '::Processing cohort by tag name.')
         conn = dl.Connector(instance='slave')
-        try:
-            conn._cur_.execute('select utm_id from usertags_meta '
-                               'WHERE utm_name = "%s"' % str(cohort_expr))
-            res = conn._cur_.fetchone()[0]
-            conn._cur_.execute('select ut_user from usertags '
-                               'WHERE ut_tag = "%s"' % res)
-        except IndexError:
-            redirect(url_for('cohorts'))
-        users = [r[0] for r in conn._cur_]
+        conn._cur_.execute('select utm_id, utm_touched from usertags_meta '
+                           'WHERE utm_name = "%s"' % str(cohort_expr))
+        res = conn._cur_.fetchone()
+        users = get_cohort_members(conn, res[0], res[1]).tolist()
         del conn
     return users
 
@@ -208,73 +207,67 @@ def get_cohort_refresh_datetime(utm_id):
     del conn
     return utm_touched.strftime(DATETIME_STR_FORMAT)
 
-def get_data(request_meta, hash_table_ref):
-    """ Extract data from the global hash given a request object """
-
-    # Traverse the hash key structure to find data
-    # @TODO rather than iterate through REQUEST_META_BASE &
-    #   REQUEST_META_QUERY_STR look only at existing attributes
-
-    logging.debug(__name__ + "::Attempting to pull data for request {0}".
-        format(str(request_meta)))
-    for key_name in REQUEST_META_BASE + REQUEST_META_QUERY_STR:
-        if hasattr(request_meta, key_name) and getattr(request_meta, key_name):
-            key = getattr(request_meta, key_name)
-        else:
-            continue
-
-        full_key = key_name + HASH_KEY_DELIMETER + key
-        if hasattr(hash_table_ref, 'has_key') and hash_table_ref.has_key(
-            full_key):
-            hash_table_ref = hash_table_ref[full_key]
-        else:
-            return None
-
-    # Ensure that an interface that does not rely on keyed values is returned
-    # all data must be in interfaces resembling lists
-    if not hasattr(hash_table_ref, '__iter__'):
-        return hash_table_ref
-    else:
-        return None
-
-def set_data(request_meta, data, hash_table_ref):
+def get_key_signature(request_meta):
     """
-        Given request meta-data and a dataset create a key path in the global
-        hash to store the data
+        Returns the list of keys identifying the response to a request, or
+        None if the request lacks any of REQUEST_META_BASE
     """
-
     key_sig = list()
 
-    # Build the key signature
     for key_name in REQUEST_META_BASE: # These keys must exist
         key = getattr(request_meta, key_name)
         if key:
             key_sig.append(key_name + HASH_KEY_DELIMETER + key)
         else:
-            logging.error(__name__ + '::Request must include %s. '
-                                     'Cannot set data %s.' % (
-                key_name, str(request_meta)))
-            return
+            return None
 
     for key_name in REQUEST_META_QUERY_STR: # These keys may optionally exist
         if hasattr(request_meta,key_name):
             key = getattr(request_meta, key_name)
             if key: key_sig.append(key_name + HASH_KEY_DELIMETER + key)
+    return key_sig
 
-    logging.debug(__name__ + "::Adding data to hash @ key signature = {0}".
+def get_data(request_meta, cache, store=None):
+    """
+        Extract data from the response cache (see src/api/cache.py) given a
+        request object.  Responses missing from the cache are loaded from
+        the persistent `store` (see src/api/response_store.py), if given,
+        unless the cohort has been refreshed since they were stored.
+    """
+    logging.debug(__name__ + "::Attempting to pull data for request {0}".
+        format(str(request_meta)))
+    key_sig = get_key_signature(request_meta)
+    if not key_sig:
+        return None
+
+    data = cache.get(key_sig)
+    if data is None and store:
+        stored = store.get(key_sig, request_meta.cohort_gen_timestamp)
+        if stored:
+            body, status, mimetype = stored
+            data = Response(body, status=status, mimetype=mimetype)
+            cache.set(key_sig, data)
+    return data
+
+def set_data(request_meta, data, cache, store=None):
+    """
+        Given request meta-data and a dataset store the data in the response
+        cache, and in the persistent `store` if given, under the key
+        signature of the request
+    """
+    key_sig = get_key_signature(request_meta)
+    if not key_sig:
+        logging.error(__name__ + '::Request must include %s. '
+                                 'Cannot set data %s.' % (
+            ", ".join(REQUEST_META_BASE), str(request_meta)))
+        return
+
+    logging.debug(__name__ + "::Adding data to cache @ key signature = {0}".
         format(str(key_sig)))
-    # For each key in the key signature add a nested key to the hash
-    last_item = key_sig[len(key_sig) - 1]
-    for key in key_sig:
-        if key != last_item:
-            if not (hasattr(hash_table_ref, 'has_key') and
-                    hash_table_ref.has_key(key) and
-                    hasattr(hash_table_ref[key], 'has_key')):
-                hash_table_ref[key] = OrderedDict()
-
-            hash_table_ref = hash_table_ref[key]
-        else:
-            hash_table_ref[key] = data
+    cache.set(key_sig, data)
+    if store:
+        store.put(key_sig, request_meta.cohort_gen_timestamp,
+                  (data.data, data.status_code, data.mimetype))
 
 def get_url_from_keys(keys, path_root):
     """ Compose a url from a set of keys """
@@ -293,14 +286,6 @@ def get_url_from_keys(keys, path_root):
         url = path_root
     return url
 
-def build_key_tree(nested_dict):
-    """ Builds a tree of key values from a nested dict. """
-    if hasattr(nested_dict, 'keys'):
-        for key in nested_dict.keys(): yield (key, build_key_tree(
-            nested_dict[key]))
-    else:
-        yield None
-
 #
 # Cohort parsing methods
 #
@@ -346,32 +331,58 @@ def parse(expression):
                 yield user_id
 
 
-def get_cohort_ids(conn, cohort_id):
+# Cohort memberships by cohort id, see src/api/cohort_cache.py
+cohort_cache = CohortCache(
+    persist=getattr(settings, '__api_cohort_cache_persist__', True))
+
+def get_cohort_members(conn, cohort_id, utm_touched=None):
+    """
+        Returns the user ids of a cohort as a sorted array.  The ids are
+        read from the cohort cache unless the cohort has been touched, at
+        `utm_touched`, since they were cached.
+    """
+    user_ids = cohort_cache.get(cohort_id, utm_touched)
+    if user_ids is None:
+        sql = """
+            SELECT ut_user
+            FROM staging.usertags
+            WHERE ut_tag = %(id)s
+        """ % {
+            'id' : str(cohort_id)
+        }
+        conn._cur_.execute(sql)
+        user_ids = cohort_cache.put(cohort_id, utm_touched,
+                                    (row[0] for row in conn._cur_))
+    return user_ids
+
+def get_cohort_touched(conn, cohort_ids):
+    """ Returns the utm_touched values of cohorts keyed by cohort id """
+    conn._cur_.execute('SELECT utm_id, utm_touched FROM usertags_meta '
+                       'WHERE utm_id IN (%s)' % ','.join(
+                           [str(int(cid)) for cid in cohort_ids]))
+    return dict((str(row[0]), row[1]) for row in conn._cur_)
+
+def get_cohort_ids(conn, cohort_id, utm_touched=None):
     """ Returns string valued ids corresponding to a cohort """
-    sql = """
-        SELECT ut_user
-        FROM staging.usertags
-        WHERE ut_tag = %(id)s
-    """ % {
-        'id' : str(cohort_id)
-    }
-    conn._cur_.execute(sql)
-    for row in conn._cur_:
-        yield str(row[0])
+    for user_id in get_cohort_members(conn, cohort_id, utm_touched).tolist():
+        yield str(user_id)
 
 def intersect_ids(cohort_id_list):
 
     conn = dl.Connector(instance='slave')
+    touched = get_cohort_touched(conn, cohort_id_list)
 
     user_ids = dict()
     # only a single cohort id in the expression - return all users of this
     # cohort
     if len(cohort_id_list) == 1:
-        for id in get_cohort_ids(conn, cohort_id_list[0]):
+        for id in get_cohort_ids(conn, cohort_id_list[0],
+                                 touched.get(str(int(cohort_id_list[0])))):
             yield id
     else:
         for cid in cohort_id_list:
-            for id in get_cohort_ids(conn, cid):
+            for id in get_cohort_ids(conn, cid,
+                                     touched.get(str(int(cid)))):
                 if user_ids.has_key(id):
                     user_ids[id] += 1
                 else:
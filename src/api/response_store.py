@@ -0,0 +1,157 @@
+"""
+    Persistent store for the responses of the metrics API.  Responses are
+    written to a shelve on local disk under the key signature of their
+    request (see engine.get_key_signature) so that they outlive the API
+    process.  They are read back on lookup only: ::
+
+        >>> store = ResponseStore()
+        >>> store.put(key_sig, '20130115000000', response)
+        >>> store.get(key_sig, '20130115000000')
+        response
+
+    Each response is stored along with the refresh time (`utm_touched`) of
+    its cohort.  A stored response is invalid once the cohort has been
+    refreshed since.
+
+    The store is bounded by a number of responses and by their total size,
+    and responses expire a time to live (TTL) after they are stored.
+    Expired responses are swept, and the oldest responses evicted while
+    either bound is exceeded, whenever a response is stored.  The stored
+    time and size of each response are kept in an index so that the sweep
+    does not read the responses.
+"""
+
+__author__ = "ryan faulkner"
+__date__ = "01/22/2013"
+__license__ = "GPL (version 2 or later)"
+
+import hashlib
+import time
+
+import config.settings as settings
+from config import logging
+from cache import get_size
+from src.utils.locked_shelf import LockedShelf
+
+STORE_FILE = 'api_responses'
+
+# Key of the index of stored responses, key -> (stored time, size)
+INDEX_KEY = 'index'
+
+# Default bounds, a bound of 0 is unlimited
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024 * 1024
+DEFAULT_TTL = 30 * 24 * 3600    # seconds
+
+
+class ResponseStore(object):
+    """
+        Shelve backed store of API responses.  The shelve is opened for each
+        read or write under an exclusive lock (see src.utils.locked_shelf)
+        since the API may be served by several processes.
+    """
+
+    def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self._path = path if path else settings.__data_file_dir__ + \
+            STORE_FILE
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+
+    @staticmethod
+    def _key(key_sig):
+        return hashlib.sha1(repr(list(key_sig))).hexdigest()
+
+    def get(self, key_sig, cohort_refresh_ts):
+        """
+            Returns the response stored for `key_sig` or None if there is
+            none, it has expired or the cohort was refreshed, at
+            `cohort_refresh_ts`, since it was stored.
+        """
+        if not cohort_refresh_ts: return None
+
+        try:
+            store = LockedShelf(self._path)
+        except Exception as e:
+            logging.error(__name__ + '::Could not open the response store: '
+                                     '%s' % e.message)
+            return None
+        try:
+            key = self._key(key_sig)
+            if not store.has_key(key):
+                return None
+            stored_key_sig, refresh_ts, stored_ts, data = store[key]
+            if refresh_ts != cohort_refresh_ts or self._is_expired(stored_ts):
+                index = self._get_index(store)
+                self._delete(store, index, key)
+                store[INDEX_KEY] = index
+                return None
+            return data
+        finally:
+            store.close()
+
+    def put(self, key_sig, cohort_refresh_ts, data):
+        """ Stores the response `data` computed for a cohort refreshed at
+            `cohort_refresh_ts` """
+        if not cohort_refresh_ts: return
+
+        size = get_size(data)
+        if self._max_bytes and size > self._max_bytes:
+            logging.error(__name__ + '::Response of %s bytes exceeds the '
+                                     'store size, not stored.' % size)
+            return
+
+        try:
+            store = LockedShelf(self._path)
+        except Exception as e:
+            logging.error(__name__ + '::Could not open the response store: '
+                                     '%s' % e.message)
+            return
+        try:
+            key = self._key(key_sig)
+            stored_ts = time.time()
+            index = self._get_index(store)
+            store[key] = (list(key_sig), cohort_refresh_ts, stored_ts, data)
+            index[key] = (stored_ts, size)
+            self._evict(store, index, key)
+            store[INDEX_KEY] = index
+        finally:
+            store.close()
+
+    def _get_index(self, store):
+        if store.has_key(INDEX_KEY):
+            return store[INDEX_KEY]
+        # Stores written without an index are indexed once
+        index = dict()
+        for key in store.keys():
+            stored_ts, data = store[key][2:]
+            index[key] = (stored_ts, get_size(data))
+        return index
+
+    @staticmethod
+    def _delete(store, index, key):
+        if store.has_key(key):
+            del store[key]
+        index.pop(key, None)
+
+    def _evict(self, store, index, keep):
+        """ Removes the expired responses, then the oldest responses until
+            the store is within its bounds.  The response just stored,
+            `keep`, is not evicted """
+        for key in [key for key, entry in index.iteritems()
+                    if self._is_expired(entry[0])]:
+            self._delete(store, index, key)
+
+        size = sum(entry[1] for entry in index.itervalues())
+        by_age = sorted([key for key in index if key != keep],
+                        key=lambda key: index[key][0], reverse=True)
+        while (self._max_entries and len(index) > self._max_entries) or \
+                (self._max_bytes and size > self._max_bytes):
+            key = by_age.pop()
+            size -= index[key][1]
+            logging.debug(__name__ + '::Evicting stored response %s.' % key)
+            self._delete(store, index, key)
+
+    def _is_expired(self, stored_ts):
+        return bool(self._ttl) and time.time() >= stored_ts + self._ttl
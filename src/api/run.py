@@ -49,8 +49,11 @@
         metric_param := -, optional metric parameters
         data := list(tuple), set of data points
 
-    Request data is mapped to a query via metric objects and hashed in the
-    dictionary `pkl_data`.
+    Request data is mapped to a query via metric objects and the responses
+    are stored in the bounded cache `pkl_data` (see src/api/cache.py).  The
+    responses are also written to disk (see src/api/response_store.py) and
+    loaded from there when they are missing from the cache, e.g. after a
+    restart.
 
     Cohort Data
     ^^^^^^^^^^^
@@ -75,17 +78,14 @@
     +-------------+-----------------+------+-----+---------+----------------+
 
 """
-from flask import Flask, render_template, Markup, jsonify, \
-    redirect, url_for, make_response, request, escape
+from flask import Flask, render_template, Markup, Response, \
+    redirect, url_for, request, escape
 
 import cPickle
 from config import logging
 import os
 import json
 import config.settings as settings
-import multiprocessing as mp
-import collections
-from collections import OrderedDict
 from re import sub, search
 
 from src.metrics.users import MediaWikiUser
@@ -93,6 +93,13 @@ import src.etl.data_loader as dl
 import src.metrics.metrics_manager as mm
 
 from engine import *
+from cache import ResultCache, DEFAULT_MAX_ENTRIES, DEFAULT_MAX_BYTES, \
+    DEFAULT_TTL, LRU
+from response_store import ResponseStore, \
+    DEFAULT_MAX_ENTRIES as STORE_MAX_ENTRIES, \
+    DEFAULT_MAX_BYTES as STORE_MAX_BYTES, DEFAULT_TTL as STORE_TTL
+from scheduler import JobScheduler, DEFAULT_MAX_JOBS, DEFAULT_METRIC_LIMIT, \
+    NORMAL_PRIORITY, LOW_PRIORITY, QUEUED, PENDING, SUCCESS, FAILURE
 
 ######
 #
@@ -102,18 +109,25 @@ from engine import *
 
 app = Flask(__name__)
 
-# hash for jobs in queue_data dict
-global global_id
-global_id = 0
-
-# Stores cached requests (this should eventually be replaced
-# with a proper cache)
+# Stores cached requests.  The bounds of the cache may be set in the
+# project settings
 global pkl_data
-pkl_data = OrderedDict()
-
-# stores data in Queue objects that are active
-global queue_data
-queue_data = dict()
+pkl_data = ResultCache(
+    max_entries=getattr(settings, '__api_cache_max_entries__',
+                        DEFAULT_MAX_ENTRIES),
+    max_bytes=getattr(settings, '__api_cache_max_bytes__', DEFAULT_MAX_BYTES),
+    ttl=getattr(settings, '__api_cache_ttl__', DEFAULT_TTL),
+    policy=getattr(settings, '__api_cache_policy__', LRU))
+
+# Persistent store of responses, responses missing from `pkl_data` are
+# loaded from it.  The bounds of the store may be set in the project
+# settings
+global response_store
+response_store = ResponseStore(
+    max_entries=getattr(settings, '__api_store_max_entries__',
+                        STORE_MAX_ENTRIES),
+    max_bytes=getattr(settings, '__api_store_max_bytes__', STORE_MAX_BYTES),
+    ttl=getattr(settings, '__api_store_ttl__', STORE_TTL))
 
 # Error codes for web requests
 global error_codes
@@ -124,14 +138,6 @@ error_codes = {
     3 : 'Could not find User ID.',
 }
 
-# Queue for storing all active processes
-global processQ
-processQ = list()
-
-# Class defining all objects contained on the processQ
-QStructClass = collections.namedtuple('QStruct',
-    'id process request url queue status')
-
 # The default value for non-assigned and valid values in the query string
 DEFAULT_QUERY_VAL = 'present'
 
@@ -153,9 +159,11 @@ def get_errors(request_args):
         except ValueError: pass
     return error
 
-def process_metrics(p, rm):
+def process_metrics(p, rm, progress):
     """ Worker process for requests -
-        this will typically operate in a forked process """
+        this will typically operate in a forked process.  `progress` is a
+        shared value that tracks the fraction of completed time series
+        intervals """
 
     conn = dl.Connector(instance='slave')
     logging.info(__name__ + '::START JOB %s (PID = %s)' % (str(rm),
@@ -178,12 +186,30 @@ def process_metrics(p, rm):
                                                               str(args)))
 
     # process request
-    results = mm.process_data_request(rm.metric, users, **args)
+    def update_progress(completed, total):
+        progress.value = float(completed) / total
+    results = mm.process_data_request(rm.metric, users,
+                                      progress=update_progress, **args)
+    progress.value = 1.0
 
-    p.put(jsonify(results))
+    p.put(json.dumps(results))
     del conn
     logging.info(__name__ + '::END JOB %s (PID = %s)' % (str(rm), os.getpid()))
 
+def store_response(job):
+    """ Caches the response of a finished job """
+    set_data(job.request, Response(job.data, mimetype='application/json'),
+             pkl_data, response_store)
+
+# Runs the request jobs, see src/api/scheduler.py.  Requests over all users
+# are run after other requests.
+global scheduler
+scheduler = JobScheduler(process_metrics, store_response,
+    max_jobs=getattr(settings, '__api_max_jobs__', DEFAULT_MAX_JOBS),
+    metric_limit=getattr(settings, '__api_metric_job_limit__',
+                         DEFAULT_METRIC_LIMIT),
+    metric_limits=getattr(settings, '__api_metric_job_limits__', None))
+
 
 ######
 #
@@ -301,7 +327,6 @@ def output(cohort, metric):
     """ View corresponding to a data request -
         All of the setup and execution for a request happens here. """
 
-    global global_id
     url = request.url.split(request.url_root)[1]
 
     # Check for refresh flag - drop from url
@@ -336,32 +361,24 @@ def output(cohort, metric):
 
     # Determine if the request maps to an existing response.  If so return it.
     # Otherwise compute.
-    data = get_data(rm, pkl_data)
+    data = get_data(rm, pkl_data, response_store)
     if data and not refresh:
         return data
     else:
 
-        # Ensure that the job for this url is not already running
-        is_pending_job = False
-        for p in processQ:
-            if not cmp(rm, p.request) and p.status[0] == 'pending':
-                is_pending_job = True
+        # Queue the job.  Identical requests that are queued or running
+        # share the job, and its response, rather than computing it again
+        key_sig = get_key_signature(rm)
+        if not key_sig:
+            return redirect(url_for('cohorts') + '?error=2')
 
-        if not is_pending_job: # Queue the job
+        priority = LOW_PRIORITY if rm.cohort_expr == 'all' else \
+            NORMAL_PRIORITY
+        logging.info(__name__ + '::Appending request %s to the queue...' % rm)
+        scheduler.submit(rm, url, rm.metric, tuple(key_sig),
+                         priority=priority)
 
-            q = mp.Queue()
-            p = mp.Process(target=process_metrics, args=(q, rm))
-            p.start()
-
-            global_id += 1
-
-            logging.info(__name__ + '::Appending request %s to the queue...'
-                % rm)
-            processQ.append(QStructClass(global_id,p,rm,url,q,['pending']))
-
-            return render_template('processing.html', url_str=str(rm))
-        else:
-            return redirect(url_for('job_queue') + '?error=0')
+        return render_template('processing.html', url_str=str(rm))
 
 @app.route('/job_queue/')
 def job_queue():
@@ -371,48 +388,29 @@ def job_queue():
 
     def error_class(em):
         return {
-            'failure': 'error',
-            'pending': 'warning',
-        	'success': 'success'
-        	}.get(em, '') 
+            FAILURE: 'error',
+            PENDING: 'warning',
+            QUEUED: 'info',
+            SUCCESS: 'success'
+            }.get(em, '')
 
+    # Results of finished jobs are harvested by the scheduler
     p_list = list()
     p_list.append(Markup('<thead><tr><th>is_alive</th><th>PID</th><th>url'
-                         '</th><th>status</th></tr></thead>\n<tbody>\n'))
-    for p in processQ:
-        try:
-
-            # Pull data off of the queue and add it to the queue data
-            while not p.queue.empty():
-                if not queue_data.has_key(p.id):
-                    queue_data[p.id] = json.loads(p.queue.get().data)
-                else:
-                    for k,v in queue_data[p.id]:
-                        if hasattr(v,'__iter__'): queue_data[p.id][k].extend(v)
-
-            # once a process has finished working remove it and put its
-            # contents into the cache
-            if not p.process.is_alive() and p.status[0] == 'pending':
-                q_response = make_response(jsonify(queue_data[p.id]))
-                del queue_data[p.id]
-                set_data(p.request, q_response, pkl_data)
-
-                p.status[0] = 'success'
-                logging.info(__name__ + '::Completed request %s.' % p.url)
-
-        except Exception as e:
-            p.status[0] = 'failure'
-            logging.error(__name__ + "::Could not update request: %s.  "
-                                     "Exception: %s" % (p.url, e.message) )
+                         '</th><th>status</th><th>progress</th></tr></thead>\n'
+                         '<tbody>\n'))
+    for job in scheduler.jobs():
 
         # Log the status of the job
         response_url = "".join(['<a href="',
-                                request.url_root, p.url + '">', p.url, '</a>'])
-	
-        p_list.append(Markup('<tr class="'+ error_class(p.status[0])+'"><td>'))
-        p_list.append("</td><td>".join([str(p.process.is_alive()),
-                                        str(p.process.pid),
-                                  escape(Markup(response_url)), p.status[0]]))
+                                request.url_root, job.url + '">', job.url,
+                                '</a>'])
+
+        p_list.append(Markup('<tr class="'+ error_class(job.status)+'"><td>'))
+        p_list.append("</td><td>".join([str(job.is_alive()),
+                                        str(job.pid) if job.pid else '-',
+                                  escape(Markup(response_url)), job.status,
+                                  '%.0f%%' % (job.get_progress() * 100)]))
         p_list.append(Markup('</td></tr>'))
 
     p_list.append(Markup('\n</tbody>'))
@@ -426,25 +424,9 @@ def job_queue():
 def all_urls():
     """ View for listing all requests """
 
-    # Build a tree containing nested key values
-    tree = build_key_tree(pkl_data)
-    key_sigs = list()
-
-    # Depth first traversal - get the key signatures
-    for node in tree:
-        stack_trace = [node]
-        while stack_trace:
-            if stack_trace[-1]:
-                ptr = stack_trace[-1][1]
-                try: stack_trace.append(ptr.next())
-                except StopIteration: stack_trace.pop() # no more children
-            else:
-                key_sigs.append([elem[0] for elem in stack_trace[:-1]])
-                stack_trace.pop()
-
-    # Compose urls from key sigs
+    # Compose urls from the key sigs of the cached responses
     url_list = list()
-    for key_sig in key_sigs:
+    for key_sig in pkl_data.keys():
         url = get_url_from_keys(key_sig, 'stored')
         url_list.append("".join(['<a href="',
                                  request.url_root, url + '">', url, '</a>']))
@@ -454,33 +436,22 @@ def all_urls():
 def stored_requests(cohort, metric):
     """ View for processing stored requests """
     global pkl_data
-    hash_ref = pkl_data
 
-    # Parse the cohort and metric IDs
-    try:
-        hash_ref = hash_ref[
-                   'cohort_expr' + HASH_KEY_DELIMETER + cohort][
-                   'metric' + HASH_KEY_DELIMETER + metric]
-    except Exception:
-        logging.error(__name__ + '::Request not found for: %s' % request.url)
-        return redirect(url_for('cohorts') + '?error=2')
-
-    # Parse the parameter values
+    # Compose the key signature from the cohort and metric IDs and the
+    # parameter values
+    key_sig = ['cohort_expr' + HASH_KEY_DELIMETER + cohort,
+               'metric' + HASH_KEY_DELIMETER + metric]
     for param in REQUEST_META_QUERY_STR:
         if param in request.args:
-            try:
-                hash_ref = hash_ref[
-                           param + HASH_KEY_DELIMETER + request.args[param]]
-            except KeyError:
-                logging.error(__name__ + '::Request not found for: %s' %
-                                         request.url)
-                return redirect(url_for('cohorts') + '?error=2')
+            key_sig.append(param + HASH_KEY_DELIMETER + request.args[param])
 
     # Ensure that that the data is a HTTP response object
-    if hasattr(hash_ref, 'status_code'):
-        return hash_ref
+    data = pkl_data.get(key_sig)
+    if hasattr(data, 'status_code'):
+        return data
     else:
-        return redirect(url_for('cohort') + '?error=2')
+        logging.error(__name__ + '::Request not found for: %s' % request.url)
+        return redirect(url_for('cohorts') + '?error=2')
 
 
 ######
@@ -510,10 +481,16 @@ class APIMethods(object):
         except IOError:
             pkl_file = None
 
-        # test whether the open was successful
+        # test whether the open was successful, the stored responses are
+        # added to the cache subject to its current bounds
         if pkl_file:
-            pkl_data = cPickle.load(pkl_file)
+            data = cPickle.load(pkl_file)
             pkl_file.close()
+            if isinstance(data, ResultCache):
+                pkl_data.update(data)
+            else:
+                logging.error(__name__ + '::Stored responses are not in '
+                                         'the cache format, not loaded.')
 
     def close(self):
         """  When the instance is deleted store the pickled data """
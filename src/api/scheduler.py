@@ -0,0 +1,253 @@
+"""
+    Scheduler for the metric request jobs of the API.  Each job runs in a
+    separate process, and only a fixed number of jobs, `max_jobs`, run at a
+    time.  Jobs wait in a priority queue for a free slot.  The number of
+    running jobs of a single metric can be limited further: ::
+
+        >>> scheduler = JobScheduler(process_metrics, store_response,
+                max_jobs=4, metric_limits={'revert_rate' : 1})
+        >>> scheduler.submit(request_meta, url, 'revert_rate', key_sig)
+
+    Identical requests, with the same key signature, are coalesced.  While a
+    job is queued or running further submissions of its key signature
+    attach to it rather than starting another job.
+
+    A background thread harvests the results of running jobs and passes each
+    finished job to the completion callback.  It then frees the slot and
+    starts the next queued jobs.  Finished jobs are kept only for display in
+    the job queue, and only the most recent MAX_FINISHED_JOBS of them.
+"""
+
+__author__ = "ryan faulkner"
+__date__ = "01/23/2013"
+__license__ = "GPL (version 2 or later)"
+
+import heapq
+import multiprocessing as mp
+import threading
+import time
+from collections import deque
+
+from config import logging
+
+# Job states
+QUEUED = 'queued'
+PENDING = 'pending'
+SUCCESS = 'success'
+FAILURE = 'failure'
+
+# Job priorities, lower values are run first
+HIGH_PRIORITY = 0
+NORMAL_PRIORITY = 1
+LOW_PRIORITY = 2
+
+# Default number of jobs run at a time, overall and per metric (0 is
+# unlimited)
+DEFAULT_MAX_JOBS = 4
+DEFAULT_METRIC_LIMIT = 2
+
+# Seconds between harvests of the running jobs
+HARVEST_INTERVAL = 2.0
+
+# Number of finished jobs kept for display
+MAX_FINISHED_JOBS = 100
+
+
+class Job(object):
+    """ A metric request along with the process that services it """
+
+    def __init__(self, id, request, url, metric, priority, key=None):
+        self.id = id
+        self.request = request
+        self.url = url
+        self.metric = metric
+        self.priority = priority
+        self.key = key
+        self.status = QUEUED
+        self.data = None
+
+        # Number of submissions serviced by the job
+        self.requests = 1
+
+        self.process = None
+        self.queue = None
+        self.progress = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process else None
+
+    def get_progress(self):
+        """ Fraction of the job completed """
+        if self.status == SUCCESS:
+            return 1.0
+        return self.progress.value if self.progress else 0.0
+
+
+class JobScheduler(object):
+    """
+        Runs jobs within a budget of processes.  `target` is the job method,
+        run in a new process as target(queue, request, progress).  It puts
+        its result on `queue` and may report the fraction of the request
+        completed in the shared value `progress`.  `on_complete` is called
+        from the harvesting thread with each job whose process returned a
+        result, stored in `job.data`.
+    """
+
+    def __init__(self, target, on_complete, max_jobs=DEFAULT_MAX_JOBS,
+                 metric_limit=DEFAULT_METRIC_LIMIT, metric_limits=None,
+                 harvest_interval=HARVEST_INTERVAL):
+        self._target = target
+        self._on_complete = on_complete
+        self._max_jobs = max_jobs
+        self._metric_limit = metric_limit
+        self._metric_limits = metric_limits if metric_limits else dict()
+        self._harvest_interval = harvest_interval
+
+        self._lock = threading.RLock()
+        self._queued = list()       # heap of (priority, id, job)
+        self._running = list()
+        self._finished = deque(maxlen=MAX_FINISHED_JOBS)
+        self._in_flight = dict()    # queued and running jobs by key
+        self._last_id = 0
+        self._harvester = None
+
+    def submit(self, request, url, metric, key, priority=NORMAL_PRIORITY):
+        """
+            Queues a job servicing `request` and returns it.  `key`, the
+            signature of the request, must be hashable.  When a job for
+            `key` is already queued or running that job is returned
+            instead, and it runs at the higher of the two priorities.
+        """
+        with self._lock:
+            if key in self._in_flight:
+                job = self._in_flight[key]
+                job.requests += 1
+                if job.status == QUEUED and priority < job.priority:
+                    self._reprioritize(job, priority)
+                logging.info(__name__ + '::Request %s attached to job %s.' %
+                                        (str(request), job.id))
+                return job
+
+            self._last_id += 1
+            job = Job(self._last_id, request, url, metric, priority, key)
+            heapq.heappush(self._queued, (priority, job.id, job))
+            self._in_flight[key] = job
+            logging.info(__name__ + '::Queued request %s (priority = %s).' %
+                                    (str(request), priority))
+            self._dispatch()
+            self._start_harvester()
+        return job
+
+    def get_job(self, key):
+        """ The queued or running job for `key`, or None """
+        with self._lock:
+            return self._in_flight.get(key)
+
+    def jobs(self):
+        """ The running, queued and most recently finished jobs """
+        with self._lock:
+            return list(self._running) + \
+                [item[2] for item in sorted(self._queued)] + \
+                list(reversed(self._finished))
+
+    def harvest(self):
+        """
+            Collects the results of the running jobs, completes the jobs
+            whose process has ended and starts queued jobs in their place
+        """
+        with self._lock:
+            for job in list(self._running):
+                # A process that has ended has flushed its results
+                alive = job.is_alive()
+                try:
+                    while not job.queue.empty():
+                        job.data = job.queue.get()
+                except Exception as e:
+                    logging.error(__name__ + '::Could not read the results '
+                                             'of %s: %s' % (job.url, e))
+                if alive:
+                    continue
+
+                job.process.join()
+                self._running.remove(job)
+                self._complete(job)
+                del self._in_flight[job.key]
+                job.queue = None
+                self._finished.append(job)
+            self._dispatch()
+
+    def _complete(self, job):
+        if job.data is None:
+            job.status = FAILURE
+            logging.error(__name__ + '::Request %s returned no results '
+                                     '(exit code %s).' % (job.url,
+                                                          job.process.exitcode))
+            return
+        try:
+            self._on_complete(job)
+            job.status = SUCCESS
+            logging.info(__name__ + '::Completed request %s.' % job.url)
+        except Exception as e:
+            job.status = FAILURE
+            logging.error(__name__ + "::Could not update request: %s.  "
+                                     "Exception: %s" % (job.url, e))
+        # Results are kept by the completion callback
+        job.data = None
+
+    def _reprioritize(self, job, priority):
+        job.priority = priority
+        self._queued = [(priority, job.id, job) if item[2] is job else item
+                        for item in self._queued]
+        heapq.heapify(self._queued)
+
+    def _dispatch(self):
+        """ Starts the queued jobs, by priority, that fit the budgets """
+        deferred = list()
+        while self._queued and len(self._running) < self._max_jobs:
+            item = heapq.heappop(self._queued)
+            if self._at_metric_limit(item[2].metric):
+                deferred.append(item)
+            else:
+                self._start(item[2])
+        for item in deferred:
+            heapq.heappush(self._queued, item)
+
+    def _at_metric_limit(self, metric):
+        limit = self._metric_limits[metric] if metric in \
+            self._metric_limits else self._metric_limit
+        return bool(limit) and limit <= len([job for job in self._running
+                                             if job.metric == metric])
+
+    def _start(self, job):
+        job.queue = mp.Queue()
+        job.progress = mp.Value('d', 0.0)
+        job.process = mp.Process(target=self._target,
+                                 args=(job.queue, job.request, job.progress))
+        job.process.start()
+        job.status = PENDING
+        self._running.append(job)
+        logging.info(__name__ + '::Started request %s (PID = %s).' %
+                                (job.url, job.pid))
+
+    def _start_harvester(self):
+        if self._harvester is None:
+            self._harvester = threading.Thread(target=self._harvest_loop)
+            self._harvester.daemon = True
+            self._harvester.start()
+
+    def _harvest_loop(self):
+        """ Harvests periodically while there are jobs """
+        while True:
+            time.sleep(self._harvest_interval)
+            try:
+                self.harvest()
+            except Exception as e:
+                logging.error(__name__ + '::Harvest failed: %s' % e)
+            with self._lock:
+                if not self._running and not self._queued:
+                    self._harvester = None
+                    return
@@ -2,6 +2,12 @@
 """
     This module contains methods that provide functionality for aggregating
     metrics data.
+
+    The aggregators convert the columns they operate on to numpy arrays and
+    compute over them with array operations.  The array computations follow
+    the order of operations of a row by row fold so that floating point
+    results are identical.  Where values are not numeric, or not uniformly
+    typed, the aggregators fall back to processing the rows one at a time.
 """
 
 __author__ = "ryan faulkner"
@@ -9,7 +15,12 @@ __date__ = "12/12/2012"
 __license__ = "GPL (version 2 or later)"
 
 from itertools import izip
-from numpy import array
+from operator import itemgetter
+from numpy import array, cumsum
+import numpy as np
+
+# numpy dtype kinds of booleans, integers and floats
+NUMERIC_KINDS = 'biuf'
 
 def decorator_builder(header):
     """
@@ -47,8 +58,19 @@ def list_sum_indices(l, indices):
         >>> list_sum_indices(l,[1,2])
         [7, 57]
     """
-    return list(reduce(lambda x,y: x+y,
-        [array([elem.__getitem__(i) for i in indices]) for elem in l]))
+    l = _get_rows(l)
+    columns = _get_columns(l, indices) if len(l) else None
+    if columns is None or columns.dtype.kind not in NUMERIC_KINDS:
+        return list(reduce(lambda x,y: x+y,
+            [array([elem.__getitem__(i) for i in indices]) for elem in l]))
+
+    # The sum of numpy boolean arrays is their logical or.  Floats are
+    # accumulated in row order
+    if columns.dtype.kind == 'b':
+        return list(columns.any(axis=0))
+    elif columns.dtype.kind == 'f':
+        return list(columns.cumsum(axis=0)[-1])
+    return list(columns.sum(axis=0))
 
 def list_sum_by_group(l, group_index):
     """
@@ -63,6 +85,12 @@ def list_sum_by_group(l, group_index):
         >>> list_sum_by_group(l,0)
         [[1,4], [2,3]]
     """
+    l = list(l)
+    groups = _get_group_sums(l, group_index)
+    if groups:
+        d, counts = groups
+        return [d[k][:group_index] + [k] + d[k][group_index:] for k in d]
+
     d=dict()
     for i in l:
         summables = i[:group_index] + i[group_index+1:]
@@ -88,6 +116,13 @@ def list_average_by_group(l, group_index):
         >>> list_average(l,0)
         [[1, 4.0], [2, 1.5]]
     """
+    l = list(l)
+    groups = _get_group_sums(l, group_index)
+    if groups:
+        d, counts = groups
+        for k in counts: d[k] = list(array(d[k]) / float(counts[k]))
+        return [d[k][:group_index] + [k] + d[k][group_index:] for k in d]
+
     d=dict()
     counts=dict()
     for i in l:
@@ -114,35 +149,64 @@ def boolean_rate(iter, **kwargs):
         Useful aggregator for boolean metrics: threshold, survival,
                 live_accounts
     """
+    total, pos = _boolean_counts(_get_rows(iter), **kwargs)
+    if total:
+        return [total, pos, float(pos) / total]
+    else:
+        return [total, pos, 0.0]
+
+def _boolean_counts(rows, **kwargs):
+    """ Counts of rows and of rows meeting the criteria of boolean_rate """
     val_idx = kwargs['val_idx'] if 'val_idx' in kwargs else 1
     cmp_method = kwargs['cmp_method'] if 'cmp_method' in kwargs else cmp_method_default
 
+    # The default comparison may be evaluated over the whole column
+    values = _get_column(rows, val_idx) if \
+        cmp_method is cmp_method_default else None
+    if values is not None:
+        return len(values), int(cmp_method(values).sum())
+
     total=0
     pos=0
-    for r in iter.__iter__():
+    for r in rows:
         try:
             if cmp_method(r[val_idx]): pos+=1
             total+=1
         except IndexError: continue
         except TypeError: continue
-    if total:
-        return [total, pos, float(pos) / total]
-    else:
-        return [total, pos, 0.0]
+    return total, pos
 
 def weight_method_default(x): return 1
 def weighted_rate(iter, **kwargs):
     """
         Computes a weighted rate over the elements of the iterator.
     """
+    count, total_weight, weighted_sum = _weighted_sums(_get_rows(iter),
+        **kwargs)
+    if count:
+        return [count, total_weight, weighted_sum / count]
+    else:
+        return [count, total_weight, 0.0]
+
+def _weighted_sums(rows, **kwargs):
+    """ The row count, total weight and weighted sum of weighted_rate """
     weight_idx = kwargs['weight_idx'] if 'weight_idx' in kwargs else 1
     val_idx = kwargs['val_idx'] if 'val_idx' in kwargs else 1
     weight_method = kwargs['weight_method'] if 'cmp_method' in kwargs else weight_method_default
 
+    # With unit weights the sums are running sums over the columns
+    weights = values = None
+    if weight_method is weight_method_default:
+        weights = _get_column(rows, weight_idx)
+        values = weights if val_idx == weight_idx else \
+            _get_column(rows, val_idx)
+    if weights is not None and values is not None:
+        return len(rows), _running_sum(weights), _running_sum(values)
+
     count=0
     total_weight=0.0
     weighted_sum=0.0
-    for r in iter.__iter__():
+    for r in rows:
         try:
             count+=1
             weight = weight_method(r[weight_idx])
@@ -150,10 +214,229 @@ def weighted_rate(iter, **kwargs):
             weighted_sum += weight * r[val_idx]
         except IndexError: continue
         except TypeError: continue
-    if count:
-        return [count, total_weight, weighted_sum / count]
-    else:
-        return [count, total_weight, 0.0]
+    return count, total_weight, weighted_sum
+
+class PartialAggregate(object):
+    """
+        Mergeable partial state of an aggregator.  Workers reduce their rows
+        to a state by calling the instance, which must therefore be
+        picklable, states are combined with `merge` and `result` produces
+        the value returned by the aggregator.  The state of an empty list
+        of rows is the identity of `merge`.
+
+        Invertible partial aggregates also define `unmerge`, which removes
+        a state merged earlier, e.g. from a sliding window.
+    """
+    INVERTIBLE = False
+
+    def __call__(self, rows): return self.partial(list(rows))
+
+    def partial(self, rows): raise NotImplementedError()
+
+    def merge(self, x, y): raise NotImplementedError()
+
+    def unmerge(self, x, y): raise NotImplementedError()
+
+    def result(self, state): raise NotImplementedError()
+
+    def merge_all(self, states):
+        return reduce(self.merge, states, self.partial([]))
+
+class SumIndicesPartial(PartialAggregate):
+    """ Partial aggregate of list_sum_indices """
+    INVERTIBLE = True
+
+    def __init__(self, indices):
+        self.indices = indices
+
+    def partial(self, rows):
+        return array(list_sum_indices(rows, self.indices)) if rows else None
+
+    def merge(self, x, y):
+        if x is None: return y
+        if y is None: return x
+        return x + y
+
+    def unmerge(self, x, y):
+        if y is None: return x
+        return x - y
+
+    def result(self, state):
+        if state is None:
+            return [0] * len(self.indices)
+        return list(state)
+
+class BooleanRatePartial(PartialAggregate):
+    """ Partial aggregate of boolean_rate, counts of rows and matches """
+    INVERTIBLE = True
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def partial(self, rows):
+        return _boolean_counts(rows, **self.kwargs)
+
+    def merge(self, x, y): return x[0] + y[0], x[1] + y[1]
+
+    def unmerge(self, x, y): return x[0] - y[0], x[1] - y[1]
+
+    def result(self, state):
+        total, pos = state
+        if total:
+            return [total, pos, float(pos) / total]
+        else:
+            return [total, pos, 0.0]
+
+class WeightedRatePartial(PartialAggregate):
+    """
+        Partial aggregate of weighted_rate, the row count, total weight
+        and weighted sum
+    """
+    INVERTIBLE = True
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def partial(self, rows):
+        return _weighted_sums(rows, **self.kwargs)
+
+    def merge(self, x, y): return x[0] + y[0], x[1] + y[1], x[2] + y[2]
+
+    def unmerge(self, x, y): return x[0] - y[0], x[1] - y[1], x[2] - y[2]
+
+    def result(self, state):
+        count, total_weight, weighted_sum = state
+        if count:
+            return [count, total_weight, weighted_sum / count]
+        else:
+            return [count, total_weight, 0.0]
+
+# Partial aggregates of the generic aggregators, which take the aggregation
+# indices of the metric
+PARTIAL_AGGREGATES = {
+    'list_sum_indices' : SumIndicesPartial,
+}
+
+def _get_rows(data):
+    """
+        The rows of `data`, a metric or an iterable of rows, as a list.
+        Results stored by column (see src.utils.columnar) are returned as
+        they are so that their columns are read directly.
+    """
+    if hasattr(data, 'columns'):
+        return data
+    if hasattr(getattr(data, '_results', None), 'columns'):
+        return data._results
+    return list(data.__iter__())
+
+def _get_column(rows, idx):
+    """
+        Returns the values at index `idx` of `rows` as a numpy array, or
+        None if a row is too short or the values are not numeric.
+    """
+    column = rows.column(idx) if hasattr(rows, 'column') else None
+    try:
+        if column is None:
+            column = array(map(itemgetter(idx), rows))
+    except IndexError:
+        return None
+    if column.dtype.kind not in NUMERIC_KINDS:
+        return None
+    return column
+
+def _get_columns(rows, indices):
+    """
+        Returns the values at `indices` of `rows` as a 2-D numpy array with
+        a row for each element of `rows`, or None if a row is too short.
+        Converting column by column is much cheaper than converting the
+        rows.
+    """
+    if hasattr(rows, 'columns'):
+        columns = rows.columns(indices)
+        if columns is not None:
+            return columns
+    try:
+        columns = [array(map(itemgetter(i), rows)) for i in indices]
+    except IndexError:
+        return None
+    if any(column.ndim != 1 for column in columns):
+        return None
+    return np.column_stack(columns)
+
+def _running_sum(column):
+    """
+        Sum of a column accumulated in order, from 0.0, as floats.  Unlike
+        `ndarray.sum` (pairwise summation) this matches a loop over the
+        values.
+    """
+    if not len(column):
+        return 0.0
+    return float(cumsum(column.astype(float))[-1])
+
+def _get_typed_column(values):
+    """
+        Converts a list of values that are all integers or all floats to a
+        numpy array.  Returns None for any other list.
+    """
+    types = set(map(type, values))
+    if types and types <= set([int, long]):
+        column = array(values)
+        if column.dtype.kind == 'i':
+            return column
+    elif types == set([float]):
+        return array(values)
+    return None
+
+def _get_group_sums(l, group_index):
+    """
+        Sums the elements of rows `l` outside of `group_index` by the value
+        at `group_index`.  Returns a dict of summed elements keyed by group,
+        with groups inserted in order of first appearance, and a dict of
+        group counts.  Returns None if the rows can not be summed as arrays.
+    """
+    if not l:
+        return None
+    widths = set(map(len, l))
+    if len(widths) != 1 or group_index >= list(widths)[0]:
+        return None
+    width = widths.pop()
+
+    # Index each row by group
+    keys = map(itemgetter(group_index), l)
+    group_ids = dict()
+    group_keys = list()
+    first_rows = list()
+    for row, key in enumerate(keys):
+        if not group_ids.has_key(key):
+            group_ids[key] = len(group_keys)
+            group_keys.append(key)
+            first_rows.append(row)
+    idx = array(map(group_ids.__getitem__, keys))
+    counts = np.bincount(idx, minlength=len(group_keys))
+
+    # numpy.bincount accumulates the weights in row order.  Integer sums
+    # are exact in doubles as long as they remain below 2**53
+    sums = list()
+    for j in xrange(width):
+        if j == group_index: continue
+        column = _get_typed_column(map(itemgetter(j), l))
+        if column is None:
+            return None
+        if column.dtype.kind == 'i' and np.abs(column).sum() >= 2 ** 53:
+            return None
+        acc = np.bincount(idx, weights=column, minlength=len(group_keys))
+        sums.append(acc.astype(column.dtype).tolist())
+
+    # Groups with a single row keep the row's elements
+    d=dict()
+    for i in xrange(len(group_keys)):
+        if counts[i] == 1:
+            row = l[first_rows[i]]
+            d[group_keys[i]] = row[:group_index] + row[group_index+1:]
+        else:
+            d[group_keys[i]] = [col[i] for col in sums]
+    return d, dict((group_keys[i], int(counts[i]))
+                   for i in xrange(len(group_keys)))
 
 class AggregatorException(Exception): pass
 
@@ -51,13 +51,22 @@ __date__ = "October 3rd, 2012"
 __license__ = "GPL (version 2 or later)"
 
 import sys
+import os
 import MySQLdb
+import MySQLdb.cursors
 import logging
 import operator
+import threading
+import time
+import weakref
 import config.settings as projSet
+from contextlib import contextmanager
 
 from config import logging
 
+# Maximum number of rows held in memory at once when streaming results
+STREAM_BATCH_SIZE = 10000
+
 def read_file(file_path_name):
     """ reads a text file line by line """
     with open(file_path_name) as f: content = f.readlines()
@@ -162,6 +171,246 @@ class Connector(object):
 
         return self._cur_.fetchall()
 
+    def execute_SQL_stream(self, SQL_statement,
+                           batch_size=STREAM_BATCH_SIZE):
+        """
+            Executes a SQL statement on an unbuffered server-side cursor and
+            yields the result rows.  Rows are pulled from the server in
+            batches of at most `batch_size` so that memory use does not grow
+            with the size of the result set.
+
+            The connection cannot execute other statements until the
+            generator is exhausted or closed.
+
+            Parameters:
+                - **SQL_statement**: String. variable storing the SQL query
+                - **batch_size**: Integer. maximum rows fetched at once
+
+            Return:
+                - Generator(tuple).  The query result rows.
+        """
+        cur = self._db_.cursor(MySQLdb.cursors.SSCursor)
+        try:
+            cur.execute(SQL_statement)
+            while 1:
+                rows = cur.fetchmany(batch_size)
+                if not rows: break
+                for row in rows: yield row
+        finally:
+            cur.close()
+
+class ConnectorPool(object):
+    """
+        Singleton class that maintains a per-process pool of Connector
+        objects keyed by instance.  Workers borrow connections with
+        *get_connection()* and hand them back with *release_connection()*
+        rather than building a new connection for each query: ::
+
+            >>> import src.etl.data_loader as dl
+            >>> conn = dl.get_connection(instance='slave')
+            >>> conn._cur_.execute('select 1')
+            >>> dl.release_connection(conn)
+
+        or equivalently: ::
+
+            >>> with dl.connection(instance='slave') as conn:
+            ...     conn._cur_.execute('select 1')
+
+        Borrowed connections are pinged before being handed out and
+        re-opened if they have dropped.  At most `max_size` connections,
+        borrowed and idle, are open per instance.  A borrower waits for a
+        connection to be released when the pool is exhausted and
+        *ConnectorError* is raised if none is released within
+        `WAIT_TIMEOUT` seconds.  Connections that are never released stop
+        counting against the pool once they are garbage collected.
+
+        The pool is safe to use after fork: a process that inherits the
+        pool from its parent starts with an empty pool.  Inherited
+        connections are never handed out by the child.  Their sockets are
+        detached in the child before they are closed so that the parent's
+        sessions stay open.
+    """
+
+    # Maximum number of connections, borrowed and idle, per instance
+    MAX_SIZE = 32
+
+    # Seconds a borrower waits for a connection when the pool is exhausted
+    WAIT_TIMEOUT = 60.0
+
+    __instance = None   # Singleton instance
+
+    def __new__(cls, *args, **kwargs):
+        """ This class is Singleton, return only one instance """
+        if not cls.__instance:
+            cls.__instance = super(ConnectorPool, cls).__new__(cls)
+            cls.__instance._lock = threading.Condition(threading.Lock())
+            cls.__instance._reset(cls.MAX_SIZE)
+        return cls.__instance
+
+    def _reset(self, max_size):
+        """ Initialize pool state for the current process """
+        self._pid = os.getpid()
+        self._max_size = max_size
+        self._idle = dict()
+        self._borrowed = weakref.WeakKeyDictionary()  # connection -> instance
+        self._opening = dict()      # connections being opened by instance
+        self._inherited = list()
+
+    def _check_pid(self):
+        """ Discard connections (and the lock) inherited from a parent
+            process.  This must be called before acquiring the lock. """
+        if self._pid != os.getpid():
+            inherited = self._inherited + [conn for conns in
+                                           self._idle.values()
+                                           for conn in conns]
+            self._lock = threading.Condition(threading.Lock())
+            self._reset(self._max_size)
+            self._inherited = [conn for conn in inherited
+                               if not self._detach(conn)]
+
+    def set_max_size(self, max_size):
+        """ Set the maximum number of connections per instance """
+        with self._lock:
+            self._max_size = int(max_size)
+            self._lock.notify_all()
+
+    def get(self, instance='slave'):
+        """ Borrow a healthy connection to `instance` from the pool """
+        self._check_pid()
+        deadline = time.time() + self.WAIT_TIMEOUT
+        with self._lock:
+            idle = self._idle.setdefault(instance, list())
+            while True:
+                while idle:
+                    conn = idle.pop()
+                    if self._is_healthy(conn):
+                        self._borrowed[conn] = instance
+                        return conn
+                    conn.close_db()
+                if self._borrowed_count(instance) < self._max_size:
+                    break
+
+                # Wait in slices, connections may also be freed by the
+                # garbage collector
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ConnectorError('Connection pool for "%s" is '
+                                         'exhausted (%s connections).' %
+                                         (instance, self._max_size))
+                self._lock.wait(min(remaining, 1.0))
+
+            # Reserve the connection while it is opened
+            self._opening[instance] = self._opening.get(instance, 0) + 1
+
+        conn = None
+        try:
+            conn = Connector(instance=instance)
+            conn._instance_ = instance
+            conn._pid_ = os.getpid()
+        finally:
+            with self._lock:
+                self._opening[instance] -= 1
+                if conn is None:
+                    self._lock.notify()
+                else:
+                    self._borrowed[conn] = instance
+        return conn
+
+    def put(self, conn):
+        """ Return a borrowed connection to the pool """
+        if not hasattr(conn, '_instance_'):
+            conn.close_db()
+            return
+
+        self._check_pid()
+        with self._lock:
+            # Connections opened in another process are detached
+            if conn._pid_ != os.getpid():
+                if not self._detach(conn):
+                    self._inherited.append(conn)
+                return
+
+            self._borrowed.pop(conn, None)
+            idle = self._idle.setdefault(conn._instance_, list())
+            if len(idle) + self._borrowed_count(conn._instance_) >= \
+                    self._max_size or not self._reset_conn(conn):
+                conn.close_db()
+            else:
+                idle.append(conn)
+            self._lock.notify()
+
+    def close_all(self):
+        """ Close all idle connections owned by this process """
+        self._check_pid()
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns: conn.close_db()
+            self._idle = dict()
+            self._lock.notify_all()
+
+    def _borrowed_count(self, instance):
+        """ Number of connections to `instance` borrowed or being opened """
+        return self._opening.get(instance, 0) + \
+            len([conn for conn, conn_instance in self._borrowed.items()
+                 if conn_instance == instance])
+
+    def _is_healthy(self, conn):
+        """ Health check - ping the server """
+        try:
+            conn._db_.ping()
+            return True
+        except (MySQLdb.Error, AttributeError):
+            return False
+
+    def _reset_conn(self, conn):
+        """ End any open transaction and discard unread results so that the
+            next borrower starts with a clean connection """
+        try:
+            conn._cur_.close()
+            conn._db_.rollback()
+            conn._cur_ = conn._db_.cursor()
+            return True
+        except (MySQLdb.Error, AttributeError):
+            return False
+
+    @staticmethod
+    def _detach(conn):
+        """
+            Closes a connection inherited from a parent process without
+            ending the parent's session.  The socket of the connection is
+            replaced by /dev/null in this process first so that closing the
+            connection does not reach the server.  Returns False if the
+            connection could not be detached, it must then be kept open.
+        """
+        try:
+            fd = conn._db_.fileno()
+            devnull = os.open(os.devnull, os.O_RDWR)
+            try:
+                os.dup2(devnull, fd)
+            finally:
+                os.close(devnull)
+        except (MySQLdb.Error, AttributeError, OSError):
+            return False
+        conn.close_db()
+        return True
+
+def get_connection(instance='slave'):
+    """ Borrow a connection from the process connection pool """
+    return ConnectorPool().get(instance=instance)
+
+def release_connection(conn):
+    """ Return a connection to the process connection pool """
+    ConnectorPool().put(conn)
+
+@contextmanager
+def connection(instance='slave'):
+    """ Context manager that borrows a pooled connection """
+    conn = get_connection(instance=instance)
+    try:
+        yield conn
+    finally:
+        release_connection(conn)
+
 class DataLoader(object):
     """ Singleton class for performing operations on data sets.
         ETL class for xsv and RDBMS data sources. """
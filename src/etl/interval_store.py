@@ -0,0 +1,164 @@
+"""
+    This module implements a persistent store for time series data points.
+    Each aggregated interval result is stored under the signature of the
+    series that produced it (metric, metric parameters, cohort, aggregator)
+    and the interval bounds, so that a series that is requested again only
+    needs to compute the intervals that have not been stored yet: ::
+
+        >>> store = IntervalStore()
+        >>> key = store.series_key(metric, aggregator, cohort, kwargs)
+        >>> rows = store.get(key, intervals)
+        >>> missing = [i for i in intervals if not i in rows]
+
+    Interval results are only final once the interval has ended.  Results
+    computed before `SETTLE_SECONDS` had passed since the end of their
+    interval are treated as stale and recomputed.
+
+    The store is bounded by a retention time (TTL) and a number of results.
+    At most once every SWEEP_INTERVAL seconds a put sweeps the store.  The
+    sweep removes the results stored more than the TTL ago, then the oldest
+    results while the store holds more than its maximum.
+"""
+
+__author__ = "ryan faulkner"
+__date__ = "01/16/2013"
+__license__ = "GPL (version 2 or later)"
+
+import hashlib
+import time
+
+import config.settings as projSet
+import src.metrics.user_metric as um
+from src.utils.locked_shelf import LockedShelf
+from src.utils.timestamp import to_epoch
+from config import logging
+
+# Stored results are final once computed this long after the interval end
+SETTLE_SECONDS = 3600
+
+STORE_FILE = 'interval_store'
+
+# Default bounds, a bound of 0 is unlimited
+DEFAULT_MAX_ENTRIES = 100000
+DEFAULT_TTL = 90 * 24 * 3600    # seconds
+
+# Seconds between sweeps of the store and the key of the last sweep time
+SWEEP_INTERVAL = 3600
+SWEEP_KEY = 'swept'
+
+# Keyword args that only affect how a metric is computed and not its result
+EXECUTION_KWARGS = ['num_threads', 'metric_threads', 'rev_threads', 'log',
+                    'log_progress', 'log_frequency', 'executor', 'batch',
+                    'progress', 'store', 'columnar', 'stream']
+
+
+class IntervalStore(object):
+    """
+        Shelve backed store of time series rows, or of the partial
+        aggregates of sliding window series.  The shelve is opened for
+        each read or write under an exclusive lock (see
+        src.utils.locked_shelf) since requests are processed by separate
+        processes.
+    """
+
+    def __init__(self, path=None, max_entries=None, ttl=None):
+        self._path = path if path else projSet.__data_file_dir__ + STORE_FILE
+        self._max_entries = max_entries if max_entries is not None else \
+            getattr(projSet, '__interval_store_max_entries__',
+                    DEFAULT_MAX_ENTRIES)
+        self._ttl = ttl if ttl is not None else \
+            getattr(projSet, '__interval_store_ttl__', DEFAULT_TTL)
+
+    @staticmethod
+    def series_key(metric, aggregator, cohort, kwargs, partial=False):
+        """
+            Composes the signature of a time series.  Returns None if the
+            cohort is not an explicit collection of user ids in which case
+            the series can not be stored.  Series of partial aggregates
+            (see src.etl.aggregator.PartialAggregate) are told apart by
+            `partial`.
+        """
+        if not isinstance(cohort, (list, tuple, set)):
+            return None
+
+        agg_name = um.get_aggregator_name(aggregator)
+        agg_kwargs = getattr(aggregator, um.METRIC_AGG_METHOD_KWARGS) if \
+            hasattr(aggregator, um.METRIC_AGG_METHOD_KWARGS) else {}
+
+        params = sorted((str(key), str(kwargs[key])) for key in kwargs
+                        if not key in EXECUTION_KWARGS)
+        cohort_hash = hashlib.sha1(
+            ','.join(sorted(str(user) for user in cohort))).hexdigest()
+
+        signature = [metric.__name__, params, cohort_hash, agg_name,
+                     sorted(agg_kwargs.items())]
+        if partial: signature.append('partial')
+        return hashlib.sha1(repr(signature)).hexdigest()
+
+    @staticmethod
+    def _interval_key(series_key, ts_s, ts_e):
+        return '%s:%s:%s' % (series_key, to_epoch(ts_s), to_epoch(ts_e))
+
+    def get(self, series_key, intervals):
+        """
+            Returns a dict of the stored rows, keyed by (start, end), of
+            those `intervals` whose result is stored and final.
+        """
+        rows = dict()
+        if not series_key: return rows
+
+        try:
+            store = LockedShelf(self._path)
+        except Exception as e:
+            logging.error(__name__ + '::Could not open the interval store: '
+                                     '%s' % e.message)
+            return rows
+        try:
+            for ts_s, ts_e in intervals:
+                key = self._interval_key(series_key, ts_s, ts_e)
+                if store.has_key(key):
+                    row, computed = store[key]
+                    if computed >= to_epoch(ts_e) + SETTLE_SECONDS and \
+                            not self._is_expired(computed):
+                        rows[(ts_s, ts_e)] = row
+        finally:
+            store.close()
+        return rows
+
+    def put(self, series_key, ts_s, ts_e, row):
+        """ Stores the row (or partial aggregate) computed for an interval
+            of a series """
+        if not series_key: return
+
+        computed = int(time.time())
+        try:
+            store = LockedShelf(self._path)
+        except Exception as e:
+            logging.error(__name__ + '::Could not open the interval store: '
+                                     '%s' % e.message)
+            return
+        try:
+            store[self._interval_key(series_key, ts_s, ts_e)] = \
+                (row, computed)
+            if not store.has_key(SWEEP_KEY) or \
+                    computed >= store[SWEEP_KEY] + SWEEP_INTERVAL:
+                self._sweep(store)
+                store[SWEEP_KEY] = computed
+        finally:
+            store.close()
+
+    def _sweep(self, store):
+        """ Removes the expired results, then the oldest results until the
+            store is within its bound """
+        computed = dict((key, store[key][1]) for key in store.keys()
+                        if key != SWEEP_KEY)
+        by_age = sorted(computed, key=computed.get)
+        expired = len([key for key in by_age
+                       if self._is_expired(computed[key])])
+        excess = len(by_age) - expired - self._max_entries if \
+            self._max_entries else 0
+        for key in by_age[:expired + max(0, excess)]:
+            del store[key]
+
+    def _is_expired(self, computed):
+        return bool(self._ttl) and time.time() >= computed + self._ttl
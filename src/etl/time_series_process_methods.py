@@ -8,23 +8,19 @@ __date__ = "12/10/2012"
 __license__ = "GPL (version 2 or later)"
 
 import datetime
-import time
 import os
 from copy import deepcopy
-from dateutil.parser import parse as date_parse
+from src.utils.timestamp import parse_timestamp as date_parse
 import operator
 import json
 
 import src.metrics.revert_rate as rr
 import src.metrics.user_metric as um
-from multiprocessing import Process, Queue
+import src.utils.multiprocessing_wrapper as mpw
+from src.etl.interval_store import IntervalStore
 
 from config import logging
 
-# Determines the amount of time to wait before picking completed threads off
-# of the queue
-PROCESS_SLEEP_TIME      = 5
-
 def _get_timeseries(date_start, date_end, interval):
     """
         Generates a series of timestamps given a start date,
@@ -74,69 +70,170 @@ def build_time_series(start, end, interval, metric, aggregator, cohort,
                 aggregator, cohort,
             num_threads=4, num_threads_metric=2, log=True)
 
+        Metrics that implement `process_intervals` (e.g. BytesAdded) are
+        computed for all intervals from a single pass over the data when the
+        cohort is a list of user IDs.  Otherwise the metric is processed
+        separately for each interval.
     """
 
-    log = bool(kwargs['log']) if 'log' in kwargs else False
+    # sort
+    return sorted(iter_time_series(start, end, interval, metric, aggregator,
+                                   cohort, **kwargs),
+                  key=operator.itemgetter(0), reverse=False)
 
-    # Get datetime types, and the number of threads
-    start = date_parse(um.UserMetric._get_timestamp(start))
-    end = date_parse(um.UserMetric._get_timestamp(end))
-    k = kwargs['num_threads'] if 'num_threads' in kwargs else 1
+def iter_time_series(start, end, interval, metric, aggregator, cohort,
+                     **kwargs):
+    """
+        Generator version of build_time_series.  Data points are yielded as
+        soon as their interval has been computed and so arrive in order of
+        completion.  The keyword arg `progress` may be a method that is
+        called with the number of completed intervals and the total number
+        of intervals after each data point.
+
+        When the keyword arg `store` is set the data points are persisted
+        in an IntervalStore and only intervals that have no final stored
+        result are computed.  Stored data points are yielded first.
+    """
 
-    # Compute window size and ensure that all the conditions
-    # necessary to generate a proper time series are met
-    num_intervals = int((end - start).total_seconds() / (3600 * interval))
-    intervals_per_thread = num_intervals / k
+    def to_row(ts_s, ts_e, rows):
+        # Aggregation is done here since metric specific aggregators are
+        # not picklable
+        r = um.aggregator(aggregator, MetricResults(metric, rows),
+                          metric.header())
+        return [str(ts_s), str(ts_e)] + r.data
 
-    # Compose the sets of time series lists
-    f = lambda t,i:  t + datetime.timedelta(
-        hours = intervals_per_thread * interval * i)
-    time_series = [_get_timeseries(f(start, i),
-        f(start, i+1), interval) for i in xrange(k)]
-    if f(start, k) <  end: time_series.append(
-        _get_timeseries(f(start, k), end, interval))
+    intervals = _get_intervals(start, end, interval)
+    for ts_s, ts_e, row in _iter_intervals(intervals, metric, aggregator,
+                                           cohort, to_row, kwargs):
+        yield row
 
+def build_window_series(start, end, interval, window, metric, aggregator,
+                        cohort, **kwargs):
+    """
+        Builds a sliding window time series.  Each data point aggregates
+        `window` hours of data and consecutive data points are `interval`
+        hours apart, e.g. a 7 day rolling edit rate with a daily step: ::
+
+            >>> build_window_series('20120101000000', '20120201000000', 24,
+                    168, er.EditRate, er.edit_rate_agg, cohort)
+
+        The metric is computed once for each `interval` length step and
+        each step is reduced to the partial aggregate of `aggregator` (see
+        src.etl.aggregator.PartialAggregate).  The state of a window is
+        maintained by merging the newest step and unmerging the step that
+        left the window, rather than by recomputing the window.  This
+        requires an invertible partial aggregate.  The rows of a user are
+        counted once for each step of a window, rates are therefore rates
+        over user steps.
+
+        The keyword args are those of iter_time_series, when `store` is
+        set the partial aggregates of the steps are persisted.
+    """
+
+    partial = um.get_partial_aggregate(aggregator, metric)
+    if partial is None or not partial.INVERTIBLE:
+        raise TimeSeriesException(message="Aggregator %s can not be used "
+                                          "over sliding windows." %
+                                          um.get_aggregator_name(aggregator))
+    if window < interval or window % interval:
+        raise TimeSeriesException(message="The window must be a multiple of "
+                                          "the interval.")
+
+    intervals = _get_intervals(start, end, interval)
+    states = dict(((ts_s, ts_e), state) for ts_s, ts_e, state in
+                  _iter_intervals(intervals, metric, aggregator, cohort,
+                                  lambda ts_s, ts_e, rows: partial(rows),
+                                  kwargs, partial=True))
+
+    steps = window / interval
     data = list()
-    q = Queue()
-    processes = list()
-
-    if log: logging.info(
-        'Spawning procs, %s - %s, interval = %s, threads = %s ... ' % (
-        str(start), str(end), interval, k))
-    for i in xrange(len(time_series)):
-        p = Process(
-            target=time_series_worker, args=(
-                time_series[i], metric, aggregator, cohort, kwargs, q))
-        p.start()
-        processes.append(p)
-
-    while 1:
-        # sleep before checking worker threads
-        time.sleep(PROCESS_SLEEP_TIME)
-
-        if log:
-            logging.info('Process queue, %s threads.' % str(len(processes)))
-
-        while not q.empty():
-            data.extend(q.get())
-        for p in processes:
-            if not p.is_alive():
-                p.terminate()
-                processes.remove(p)
-
-        # exit if all process have finished
-        if not len(processes):
-            break
+    state = partial.partial([])
+    for i in xrange(len(intervals)):
+        state = partial.merge(state, states[intervals[i]])
+        if i >= steps:
+            state = partial.unmerge(state, states[intervals[i - steps]])
+        if i >= steps - 1:
+            data.append([str(intervals[i - steps + 1][0]),
+                         str(intervals[i][1]),
+                         um.get_aggregator_name(aggregator)] +
+                        partial.result(state))
+    return data
+
+def _get_intervals(start, end, interval):
+    """ The consecutive (start, end) intervals of a time series """
+    start = date_parse(um.UserMetric._get_timestamp(start))
+    end = date_parse(um.UserMetric._get_timestamp(end))
 
-    # sort
-    return sorted(data, key=operator.itemgetter(0), reverse=False)
+    intervals = list()
+    series = _get_timeseries(start, end, interval)
+    ts_s = series.next()
+    for ts_e in series:
+        intervals.append((ts_s, ts_e))
+        ts_s = ts_e
+    return intervals
+
+def _iter_intervals(intervals, metric, aggregator, cohort, reduce_rows,
+                    kwargs, partial=False):
+    """
+        Generates (start, end, value) for each of `intervals`, where value
+        is `reduce_rows(start, end, rows)` of the metric results of the
+        interval.  See iter_time_series for the keyword args, `partial`
+        distinguishes stored partial aggregates from stored data points.
+    """
 
-def time_series_worker(time_series, metric, aggregator, cohort, kwargs, q):
-    """ worker thread which computes time series data for a set of points """
     log = bool(kwargs['log']) if 'log' in kwargs else False
+    progress = kwargs['progress'] if 'progress' in kwargs else None
+    if 'progress' in kwargs: del kwargs['progress']
+    store = IntervalStore() if 'store' in kwargs and kwargs['store'] else None
+    if 'store' in kwargs: del kwargs['store']
+    k = kwargs['num_threads'] if 'num_threads' in kwargs else 1
 
-    data = list()
-    ts_s = time_series.next()
+    # Yield the stored values
+    series_key = store.series_key(metric, aggregator, cohort, kwargs,
+                                  partial=partial) if store else None
+    stored = store.get(series_key, intervals) if series_key else dict()
+    completed = 0
+    for ts_s, ts_e in intervals:
+        if (ts_s, ts_e) in stored:
+            completed += 1
+            if progress: progress(completed, len(intervals))
+            yield ts_s, ts_e, stored[(ts_s, ts_e)]
+    missing = [i for i in intervals if not i in stored]
+
+    if log and intervals: logging.info(
+        'Submitting intervals, %s - %s, threads = %s, stored = %s ... ' %
+        (str(intervals[0][0]), str(intervals[-1][1]), k, len(stored)))
+
+    # Intervals are computed in a single pass where the metric supports it,
+    # otherwise each interval is a separate worker task
+    if missing and hasattr(metric, 'process_intervals') and \
+            hasattr(cohort, '__iter__') and cohort:
+        results = (r for run in _get_consecutive_runs(missing)
+                   for r in _process_intervals(run, metric, cohort, kwargs))
+    else:
+        results = (r for chunk in mpw.iter_thread_pool(
+            missing, time_series_worker, k, [metric, cohort, kwargs],
+            chunk_size=1) for r in chunk)
+
+    for ts_s, ts_e, rows in results:
+        value = reduce_rows(ts_s, ts_e, rows)
+        if series_key: store.put(series_key, ts_s, ts_e, value)
+        completed += 1
+        if progress: progress(completed, len(intervals))
+        yield ts_s, ts_e, value
+
+def _get_consecutive_runs(intervals):
+    """ Splits a list of intervals into runs of consecutive intervals """
+    runs = list()
+    for interval in intervals:
+        if runs and runs[-1][-1][1] == interval[0]:
+            runs[-1].append(interval)
+        else:
+            runs.append([interval])
+    return runs
+
+def _get_metric_kwargs(kwargs):
+    """ Copy the time series keyword args for the metric """
     new_kwargs = deepcopy(kwargs)
 
     # re-map some keyword args relating to thread counts
@@ -144,10 +241,35 @@ def time_series_worker(time_series, metric, aggregator, cohort, kwargs, q):
         d = json.loads(new_kwargs['metric_threads'])
         for key in d: new_kwargs[key] = d[key]
         del new_kwargs['metric_threads']
+    return new_kwargs
+
+def _process_intervals(intervals, metric, cohort, kwargs):
+    """ Computes the metric results of every interval in one call to the
+        `process_intervals` method of the metric """
+    log = bool(kwargs['log']) if 'log' in kwargs else False
+    new_kwargs = _get_metric_kwargs(kwargs)
+
+    if log: logging.info(__name__ +
+                         ' :: Processing %s intervals, %s - %s ...' % (
+        len(intervals), str(intervals[0][0]), str(intervals[-1][1])))
+
+    metric_obj = metric(date_start=intervals[0][0],
+                        date_end=intervals[-1][1], **new_kwargs)
+    results = metric_obj.process_intervals(cohort, intervals, **new_kwargs)
+    return [(intervals[i][0], intervals[i][1], results[i])
+            for i in xrange(len(intervals))]
+
+def time_series_worker(args):
+    """ worker thread which computes time series data for a set of
+        intervals, returns the metric results of each interval """
+    intervals = args[0]
+    metric, cohort, kwargs = args[1]
+    log = bool(kwargs['log']) if 'log' in kwargs else False
+
+    data = list()
+    new_kwargs = _get_metric_kwargs(kwargs)
 
-    while 1:
-        try: ts_e = time_series.next()
-        except StopIteration: break
+    for ts_s, ts_e in intervals:
 
         if log: logging.info(__name__ +
                              ' :: Processing thread %s, %s - %s ...' % (
@@ -156,15 +278,27 @@ def time_series_worker(time_series, metric, aggregator, cohort, kwargs, q):
         metric_obj = metric(date_start=ts_s,date_end=ts_e,**new_kwargs).\
             process(cohort, **new_kwargs)
 
-        r = um.aggregator(aggregator, metric_obj, metric.header())
-
         if log: logging.info(__name__ +
                              ' :: Processing complete %s, %s - %s ...' % (
                                  os.getpid(), str(ts_s), str(ts_e)))
 
-        data.append([str(ts_s), str(ts_e)] + r.data)
-        ts_s = ts_e
-    q.put(data) # add the data to the queue
+        data.append((ts_s, ts_e, list(metric_obj.__iter__())))
+    return data
+
+class MetricResults(object):
+    """
+        Exposes the results of a metric computed in a worker process to the
+        aggregators, which only rely on the header, the aggregation indices
+        and iteration over the result rows.
+    """
+    def __init__(self, metric, rows):
+        self._metric = metric
+        self._results = rows
+        self._agg_indices = metric._agg_indices
+
+    def header(self): return self._metric.header()
+
+    def __iter__(self): return (r for r in self._results)
 
 class TimeSeriesException(Exception):
     """ Basic exception class for UserMetric types """
@@ -7,10 +7,9 @@ from MySQLdb import ProgrammingError
 import collections
 import user_metric as um
 import os
-import src.etl.aggregator as agg
 import src.utils.multiprocessing_wrapper as mpw
-from query_calls import bytes_added_rev_query, bytes_added_rev_len_query, \
-                        bytes_added_rev_user_query
+from query_calls import bytes_added_rev_query, bytes_added_rev_user_query
+from src.utils.timestamp import IntervalBuckets
 
 from config import logging
 
@@ -47,8 +46,16 @@ class BytesAdded(um.UserMetric):
         execution of this implementation the call allows the caller to specify
         the number of threads as a keyword argument, `num_threads`, to the
         process() method.
+
+        process_intervals() computes the metric for each of a list of
+        consecutive intervals spanning the metric period from a single pass
+        over the revisions.
     """
 
+    # Workers may sum their rows for aggregate only requests
+    PARTIAL_AGGREGATES = True
+    LAZY_USERS = True
+
     # Structure that defines parameters for BytesAdded class
     _param_types = {
         'init' : {},
@@ -97,63 +104,90 @@ class BytesAdded(um.UserMetric):
                 user_handle = [user_handle]
             # build the argument lists for each thread
 
+        # Without users every editor of the period is processed.  The
+        # editors are streamed to the workers in chunks as they are read
         if not user_handle:
             sql = bytes_added_rev_user_query(self._start_ts_, self._end_ts_)
 
             if log_progress: logging.info(
                 __name__ + '::Getting all distinct users: " %s "' % sql)
-            user_handle = [str(row[0]) for row in
-                           self._data_source_.execute_SQL(sql)]
-            if log_progress: logging.info(
-                __name__ + '::Retrieved %s users.' % len(user_handle))
-
-        # get revisions
-        args = [log_progress, self._start_ts_,
-                self._end_ts_, self._project_, self._namespace_]
-        revs = mpw.build_thread_pool(user_handle,_get_revisions,k,args)
-
-        # Start worker threads and aggregate results for bytes added
-        args = [log_progress, log_frequency, self._project_]
-        self._results = agg.list_sum_by_group(
-            mpw.build_thread_pool(revs,_process_help,k,args),0)
-
-        # Add any missing users - O(n)
-        tallied_users = set([str(r[0]) for r in self._results])
-        for user in user_handle:
-            if not tallied_users.__contains__(str(user)):
-                # Add a row indicating no activity for that user
-                self._results.append([user,0,0,0,0,0])
+            user_handle = (str(row[0]) for row in
+                           self._data_source_.execute_SQL_stream(sql))
+
+        # Start worker threads - each worker fetches the revisions for its
+        # users, along with their parent lengths, and computes bytes added.
+        # Users without revisions get rows of zeros from their worker
+        args = [log_progress, log_frequency, self._start_ts_,
+                self._end_ts_, self._project_, self._namespace_, None]
+        self._results = self._run_pool(user_handle, _process_help, k, args,
+                                       kwargs,
+                                       cost=self._get_cost(user_handle, k))
         return self
 
-def _get_revisions(args):
-
-    MethodArgsClass = collections.namedtuple('MethodArg',
-        'log start end project namespace')
-    users = args[0]
-    state = args[1]
-    arg_obj = MethodArgsClass(state[0], state[1], state[2], state[3], state[4])
-    conn = um.dl.Connector(instance='slave')
+    def process_intervals(self, user_handle, intervals, **kwargs):
+        """
+            Computes the metric over each of `intervals`, consecutive equal
+            length (start, end) pairs that span the metric period, from a
+            single pass over the revisions of `user_handle` (a list of user
+            ids).  Returns a list of results, with rows as produced by
+            process(), for each interval.
+        """
 
-    if arg_obj.log: logging.info('Computing revisions, PID = %s' % os.getpid())
+        self.apply_default_kwargs(kwargs,'process')
 
-    rev_query = bytes_added_rev_query(arg_obj.start, arg_obj.end, users, arg_obj.namespace,
-                          arg_obj.project)
+        if not user_handle or not hasattr(user_handle, '__iter__'):
+            raise um.UserMetric.UserMetricError(
+                message=str(BytesAdded) + '::A list of users is required to '
+                                          'process intervals.')
+
+        args = [bool(kwargs['log_progress']), int(kwargs['log_frequency']),
+                self._start_ts_, self._end_ts_, self._project_,
+                self._namespace_, IntervalBuckets(intervals)]
+        rows = mpw.build_thread_pool(user_handle, _process_help,
+                                     kwargs['num_threads'], args,
+                                     cost=self._get_cost(user_handle,
+                                                         kwargs['num_threads']),
+                                     executor=self._get_executor(kwargs))
+
+        results = [list() for i in xrange(len(intervals))]
+        for row in rows: results[row[0]].append(row[1:])
+        return results
+
+# Definition of persistent state for BytesAdded workers
+BytesAddedArgsClass = collections.namedtuple('BytesAddedArgs',
+    'is_log freq start end project namespace buckets')
+
+def _get_revisions(users, thread_args):
+    """
+        Generator over the revisions of `users`.  Each row stores the user,
+        the revision length, the parent revision id, the parent revision
+        length (resolved in the same query by joining the parent revision)
+        and the revision timestamp.
+    """
+    rev_query = bytes_added_rev_query(thread_args.start, thread_args.end,
+                                      users, thread_args.namespace,
+                                      thread_args.project)
 
-    if arg_obj.log:
+    if thread_args.is_log:
         logging.info(__name__ +
                      '::Querying revisions for %(count)s users '
                      '(project = %(project)s, '
                      'namespace = %(namespace)s)... ' % {
                   'count' : len(users),
-                  'project' : arg_obj.project,
-                  'namespace' : arg_obj.namespace}
+                  'project' : thread_args.project,
+                  'namespace' : thread_args.namespace}
         )
+
+    conn = um.dl.get_connection(instance='slave')
     try:
-        return list(conn.execute_SQL(rev_query))
+        for row in conn.execute_SQL_stream(rev_query):
+            yield row
     except ProgrammingError:
        raise um.UserMetric.UserMetricError(
            message=str(BytesAdded) + '::Could not get revisions '
                                      'for specified users(s) - Query Failed.')
+    finally:
+        um.dl.release_connection(conn)
 
 def _process_help(args):
 
@@ -168,8 +202,7 @@ def _process_help(args):
         The flow of the request is as follows:
 
             #. Get all revisions for the specified users in the given
-                timeframe
-            #. For each parent revision get its length
+                timeframe along with the length of each parent revision
             #. Compute the difference in length between each revision and its
                 parent
             #. Record edit count, raw bytes added (with sign and absolute),
@@ -182,32 +215,36 @@ def _process_help(args):
             - Dictionary. key(string): user handle, value(Float): edit counts
     """
 
-    BytesAddedArgsClass = collections.namedtuple('BytesAddedArgs',
-        'is_log freq project')
-    revs = args[0]
+    users = args[0]
     state = args[1]
-    thread_args = BytesAddedArgsClass(state[0],state[1],state[2])
-
-    conn = um.dl.Connector(instance='slave')
+    thread_args = BytesAddedArgsClass(state[0],state[1],state[2],state[3],
+                                      state[4],state[5],state[6])
     bytes_added = dict()
 
     # Get the difference for each revision length from the parent
     # to compute bytes added
     row_count = 1
     missed_records = 0
-    total_rows = len(revs)
 
     if thread_args.is_log:
         logging.info(
             __name__ + '::Processing revision data '
-                       '(%s rows) by user... (PID = %s)' % (
-                total_rows, os.getpid()))
+                       '(%s users) by user... (PID = %s)' % (
+                len(users), os.getpid()))
 
-    for row in revs:
+    for row in _get_revisions(users, thread_args):
         try:
             user = str(row[0])
             rev_len_total = int(row[1])
             parent_rev_id = row[2]
+            parent_rev_len = row[3]
+
+            # When processing intervals tally by interval and user
+            if thread_args.buckets:
+                bucket = thread_args.buckets.bucket(row[4])
+                if bucket is None:
+                    continue
+                user = (bucket, user)
 
         except IndexError:
             missed_records += 1
@@ -216,24 +253,10 @@ def _process_help(args):
             missed_records += 1
             continue
 
-        # Produce the revision length of the parent.  In case of a new
-        # article, parent_rev_id = 0, no record in the db
+        # In case of a new article, parent_rev_id = 0, no record in the db.
+        # A missing parent record is left as None and the revision ignored
         if parent_rev_id == 0:
             parent_rev_len = 0
-        else:
-            sql = bytes_added_rev_len_query(parent_rev_id, thread_args.project)
-            try:
-                parent_rev_len = conn.execute_SQL(sql)[0][0]
-            except IndexError:
-                missed_records += 1
-                continue
-            except TypeError:
-                missed_records += 1
-                continue
-            except ProgrammingError:
-                raise um.UserMetric.UserMetricError(message=str(BytesAdded) +
-                        '::Could not produce rev diff for %s on rev_id %s.' % (
-                                user, str(parent_rev_id)))
 
         # Update the bytes added hash - ignore revision if either rev length
         # is undetermined
@@ -263,16 +286,29 @@ def _process_help(args):
         if thread_args.freq and row_count % thread_args.freq == 0 and \
            thread_args.is_log:
             logging.info(
-                __name__ + '::Processed %s of %s records. (PID = %s)' % (
-                    row_count, total_rows, os.getpid()))
+                __name__ + '::Processed %s records. (PID = %s)' % (
+                    row_count, os.getpid()))
 
         row_count += 1
 
-    results = [[user] + bytes_added[user] for user in bytes_added]
+    if thread_args.buckets:
+        results = [list(key) + bytes_added[key] for key in bytes_added]
+    else:
+        results = [[user] + bytes_added[user] for user in bytes_added]
+
+    # Add a row indicating no activity for the users of the chunk (in each
+    # interval) without revisions
+    for user in users:
+        if thread_args.buckets:
+            for bucket in xrange(len(thread_args.buckets)):
+                if not (bucket, str(user)) in bytes_added:
+                    results.append([bucket,user,0,0,0,0,0])
+        elif not str(user) in bytes_added:
+            results.append([user,0,0,0,0,0])
     if thread_args.is_log:
         logging.info(
             __name__ + '::Processed %s out of %s records. (PID = %s)' % (
-                total_rows - missed_records,total_rows, os.getpid()))
+                row_count - 1, row_count - 1 + missed_records, os.getpid()))
 
     return results
 
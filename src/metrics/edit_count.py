@@ -6,6 +6,7 @@ __license__ = "GPL (version 2 or later)"
 import user_metric as um
 from query_calls import escape_var
 from MySQLdb import ProgrammingError
+from src.utils.timestamp import IntervalBuckets
 
 class EditCount(um.UserMetric):
     """
@@ -83,17 +84,63 @@ class EditCount(um.UserMetric):
             'project' : self._project_}
         sql = " ".join(sql.strip().split())
 
+        # Get edit counts from query - all users not appearing have an edit count of 0
+        user_set = set([long(user_id) for user_id in user_handle])
         try:
-            self._data_source_._cur_.execute(sql)
+            for row in self._data_source_.execute_SQL_stream(sql):
+                edit_count.append([row[0], int(row[1])])
+                user_set.discard(row[0])
         except ProgrammingError:
             raise um.UserMetric.UserMetricError(message=str(self.__class__()) + 'Could not get edit counts - Query failed.')
-
-        # Get edit counts from query - all users not appearing have an edit count of 0
-        user_set = set([long(user_id) for user_id in user_handle])
-        for row in self._data_source_._cur_.fetchall():
-            edit_count.append([row[0], int(row[1])])
-            user_set.discard(row[0])
         for user in user_set: edit_count.append([user, 0])
 
         self._results = edit_count
         return self
+
+    def process_intervals(self, user_handle, intervals, **kwargs):
+        """
+            Determine edit counts over each of `intervals`, consecutive equal length (start, end) pairs spanning the metric period, from a
+            single pass over the revisions of the users in *user_handle*.  Returns a list of edit count results, as produced by
+            process(), for each interval.
+        """
+
+        self.apply_default_kwargs(kwargs,'process')
+
+        buckets = IntervalBuckets(intervals)
+        ts_condition  = 'and rev_timestamp >= "%s" and rev_timestamp < "%s"' % (self._start_ts_, self._end_ts_)
+
+        # Escape user_handle for SQL injection
+        user_handle = escape_var(user_handle)
+
+        if not hasattr(user_handle, '__iter__'): user_handle = [user_handle] # ensure the handles are iterable
+        user_set = um.dl.DataLoader().format_comma_separated_list(user_handle)
+        sql = """
+                select
+                    rev_user,
+                    rev_timestamp
+                from %(project)s.revision
+                where rev_user in (%(user_set)s) %(ts_condition)s
+                """ % {
+            'user_set' : user_set,
+            'ts_condition' : ts_condition,
+            'project' : self._project_}
+        sql = " ".join(sql.strip().split())
+
+        # Tally the revisions of each user by interval
+        counts = [dict() for i in xrange(len(intervals))]
+        try:
+            for row in self._data_source_.execute_SQL_stream(sql):
+                bucket = buckets.bucket(row[1])
+                if bucket is not None:
+                    counts[bucket][row[0]] = counts[bucket].get(row[0], 0) + 1
+        except ProgrammingError:
+            raise um.UserMetric.UserMetricError(message=str(self.__class__()) + 'Could not get edit counts - Query failed.')
+
+        # All users not appearing in an interval have an edit count of 0
+        users = set([long(user_id) for user_id in user_handle])
+        results = list()
+        for interval_counts in counts:
+            edit_count = [[user, interval_counts[user]] for user in interval_counts]
+            edit_count.extend([[user, 0] for user in users.difference(interval_counts)])
+            results.append(edit_count)
+        return results
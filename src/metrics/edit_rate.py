@@ -3,10 +3,11 @@ __author__ = "Ryan Faulkner"
 __date__ = "July 27th, 2012"
 __license__ = "GPL (version 2 or later)"
 
-from dateutil.parser import parse as date_parse
+from src.utils.timestamp import parse_timestamp as date_parse
 import user_metric as um
 import edit_count as ec
-from src.etl.aggregator import weighted_rate, decorator_builder
+from src.etl.aggregator import weighted_rate, decorator_builder, \
+    WeightedRatePartial
 
 class EditRate(um.UserMetric):
     """
@@ -95,15 +96,42 @@ class EditRate(um.UserMetric):
         self.apply_default_kwargs(kwargs,'process')
 
         # Extract edit count for given parameters
-        edit_rate = list()
         e = ec.EditCount(date_start = self._start_ts_,
             date_end = self._end_ts_,
             datasource = self._data_source_,
             namespace=self._namespace_).process(user_handle)
 
+        self._results = self._get_edit_rates(e.__iter__(), self._start_ts_,
+                                             self._end_ts_)
+        return self
+
+    def process_intervals(self, user_handle, intervals, **kwargs):
+        """
+            Determine the edit rate of users over each of `intervals`,
+            consecutive equal length (start, end) pairs spanning the metric
+            period, from a single pass over their revisions.  Returns a list
+            of edit rate results, as produced by process(), for each
+            interval.
+        """
+
+        self.apply_default_kwargs(kwargs,'process')
+
+        edit_counts = ec.EditCount(date_start = self._start_ts_,
+            date_end = self._end_ts_,
+            namespace=self._namespace_).process_intervals(user_handle,
+                                                          intervals)
+        return [self._get_edit_rates(edit_counts[i],
+                                     self._get_timestamp(intervals[i][0]),
+                                     self._get_timestamp(intervals[i][1]))
+                for i in xrange(len(intervals))]
+
+    def _get_edit_rates(self, edit_counts, start_ts, end_ts):
+        """ Build the edit rate rows from edit count rows over the period
+            [`start_ts`, `end_ts`) """
+        edit_rate = list()
         try:
-            start_ts_obj = date_parse(self._start_ts_)
-            end_ts_obj = date_parse(self._end_ts_)
+            start_ts_obj = date_parse(start_ts)
+            end_ts_obj = date_parse(end_ts)
         except AttributeError:
             raise um.UserMetric.UserMetricError()
         except ValueError:
@@ -121,14 +149,13 @@ class EditRate(um.UserMetric):
             time_diff = time_diff_sec
 
         # Build the list of edit rate metrics
-        for i in e.__iter__():
+        for i in edit_counts:
             new_i = i[:]  # Make a copy of the edit count element
             new_i.append(new_i[1] / (time_diff * self._time_unit_count_))
-            new_i.append(self._start_ts_)
+            new_i.append(start_ts)
             new_i.append(time_diff)
             edit_rate.append(new_i)
-        self._results = edit_rate
-        return self
+        return edit_rate
 
 
 # ==========================
@@ -144,3 +171,4 @@ setattr(edit_rate_agg, um.METRIC_AGG_METHOD_NAME, 'edit_rate_agg')
 setattr(edit_rate_agg, um.METRIC_AGG_METHOD_HEAD, ['total_users',
                                                    'total_weight','rate'])
 setattr(edit_rate_agg, um.METRIC_AGG_METHOD_KWARGS, {'val_idx' : 2})
+setattr(edit_rate_agg, um.METRIC_AGG_METHOD_PARTIAL, WeightedRatePartial)
@@ -6,12 +6,13 @@ __license__ = "GPL (version 2 or later)"
 
 import user_metric as um
 import src.utils.multiprocessing_wrapper as mpw
-from src.etl.data_loader import Connector
+from src.etl.data_loader import get_connection, release_connection
 from collections import namedtuple
 from config import logging
 from os import getpid
-from dateutil.parser import parse as date_parse
-from src.etl.aggregator import decorator_builder, boolean_rate
+from src.utils.timestamp import to_epoch
+from src.etl.aggregator import decorator_builder, boolean_rate, \
+    BooleanRatePartial
 from query_calls import live_account_query
 
 # Definition of persistent state for RevertRate objects
@@ -59,6 +60,11 @@ class LiveAccount(um.UserMetric):
             1   - The edit button was clicked `t` minutes within registration
     """
 
+    # Run the edit page tracking queries on threads
+    EXECUTOR = mpw.THREAD
+    PARTIAL_AGGREGATES = True
+    LAZY_USERS = True
+
     # Structure that defines parameters for RevertRate class
     _param_types = {
         'init' : {
@@ -105,7 +111,8 @@ class LiveAccount(um.UserMetric):
         # Multiprocessing vs. single processing execution
         args = [self._project_, self._namespace_, log, self._start_ts_,
                 self._end_ts_, self._t_]
-        self._results = mpw.build_thread_pool(user_handle,_process_help,k,args)
+        self._results = self._run_pool(user_handle, _process_help, k, args,
+                                       kwargs)
 
         return self
 
@@ -116,7 +123,7 @@ def _process_help(args):
     thread_args = LiveAccountArgsClass(state[0],state[1],state[2],state[3],
                                         state[4],state[5])
     user_data = args[0]
-    conn = Connector(instance='slave')
+    conn = get_connection(instance='slave')
 
     # Log progress
     if thread_args.log:
@@ -133,14 +140,12 @@ def _process_help(args):
     # edit button click)
     la_query = live_account_query(user_data, thread_args.namespace,
                                 thread_args.project)
-    conn._cur_.execute(la_query)
-
     # Iterate over results to determine boolean indicating whether
     # account is "live"
     results = { long(user) : -1 for user in user_data}
-    for row in conn._cur_:
+    for row in conn.execute_SQL_stream(la_query):
         try:
-            diff = (date_parse(row[2]) - date_parse(row[1])).total_seconds()
+            diff = float(to_epoch(row[2]) - to_epoch(row[1]))
             diff /= 60 # get the difference in minutes
         except Exception:
             continue
@@ -149,6 +154,7 @@ def _process_help(args):
             results[row[0]] = 1
         else:
             results[row[0]] = 0
+    release_connection(conn)
 
     return [(str(key), results[key]) for key in results]
 
@@ -177,6 +183,7 @@ setattr(live_accounts_agg, um.METRIC_AGG_METHOD_NAME, 'live_accounts_agg')
 setattr(live_accounts_agg, um.METRIC_AGG_METHOD_HEAD, ['total_users',
                                                         'is_live','rate'])
 setattr(live_accounts_agg, um.METRIC_AGG_METHOD_KWARGS, {'val_idx' : 1})
+setattr(live_accounts_agg, um.METRIC_AGG_METHOD_PARTIAL, BooleanRatePartial)
 
 if __name__ == "__main__":
     users = ['17792132', '17797320', '17792130', '17792131', '17792136',
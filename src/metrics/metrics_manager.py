@@ -10,7 +10,7 @@ __license__ = "GPL (version 2 or later)"
 
 import re
 from collections import OrderedDict
-from dateutil.parser import parse as date_parse
+from src.utils.timestamp import parse_timestamp as date_parse
 
 import user_metric as um
 import threshold as th
@@ -80,6 +80,10 @@ def process_data_request(metric_handle, users, **kwargs):
     # create shorthand method refs
     to_string = dl.DataLoader().cast_elems_to_string
 
+    # Optional method reporting the number of completed time series intervals
+    progress = kwargs['progress'] if 'progress' in kwargs else None
+    if 'progress' in kwargs: del kwargs['progress']
+
     aggregator = kwargs['aggregator'] if 'aggregator' in kwargs else None
     agg_key = get_agg_key(aggregator, metric_handle) if aggregator else None
 
@@ -124,14 +128,25 @@ def process_data_request(metric_handle, users, **kwargs):
                 'start' : str(start),
                 'end' : str(end),
             })
-            out = tspm.build_time_series(start, end,
-                interval, metric_class, aggregator_func, users,
-                num_threads=time_threads,
-                metric_threads='{"num_threads" : %(user_threads)s, '
-                               '"rev_threads" : %(rev_threads)s}' %
-                { 'user_threads' : USER_THREADS,
-                  'rev_threads': REVISION_THREADS},
-                log=True)
+            ts_kwargs = {
+                'num_threads' : time_threads,
+                'metric_threads' : '{"num_threads" : %(user_threads)s, '
+                                   '"rev_threads" : %(rev_threads)s}' %
+                                   { 'user_threads' : USER_THREADS,
+                                     'rev_threads': REVISION_THREADS},
+                'log' : True,
+                'progress' : progress,
+                'store' : True,
+            }
+
+            # sliding window length in hours
+            if 'window' in kwargs and kwargs['window']:
+                out = tspm.build_window_series(start, end, interval,
+                    int(kwargs['window']), metric_class, aggregator_func,
+                    users, **ts_kwargs)
+            else:
+                out = tspm.build_time_series(start, end, interval,
+                    metric_class, aggregator_func, users, **ts_kwargs)
 
             count = 1
             for row in out:
@@ -149,9 +164,10 @@ def process_data_request(metric_handle, users, **kwargs):
                 'end' : str(end),
                 })
 
-            metric_obj.process(users, num_threads=USER_THREADS,
-                rev_threads=REVISION_THREADS, **kwargs)
-            r = um.aggregator(aggregator_func, metric_obj, metric_obj.header())
+            # Workers return partial aggregates where the metric allows
+            r = metric_obj.process_aggregate(users, aggregator_func,
+                num_threads=USER_THREADS, rev_threads=REVISION_THREADS,
+                **kwargs)
             results['metric'][r.data[0]] = " ".join(to_string(r.data[1:]))
             results['header'] = " ".join(to_string(r.header))
     else:
@@ -162,8 +178,10 @@ def process_data_request(metric_handle, users, **kwargs):
             'start' : str(start),
             'end' : str(end),
             })
+        # The rows are streamed from the workers into the response
         metric_obj.process(users, num_threads=USER_THREADS,
-            rev_threads=REVISION_THREADS, log_progress=True, **kwargs)
+            rev_threads=REVISION_THREADS, log_progress=True, stream=True,
+            **kwargs)
         for m in metric_obj.__iter__():
             results['metric'][m[0]] = " ".join(to_string(m[1:]))
 
@@ -6,14 +6,16 @@ __license__ = "GPL (version 2 or later)"
 
 import user_metric as um
 import src.utils.multiprocessing_wrapper as mpw
-from src.etl.data_loader import Connector, DataLoader
+from src.etl.data_loader import DataLoader, get_connection, \
+    release_connection
 from collections import namedtuple, OrderedDict
-from src.etl.aggregator import decorator_builder
+from src.etl.aggregator import decorator_builder, PartialAggregate
+from src.utils.timestamp import IntervalBuckets
 from config import logging
 from os import getpid
 
 # Definition of persistent state for RevertRate objects
-NamespaceEditsArgsClass = namedtuple('NamespaceEditsArgs', 'project log date_start date_end')
+NamespaceEditsArgsClass = namedtuple('NamespaceEditsArgs', 'project log date_start date_end buckets')
 
 class NamespaceEdits(um.UserMetric):
     """
@@ -45,6 +47,11 @@ class NamespaceEdits(um.UserMetric):
 
     VALID_NAMESPACES = [-1,-2] + range(16) + [100, 101, 108, 109] # namespaces or which counts are gathered
 
+    # I/O bound - workers run on threads
+    EXECUTOR = mpw.THREAD
+    PARTIAL_AGGREGATES = True
+    LAZY_USERS = True
+
     # Structure that defines parameters for RevertRate class
     _param_types = {
         'init' : {},
@@ -58,9 +65,10 @@ class NamespaceEdits(um.UserMetric):
     _data_model_meta = {
         'id_fields' : [0],
         'date_fields' : [],
-        'float_fields' : [1],
-        'integer_fields' : [2],
+        'float_fields' : [],
+        'integer_fields' : [],
         'boolean_fields' : [],
+        'dict_fields' : [1],
         }
 
     _agg_indices = {
@@ -86,17 +94,38 @@ class NamespaceEdits(um.UserMetric):
         if log: logging.info(__name__ + "::parameters = " + str(kwargs))
 
         # Multiprocessing vs. single processing execution
-        args = [self._project_, log, self._start_ts_, self._end_ts_]
-        self._results = mpw.build_thread_pool(user_handle,_process_help,k,args)
+        args = [self._project_, log, self._start_ts_, self._end_ts_, None]
+        self._results = self._run_pool(user_handle, _process_help, k, args,
+                                       kwargs)
 
         return self
 
+    def process_intervals(self, user_handle, intervals, **kwargs):
+        """
+            Computes namespace edit counts over each of `intervals`, consecutive equal length (start, end) pairs spanning the
+            metric period, from a single pass over the revisions of the users in `user_handle`.  Returns a list of results, as
+            produced by process(), for each interval.
+        """
+
+        self.apply_default_kwargs(kwargs,'process')
+
+        if not hasattr(user_handle, '__iter__'): user_handle = [user_handle] # ensure the handles are iterable
+        k = int(kwargs['num_threads'])
+        log = bool(kwargs['log'])
+
+        args = [self._project_, log, self._start_ts_, self._end_ts_, IntervalBuckets(intervals)]
+        results = [list() for i in xrange(len(intervals))]
+        for bucket, user, counts in mpw.build_thread_pool(user_handle,_process_help,k,args,
+                executor=self._get_executor(kwargs)):
+            results[bucket].append((user, counts))
+        return results
+
 def _process_help(args):
 
     state = args[1]
-    thread_args = NamespaceEditsArgsClass(state[0],state[1],state[2],state[3])
+    thread_args = NamespaceEditsArgsClass(state[0],state[1],state[2],state[3],state[4])
     user_data = args[0]
-    conn = Connector(instance='slave')
+    conn = get_connection(instance='slave')
 
     to_string = DataLoader().cast_elems_to_string
     to_csv_str = DataLoader().format_comma_separated_list
@@ -111,32 +140,46 @@ def _process_help(args):
         logging.info(__name__ + '::Computing namespace edits. (PID = %s)' % getpid())
         logging.info(__name__ + '::From %s to %s. (PID = %s)' % (
             str(thread_args.date_start), str(thread_args.date_end), getpid()))
+    # When processing intervals counts are also grouped by hour of the revision timestamp (or by timestamp where the
+    # intervals do not start on the hour) so that each group falls in a single interval
+    ts_group = ''
+    if thread_args.buckets:
+        if thread_args.buckets.start % 3600:
+            ts_group = ', r.rev_timestamp'
+        else:
+            ts_group = ', LEFT(r.rev_timestamp, 10)'
+
     sql = """
             SELECT
                 r.rev_user,
                 p.page_namespace,
-                count(*) AS revs
+                count(*) AS revs %(ts_group)s
             FROM %(project)s.revision AS r JOIN %(project)s.page AS p
                 ON r.rev_page = p.page_id
             WHERE %(user_cond)s AND %(ts_cond)s
-            GROUP BY 1,2
+            GROUP BY 1,2 %(ts_group)s
         """ % {
         "user_cond" : user_cond,
         "ts_cond" : ts_cond,
+        "ts_group" : ts_group,
         "project" : thread_args.project,
     }
-    conn._cur_.execute(" ".join(sql.split('\n')))
-
-    # Tally counts of namespace edits
-    results = dict()
-
-    for user in user_data:
-        results[str(user)] = OrderedDict()
-        for ns in NamespaceEdits.VALID_NAMESPACES: results[str(user)][str(ns)] = 0
-    for row in conn._cur_:
+    # Tally counts of namespace edits - by interval when processing intervals
+    num_buckets = len(thread_args.buckets) if thread_args.buckets else 1
+    results = [dict() for i in xrange(num_buckets)]
+
+    for bucket_results in results:
+        for user in user_data:
+            bucket_results[str(user)] = OrderedDict()
+            for ns in NamespaceEdits.VALID_NAMESPACES: bucket_results[str(user)][str(ns)] = 0
+    for row in conn.execute_SQL_stream(" ".join(sql.split('\n'))):
         try:
+            bucket = 0
+            if thread_args.buckets:
+                bucket = thread_args.buckets.bucket(str(row[3]).ljust(14, '0'))
+                if bucket is None: continue
             if row[1] in NamespaceEdits.VALID_NAMESPACES:
-                results[str(row[0])][str(row[1])] = int(row[2])
+                results[bucket][str(row[0])][str(row[1])] += int(row[2])
         except KeyError:
             logging.error(__name__ + "::Could not process row: %s" % str(row))
             pass
@@ -144,8 +187,10 @@ def _process_help(args):
             logging.error(__name__ + "::Could not process row: %s" % str(row))
             pass
 
-    del conn
-    return [(user, results[user]) for user in results]
+    release_connection(conn)
+    if thread_args.buckets:
+        return [(bucket, user, results[bucket][user]) for bucket in xrange(num_buckets) for user in results[bucket]]
+    return [(user, results[0][user]) for user in results[0]]
 
 @decorator_builder(NamespaceEdits.header())
 def namespace_edits_sum(metric):
@@ -165,6 +210,32 @@ setattr(namespace_edits_sum, um.METRIC_AGG_METHOD_NAME, 'namespace_edits_aggrega
 setattr(namespace_edits_sum, um.METRIC_AGG_METHOD_HEAD, ['type', 'total_revs',
                                                        'weighted_rate','total_editors','reverted_editors'])
 
+class NamespaceEditsPartial(PartialAggregate):
+    """ Partial aggregate of namespace_edits_sum, edit counts by namespace """
+    INVERTIBLE = True
+
+    def partial(self, rows):
+        counts = OrderedDict()
+        for ns in NamespaceEdits.VALID_NAMESPACES:
+            counts[str(ns)] = 0
+        for r in rows:
+            try:
+                for ns in NamespaceEdits.VALID_NAMESPACES:
+                    counts[str(ns)] += r[1][str(ns)]
+            except IndexError: continue
+            except TypeError: continue
+        return counts
+
+    def merge(self, x, y):
+        return OrderedDict((ns, x[ns] + y[ns]) for ns in x)
+
+    def unmerge(self, x, y):
+        return OrderedDict((ns, x[ns] - y[ns]) for ns in x)
+
+    def result(self, state): return ["namespace_edits_sum", state]
+
+setattr(namespace_edits_sum, um.METRIC_AGG_METHOD_PARTIAL, NamespaceEditsPartial)
+
 if __name__ == "__main__":
     users = ['17792132', '17797320', '17792130', '17792131', '17792136', 13234584, 156171]
 
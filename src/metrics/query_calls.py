@@ -44,7 +44,7 @@ def format_namespace(namespace):
 
     if hasattr(namespace, '__iter__'):
         if len(namespace) == 1:
-            ns_cond = 'page_namespace = ' + str(namespace.pop())
+            ns_cond = 'page_namespace = ' + str(list(namespace)[0])
         else:
             ns_cond = 'page_namespace in (' + \
                       ",".join(DataLoader().
@@ -96,6 +96,70 @@ def threshold_rev_query(uid, is_survival, namespace, project,
                 'uid' : uid}
     return " ".join(sql.strip().split('\n'))
 
+def format_user_ts_table(user_thresholds):
+    """ Builds a derived table of (user, threshold timestamp) pairs from a
+        list of tuples.  The table has columns `uid` and `ts`. """
+    return " UNION ALL ".join(
+        ['SELECT %s AS uid, "%s" AS ts' % (long(uid), escape_var(ts))
+         for uid, ts in user_thresholds])
+
+def threshold_rev_batch_query(user_thresholds, is_survival, namespace,
+                              project, restrict, start_time, end_time):
+    """
+        Count revisions before (after) the threshold timestamp of many users
+        in a single grouped query.  `user_thresholds` is a list of
+        (user id, threshold timestamp) tuples.
+    """
+
+    user_ts_table = format_user_ts_table(user_thresholds)
+
+    # See `threshold_rev_query` for the survival / threshold conditions
+    if is_survival:
+        timestamp_cond = 'r.rev_timestamp > u.ts'
+    else:
+        timestamp_cond = 'r.rev_timestamp <= u.ts'
+
+    if restrict:
+        timestamp_cond += ' and r.rev_timestamp > "{0}" and '\
+                          'r.rev_timestamp <= "{1}"'.format(start_time,
+                                                          end_time)
+
+    # format the namespace condition
+    ns_cond = format_namespace(deepcopy(namespace))
+    if ns_cond: ns_cond = 'AND p.' + ns_cond
+
+    sql = query_store[threshold_rev_batch_query.__name__] % {
+        'project' : project,
+        'user_ts_table' : user_ts_table,
+        'ts_cond' : timestamp_cond,
+        'ns' : ns_cond,
+    }
+    return " ".join(sql.strip().split())
+
+def threshold_sweep_rev_query(user_thresholds, namespace, project,
+                              restrict, start_time, end_time):
+    """
+        Get the timestamp and namespace of all revisions made by users up
+        to their threshold timestamp.  `user_thresholds` is a list of
+        (user id, threshold timestamp) tuples.
+    """
+    timestamp_cond = 'r.rev_timestamp <= u.ts'
+    if restrict:
+        timestamp_cond += ' and r.rev_timestamp > "{0}" and '\
+                          'r.rev_timestamp <= "{1}"'.format(start_time,
+                                                          end_time)
+
+    ns_cond = format_namespace(deepcopy(namespace))
+    if ns_cond: ns_cond = 'AND p.' + ns_cond
+
+    sql = query_store[threshold_sweep_rev_query.__name__] % {
+        'project' : project,
+        'user_ts_table' : format_user_ts_table(user_thresholds),
+        'ts_cond' : timestamp_cond,
+        'ns' : ns_cond,
+    }
+    return " ".join(sql.strip().split())
+
 def live_account_query(users, namespace, project):
     """ Format query for live_account metric """
 
@@ -122,9 +186,10 @@ def live_account_query(users, namespace, project):
     return " ".join(sql.split('\n'))
 
 def bytes_added_rev_query(start, end, users, namespace, project):
-    """ Get revision length, user, and page """
-    ts_condition  = 'rev_timestamp >= "%s" and rev_timestamp < "%s"' % \
-                                                                (start, end)
+    """ Get revision length, user, parent revision, parent length and
+        timestamp """
+    ts_condition  = 'revision.rev_timestamp >= "%s" and ' \
+                    'revision.rev_timestamp < "%s"' % (start, end)
 
     # build the user set for inclusion into the query - if the user_handle is
     # empty or None get all users for timeframe
@@ -136,7 +201,8 @@ def bytes_added_rev_query(start, end, users, namespace, project):
 
     user_set = DataLoader().format_comma_separated_list(users,
         include_quotes=False)
-    where_clause = 'rev_user in (%(user_set)s) and %(ts_condition)s' % {
+    where_clause = 'revision.rev_user in (%(user_set)s) and ' \
+                   '%(ts_condition)s' % {
         'user_set' : user_set, 'ts_condition' : ts_condition}
 
     # format the namespace condition
@@ -149,13 +215,6 @@ def bytes_added_rev_query(start, end, users, namespace, project):
         'namespace' : ns_cond}
     return " ".join(sql.split('\n'))
 
-def bytes_added_rev_len_query(rev_id, project):
-    """ Get parent revision length """
-    return query_store[bytes_added_rev_len_query.__name__] % {
-        'project' : project,
-        'parent_rev_id' : rev_id,
-    }
-
 def bytes_added_rev_user_query(start, end):
     """ Produce all users that made a revision within period """
     return query_store[bytes_added_rev_user_query.__name__] % {
@@ -163,6 +222,47 @@ def bytes_added_rev_user_query(start, end):
         'end': end,
     }
 
+def time_to_threshold_revs_query(users, head, tail, project):
+    """
+        Get the first `head` and last `tail` revisions (user, rev_id and
+        timestamp) of each user in a single statement.  Either bound may be
+        zero in which case those revisions are not fetched.
+    """
+    sub_queries = list()
+    for user in escape_var(users):
+        params = {
+            'project' : project,
+            'user' : user,
+            'head' : head,
+            'tail' : tail,
+        }
+        if head:
+            sub_queries.append(
+                query_store[time_to_threshold_revs_query.__name__]['head'] %
+                params)
+        if tail:
+            sub_queries.append(
+                query_store[time_to_threshold_revs_query.__name__]['tail'] %
+                params)
+    sql = " UNION ALL ".join(sub_queries)
+    return " ".join(sql.strip().split())
+
+def user_rev_count_query(users, start, end, project):
+    """ Count the revisions of each of `users` within a period, used to
+        estimate the cost of users for worker pools """
+    users = escape_var(users)
+    if not hasattr(users, '__iter__'): users = [users]
+
+    user_set = DataLoader().format_comma_separated_list(users,
+                                                        include_quotes=False)
+    sql = query_store[user_rev_count_query.__name__] % {
+        'project' : project,
+        'user_set' : user_set,
+        'start_ts' : start,
+        'end_ts' : end
+    }
+    return " ".join(sql.strip().split())
+
 def revert_rate_past_revs_query(rev_id, page_id, n, project):
     return query_store[revert_rate_past_revs_query.__name__] % {
         'rev_id':  rev_id,
@@ -186,6 +286,44 @@ def revert_rate_user_revs_query(project, user, start, end):
         'end_ts' : end
     }
 
+def revert_rate_user_revs_batch_query(project, users, start, end):
+    """ Get the revisions of a set of users for RevertRate """
+    users = escape_var(users)
+    if not hasattr(users, '__iter__'): users = [users]
+
+    user_set = DataLoader().format_comma_separated_list(users,
+                                                        include_quotes=False)
+    sql = query_store[revert_rate_user_revs_batch_query.__name__] % {
+        'project' : project,
+        'user_set' : user_set,
+        'start_ts' : start,
+        'end_ts' : end
+    }
+    return " ".join(sql.strip().split('\n'))
+
+def revert_rate_page_revs_query(user_revs, look_back, look_ahead, project):
+    """
+        Get the revision windows surrounding many user revisions.
+        `user_revs` is a list of (page_id, rev_id) tuples.  For each
+        revision the query returns the `look_back` revisions of its page
+        preceding it and the `look_ahead` revisions following it.  Each row
+        is prefixed with the id of the user revision it surrounds.
+    """
+    sub_queries = list()
+    for page_id, rev_id in user_revs:
+        params = {
+            'project' : project,
+            'page_id' : page_id,
+            'rev_id' : rev_id,
+            'look_back' : look_back,
+            'look_ahead' : look_ahead,
+        }
+        sub_queries.extend(
+            [query_store[revert_rate_page_revs_query.__name__][key] % params
+             for key in ['past', 'future']])
+    sql = " UNION ALL ".join(sub_queries)
+    return " ".join(sql.strip().split())
+
 query_store = {
     threshold_reg_query.__name__:
                             """
@@ -207,6 +345,30 @@ query_store = {
                                         ON  r.rev_page = p.page_id
                                 WHERE %(ns)s AND rev_user = %(uid)s
                             """,
+    threshold_rev_batch_query.__name__:
+                            """
+                                SELECT
+                                    u.uid,
+                                    count(r.rev_id) as revs
+                                FROM (%(user_ts_table)s) AS u
+                                    LEFT JOIN (%(project)s.revision AS r
+                                        JOIN %(project)s.page AS p
+                                        ON r.rev_page = p.page_id %(ns)s)
+                                    ON r.rev_user = u.uid AND %(ts_cond)s
+                                GROUP BY u.uid
+                            """,
+    threshold_sweep_rev_query.__name__:
+                            """
+                                SELECT
+                                    r.rev_user,
+                                    r.rev_timestamp,
+                                    p.page_namespace
+                                FROM (%(user_ts_table)s) AS u
+                                    JOIN %(project)s.revision AS r
+                                        ON r.rev_user = u.uid AND %(ts_cond)s
+                                    JOIN %(project)s.page AS p
+                                        ON r.rev_page = p.page_id %(ns)s
+                            """,
     live_account_query.__name__:
                             """
                                 SELECT
@@ -220,20 +382,18 @@ query_store = {
     bytes_added_rev_query.__name__:
                             """
                                 select
-                                    rev_user,
-                                    rev_len,
-                                    rev_parent_id
+                                    revision.rev_user,
+                                    revision.rev_len,
+                                    revision.rev_parent_id,
+                                    parent.rev_len,
+                                    revision.rev_timestamp
                                 from %(project)s.revision
                                     join %(project)s.page
                                     on page.page_id = revision.rev_page
+                                    left join %(project)s.revision as parent
+                                    on parent.rev_id = revision.rev_parent_id
                                 where %(namespace)s %(where_clause)s
                             """,
-    bytes_added_rev_len_query.__name__:
-                            """
-                                SELECT rev_len
-                                FROM %(project)s.revision
-                                WHERE rev_id = %(parent_rev_id)s
-                            """,
     bytes_added_rev_user_query.__name__:
                             """
                                 SELECT distinct rev_user
@@ -241,6 +401,31 @@ query_store = {
                                 WHERE rev_timestamp >= "%(start)s" AND
                                     rev_timestamp < "%(end)s"
                             """,
+    user_rev_count_query.__name__:
+                        """
+                            SELECT rev_user, COUNT(*)
+                            FROM %(project)s.revision
+                            WHERE rev_user in (%(user_set)s) AND
+                                rev_timestamp >= "%(start_ts)s" AND
+                                rev_timestamp < "%(end_ts)s"
+                            GROUP BY rev_user
+                        """,
+    time_to_threshold_revs_query.__name__: {
+        'head' :        """
+                            (SELECT rev_user, rev_id, rev_timestamp
+                            FROM %(project)s.revision
+                            WHERE rev_user = "%(user)s"
+                            ORDER BY rev_timestamp ASC, rev_id ASC
+                            LIMIT %(head)s)
+                        """,
+        'tail' :        """
+                            (SELECT rev_user, rev_id, rev_timestamp
+                            FROM %(project)s.revision
+                            WHERE rev_user = "%(user)s"
+                            ORDER BY rev_timestamp DESC, rev_id DESC
+                            LIMIT %(tail)s)
+                        """,
+    },
     revert_rate_past_revs_query.__name__:
                         """
                             SELECT rev_id, rev_user_text, rev_sha1
@@ -271,6 +456,40 @@ query_store = {
                            rev_timestamp > "%(start_ts)s" AND
                            rev_timestamp <= "%(end_ts)s"
                         """,
+    revert_rate_user_revs_batch_query.__name__:
+                        """
+                           SELECT
+                               rev_user,
+                               rev_id,
+                               rev_page,
+                               rev_sha1,
+                               rev_user_text,
+                               rev_timestamp
+                           FROM %(project)s.revision
+                           WHERE rev_user in (%(user_set)s) AND
+                           rev_timestamp > "%(start_ts)s" AND
+                           rev_timestamp <= "%(end_ts)s"
+                        """,
+    revert_rate_page_revs_query.__name__: {
+        'past' :        """
+                            (SELECT %(rev_id)s, rev_id, rev_user_text,
+                                rev_sha1
+                            FROM %(project)s.revision
+                            WHERE rev_page = %(page_id)s
+                                AND rev_id < %(rev_id)s
+                            ORDER BY rev_id DESC
+                            LIMIT %(look_back)s)
+                        """,
+        'future' :      """
+                            (SELECT %(rev_id)s, rev_id, rev_user_text,
+                                rev_sha1
+                            FROM %(project)s.revision
+                            WHERE rev_page = %(page_id)s
+                                AND rev_id > %(rev_id)s
+                            ORDER BY rev_id ASC
+                            LIMIT %(look_ahead)s)
+                        """,
+    },
 }
 
 
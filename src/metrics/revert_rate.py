@@ -9,17 +9,25 @@ import src.etl.data_loader as dl
 import collections
 import os
 import src.utils.multiprocessing_wrapper as mpw
-from src.etl.aggregator import decorator_builder, weighted_rate
+from src.utils.timestamp import IntervalBuckets
+from src.etl.aggregator import decorator_builder, weighted_rate, \
+    WeightedRatePartial
 from query_calls import revert_rate_future_revs_query, \
                         revert_rate_past_revs_query, \
-                        revert_rate_user_revs_query
+                        revert_rate_user_revs_query, \
+                        revert_rate_user_revs_batch_query, \
+                        revert_rate_page_revs_query
 from config import logging
 
+# Number of revisions whose page windows are fetched per query when
+# reverts are computed in batch mode
+REV_BATCH_SIZE = 100
+
 # Definition of persistent state for RevertRate objects
 RevertRateArgsClass = collections.namedtuple('RevertRateArgs',
                                              'project log_progress '
                                              'look_ahead look_back date_start '
-                                             'date_end rev_threads')
+                                             'date_end rev_threads buckets')
 class RevertRate(um.UserMetric):
     """
         Skeleton class for "RevertRate" metric:
@@ -52,11 +60,25 @@ class RevertRate(um.UserMetric):
         in the past and in the future for a given article we are willing to
         look for a revert.  The identification of reverts is done by matching
         sha1 checksum values over revision history.
+
+        Setting `batch` in the call to process() computes reverts with a
+        handful of set-based queries per worker rather than two queries per
+        revision.  The page windows of many revisions are fetched at once and
+        sha1 reverts are then detected in memory.
+
+        process_intervals() computes the metric for each of a list of
+        consecutive intervals spanning the metric period with the batch
+        method, the revisions of each user being fetched once.
     """
 
     REV_SHA1_IDX = 2
     REV_USER_TEXT_IDX = 1
 
+    # Revert detection is dominated by page history queries
+    EXECUTOR = mpw.THREAD
+    PARTIAL_AGGREGATES = True
+    LAZY_USERS = True
+
     # Structure that defines parameters for RevertRate class
     _param_types = {
         'init' : {
@@ -71,6 +93,8 @@ class RevertRate(um.UserMetric):
                                     'processes over users.',1],
             'rev_threads' : ['int', 'Number of worker '
                                     'processes over revisions.',1],
+            'batch' : ['bool', 'Compute reverts over page histories with '
+                               'set-based queries.',False],
         }
     }
 
@@ -109,12 +133,42 @@ class RevertRate(um.UserMetric):
         log_progress = bool(kwargs['log_progress'])
 
         args = [self._project_, log_progress, self.look_ahead,
-                self.look_back, self._start_ts_, self._end_ts_, k_r]
-        self._results = mpw.build_thread_pool(user_handle, _process_help,
-                                              k, args)
+                self.look_back, self._start_ts_, self._end_ts_, k_r, None]
+        callback = _process_help_batched if bool(kwargs['batch']) else \
+            _process_help
+
+        # Users with many revisions are spread over the workers
+        self._results = self._run_pool(user_handle, callback, k, args, kwargs,
+                                       cost=self._get_cost(user_handle, k))
 
         return self
 
+    def process_intervals(self, user_handle, intervals, **kwargs):
+        """
+            Computes revert rates over each of `intervals`, consecutive
+            equal length (start, end) pairs spanning the metric period.  As
+            with process() revisions are counted in an interval when they
+            are later than its start and no later than its end.  Returns a
+            list of results, as produced by process(), for each interval.
+        """
+
+        self.apply_default_kwargs(kwargs,'process')
+
+        if not hasattr(user_handle, '__iter__'): user_handle = [user_handle]
+        k = int(kwargs['num_threads'])
+
+        args = [self._project_, bool(kwargs['log_progress']),
+                self.look_ahead, self.look_back, self._start_ts_,
+                self._end_ts_, int(kwargs['rev_threads']),
+                IntervalBuckets(intervals, right_closed=True)]
+        results = [list() for i in xrange(len(intervals))]
+        for row in mpw.build_thread_pool(user_handle, _process_help_batched,
+                                         k, args,
+                                         cost=self._get_cost(user_handle, k),
+                                         executor=self._get_executor(kwargs)):
+            results[row[0]].append(row[1:])
+        return results
+
 def __revert(rev_id, page_id, sha1, user_text, metric_args):
     """ Returns the revision corresponding to a revision if it exists. """
     history = {}
@@ -133,23 +187,29 @@ def __revert(rev_id, page_id, sha1, user_text, metric_args):
 
 def __history(rev_id, page_id, n, project='enwiki'):
     """ Produce the n revisions on a page before a given revision """
-    conn = dl.Connector(instance='slave')
-    conn._cur_.execute(
-        revert_rate_past_revs_query(rev_id, page_id, n, project)
-    )
+    conn = dl.get_connection(instance='slave')
+    try:
+        conn._cur_.execute(
+            revert_rate_past_revs_query(rev_id, page_id, n, project)
+        )
 
-    for row in conn._cur_:
-        yield row
+        for row in conn._cur_:
+            yield row
+    finally:
+        dl.release_connection(conn)
 
 def __future(rev_id, page_id, n, project='enwiki'):
     """ Produce the n revisions on a page after a given revision """
-    conn = dl.Connector(instance='slave')
-    conn._cur_.execute(
-        revert_rate_future_revs_query(rev_id, page_id, n, project)
-    )
+    conn = dl.get_connection(instance='slave')
+    try:
+        conn._cur_.execute(
+            revert_rate_future_revs_query(rev_id, page_id, n, project)
+        )
 
-    for row in conn._cur_:
-        yield row
+        for row in conn._cur_:
+            yield row
+    finally:
+        dl.release_connection(conn)
 
 def _process_help(args):
     """ Used by Threshold::process() for forking.
@@ -157,7 +217,8 @@ def _process_help(args):
 
     state = args[1]
     thread_args = RevertRateArgsClass(state[0],state[1],state[2],
-                                      state[3],state[4],state[5],state[6])
+                                      state[3],state[4],state[5],state[6],
+                                      state[7])
     user_data = args[0]
 
     if thread_args.log_progress:
@@ -166,19 +227,19 @@ def _process_help(args):
                     % (len(user_data), str(os.getpid())))
     results_agg = list()
     for user in user_data:
-        conn = dl.Connector(instance='slave')
-        conn._cur_.execute(
-            revert_rate_user_revs_query(thread_args.project, user,
-                thread_args.date_start,
-                thread_args.date_end)
-        )
+        # The connection is released before the revisions are fanned out,
+        # the revision workers borrow connections from the same pool
+        with dl.connection(instance='slave') as conn:
+            conn._cur_.execute(
+                revert_rate_user_revs_query(thread_args.project, user,
+                    thread_args.date_start,
+                    thread_args.date_end)
+            )
+            revisions = [rev for rev in conn._cur_]
 
         total_revisions = 0.0
         total_reverts = 0.0
 
-        revisions = [rev for rev in conn._cur_]
-        del conn
-
         results_thread = mpw.build_thread_pool(revisions, _revision_proc,
                                                thread_args.rev_threads, state)
 
@@ -202,7 +263,7 @@ def _revision_proc(args):
 
     state = args[1]
     thread_args = RevertRateArgsClass(state[0],state[1],state[2],state[3],
-                                      state[4],state[5],state[6])
+                                      state[4],state[5],state[6],state[7])
     rev_data = args[0]
 
     revision_count = 0.0
@@ -213,6 +274,105 @@ def _revision_proc(args):
         revision_count += 1.0
     return [(revision_count, revert_count)]
 
+def _process_help_batched(args):
+    """ Used by RevertRate::process() for forking in batch mode.  Computes
+        the same rows as `_process_help` from set-based queries over the
+        page histories of all revisions of the users.
+        Should not be called externally. """
+
+    state = args[1]
+    thread_args = RevertRateArgsClass(state[0],state[1],state[2],
+                                      state[3],state[4],state[5],state[6],
+                                      state[7])
+    user_data = args[0]
+
+    if thread_args.log_progress:
+        logging.info(__name__ +
+                    '::Computing reverts (batch) on %s users in thread %s.'
+                    % (len(user_data), str(os.getpid())))
+
+    conn = dl.get_connection(instance='slave')
+
+    # Gather all user revisions: rev_user, rev_id, rev_page, rev_sha1,
+    # rev_user_text, rev_timestamp
+    conn._cur_.execute(
+        revert_rate_user_revs_batch_query(thread_args.project, user_data,
+                                          thread_args.date_start,
+                                          thread_args.date_end)
+    )
+    user_revs = [rev for rev in conn._cur_]
+
+    # Fetch the page history surrounding many revisions per query.  Each
+    # window holds at most look_back (look_ahead) revisions
+    past_revs = collections.defaultdict(list)
+    future_revs = collections.defaultdict(list)
+    windows = [(rev[2], rev[1]) for rev in user_revs]
+    for i in xrange(0, len(windows), REV_BATCH_SIZE):
+        for row in conn.execute_SQL_stream(
+            revert_rate_page_revs_query(windows[i:i + REV_BATCH_SIZE],
+                                        thread_args.look_back,
+                                        thread_args.look_ahead,
+                                        thread_args.project)):
+            if row[1] < row[0]:
+                past_revs[row[0]].append(row[1:])
+            else:
+                future_revs[row[0]].append(row[1:])
+    dl.release_connection(conn)
+
+    # The order of the union is not defined
+    for revs in future_revs.itervalues():
+        revs.sort(key=lambda rev: rev[0])
+
+    # Tally reverts in memory - by interval and user when processing
+    # intervals
+    totals = dict()
+    for rev in user_revs:
+        user = str(rev[0])
+        if thread_args.buckets:
+            bucket = thread_args.buckets.bucket(rev[5])
+            if bucket is None: continue
+            user = (bucket, user)
+        if not user in totals: totals[user] = [0.0, 0.0]
+        totals[user][0] += 1.0
+
+        if _is_reverted(rev[3], rev[4], past_revs[rev[1]],
+                        future_revs[rev[1]]):
+            totals[user][1] += 1.0
+
+    results_agg = list()
+    if thread_args.buckets:
+        keys = [((bucket, str(user)), [bucket, user])
+                for bucket in xrange(len(thread_args.buckets))
+                for user in user_data]
+    else:
+        keys = [(str(user), [user]) for user in user_data]
+    for key, row in keys:
+        total_revisions, total_reverts = totals.get(key, [0.0, 0.0])
+        if not total_revisions:
+            results_agg.append(row + [0.0, total_revisions])
+        else:
+            results_agg.append(row + [total_reverts / total_revisions,
+                                      total_revisions])
+
+    if thread_args.log_progress: logging.info(__name__ +
+                                              '::PID %s complete.' %
+                                              (str(os.getpid())))
+    return results_agg
+
+def _is_reverted(sha1, user_text, past_revs, future_revs):
+    """ Determines whether a revision is reverted given the revisions
+        preceding and following it on its page. The revision rows
+        are structured as those returned by `__history` and `__future`. """
+    history = dict()
+    for rev in past_revs:
+        history[rev[RevertRate.REV_SHA1_IDX]] = rev
+
+    for rev in future_revs:
+        if rev[RevertRate.REV_SHA1_IDX] in history and \
+           rev[RevertRate.REV_SHA1_IDX] != sha1:
+            return user_text != rev[RevertRate.REV_USER_TEXT_IDX]
+    return False
+
 # Build "weighted rate" decorator
 revert_rate_avg = weighted_rate
 revert_rate_avg = decorator_builder(RevertRate.header())(
@@ -225,6 +385,7 @@ setattr(revert_rate_avg, um.METRIC_AGG_METHOD_HEAD, ['total_users',
                                                     'average_rate',])
 setattr(revert_rate_avg, um.METRIC_AGG_METHOD_KWARGS, {'val_idx' : 1,
                                                        'weight_idx' : 1})
+setattr(revert_rate_avg, um.METRIC_AGG_METHOD_PARTIAL, WeightedRatePartial)
 
 # testing
 if __name__ == "__main__":
@@ -5,7 +5,8 @@ __license__ = "GPL (version 2 or later)"
 
 import user_metric as um
 import threshold as th
-from src.etl.aggregator import decorator_builder, boolean_rate
+from src.etl.aggregator import decorator_builder, boolean_rate, \
+    BooleanRatePartial
 
 class Survival(um.UserMetric):
     """
@@ -29,6 +30,10 @@ class Survival(um.UserMetric):
 
     """
 
+    # Partial aggregates are computed by the workers of Threshold
+    PARTIAL_AGGREGATES = True
+    LAZY_USERS = True
+
     # Structure that defines parameters for Survival class
     _param_types = {
         'init' : {
@@ -39,6 +44,7 @@ class Survival(um.UserMetric):
             'num_threads' : ['int', 'Number of worker processes over users.',0],
             'restrict' : ['bool', 'Restrict threshold calculations to those users registered between'
                                   '`date_start` and `date_end`',False],
+            'batch' : ['bool', 'Evaluate users with grouped queries over batches of users.',False],
             }
     }
 
@@ -78,7 +84,9 @@ class Survival(um.UserMetric):
         kwargs['survival'] = True
         kwargs['n'] = 1     # survival is denoted by making at least one revision
 
-        self._results =  th.Threshold(**kwargs).process(user_handle, **kwargs)._results
+        threshold_obj = th.Threshold(**kwargs)
+        threshold_obj._partial = self._partial
+        self._results = threshold_obj.process(user_handle, **kwargs)._results
         return self
 
 # Build "rate" decorator
@@ -90,6 +98,7 @@ setattr(survival_editors_agg, um.METRIC_AGG_METHOD_NAME, 'survival_editors_agg')
 setattr(survival_editors_agg, um.METRIC_AGG_METHOD_HEAD, ['total_users',
                                                            'has_survived','rate'])
 setattr(survival_editors_agg, um.METRIC_AGG_METHOD_KWARGS, {'val_idx' : 1})
+setattr(survival_editors_agg, um.METRIC_AGG_METHOD_PARTIAL, BooleanRatePartial)
 
 # testing
 if __name__ == "__main__":
@@ -5,14 +5,22 @@ __license__ = "GPL (version 2 or later)"
 
 from datetime import timedelta
 import collections
+from itertools import chain
 import os
+import numpy as np
 import src.utils.multiprocessing_wrapper as mpw
 import user_metric as um
-from src.etl.aggregator import decorator_builder, boolean_rate
-from query_calls import threshold_reg_query, threshold_rev_query
+from src.utils.timestamp import parse_timestamp, to_epoch, to_epoch_array
+from src.etl.aggregator import decorator_builder, boolean_rate, \
+    BooleanRatePartial
+from query_calls import threshold_reg_query, threshold_rev_query, \
+    threshold_rev_batch_query, threshold_sweep_rev_query
 
 from config import logging
 
+# Number of users evaluated per query in batch mode
+USER_BATCH_SIZE = 1000
+
 class Threshold(um.UserMetric):
     """
         Boolean measure: Did an editor reach some threshold of activity (e.g.
@@ -34,8 +42,17 @@ class Threshold(um.UserMetric):
             >>> import src.etl.threshold as t
             >>> for r in t.Threshold().process([13234584]).__iter__(): print r
             (13234584L, 1)
+
+        Setting `batch` in the call to process() evaluates the cohort with
+        one grouped query per `USER_BATCH_SIZE` users in place of a query
+        per user.
     """
 
+    # Workers count revisions with one query per user or batch
+    EXECUTOR = mpw.THREAD
+    PARTIAL_AGGREGATES = True
+    LAZY_USERS = True
+
     # Structure that defines parameters for Threshold class
     _param_types = {
         'init' : {
@@ -54,6 +71,9 @@ class Threshold(um.UserMetric):
                                   'users registered between `date_start` and '
                                   '`date_end`',
                           False],
+            'batch' : ['bool', 'Evaluate users with grouped queries over '
+                               'batches of users.',
+                       False],
         }
     }
 
@@ -111,15 +131,23 @@ class Threshold(um.UserMetric):
         if not hasattr(user_handle, '__iter__'): user_handle = [user_handle]
         if not user_handle: user_handle.append(-1) # No user is matched
 
-        reg_query = threshold_reg_query(user_handle, self._project_)
-        self._data_source_._cur_.execute(reg_query)
-
-        # Process results
-        user_data = [r for r in self._data_source_._cur_]
+        # The registrations are streamed to the workers as they are read,
+        # those of generated users a chunk of users at a time
+        if hasattr(user_handle, '__len__'):
+            user_data = self._data_source_.execute_SQL_stream(
+                threshold_reg_query(user_handle, self._project_))
+        else:
+            user_data = chain.from_iterable(
+                self._data_source_.execute_SQL_stream(
+                    threshold_reg_query(users, self._project_))
+                for users in mpw.iter_chunks(user_handle,
+                                             self.COHORT_CHUNK_SIZE))
         args = [self._project_, self._namespace_, self._n_,
                 self._t_, log_progress, survival, restrict,
                 self._start_ts_, self._end_ts_]
-        self._results = mpw.build_thread_pool(user_data,_process_help,k,args)
+        callback = _process_help_batched if bool(kwargs['batch']) else \
+            _process_help
+        self._results = self._run_pool(user_data, callback, k, args, kwargs)
 
         return self
 
@@ -142,12 +170,12 @@ def _process_help(args):
     # only proceed if there is user data
     if not len(user_data): return []
 
-    conn = um.dl.Connector(instance='slave')
+    conn = um.dl.get_connection(instance='slave')
     results = list()
     dropped_users = 0
     for r in user_data:
         try:
-            threshold_ts = um.UserMetric._get_timestamp(um.date_parse(r[1]) +
+            threshold_ts = um.UserMetric._get_timestamp(parse_timestamp(r[1]) +
                                               timedelta(hours=thread_args.t))
             uid = long(r[0])
             rev_query = threshold_rev_query(uid,
@@ -156,7 +184,7 @@ def _process_help(args):
                                             thread_args.project,
                                             thread_args.restrict,
                                             thread_args.ts_start,
-                                            thread_args.ts_start,
+                                            thread_args.ts_end,
                                             threshold_ts)
             conn._cur_.execute(rev_query)
             count = int(conn._cur_.fetchone()[0])
@@ -171,6 +199,73 @@ def _process_help(args):
             results.append((r[0],0))
         else:
             results.append((r[0],1))
+    um.dl.release_connection(conn)
+
+    if thread_args.log_progress: logging.info(
+        __name__ + '::Processed PID = %s.  Dropped users = %s.' % (
+            os.getpid(), str(dropped_users)))
+
+    return results
+
+def _process_help_batched(args):
+    """ Used by Threshold::process() for forking in batch mode.  Counts the
+        revisions of `USER_BATCH_SIZE` users at once with a grouped query.
+        Should not be called externally. """
+
+    ThresholdArgsClass = collections.namedtuple('ThresholdArgs',
+        'project namespace n t log_progress survival restrict ts_start ts_end')
+    user_data = args[0]
+    state = args[1]
+    thread_args = ThresholdArgsClass(state[0],state[1],state[2],
+        state[3],state[4],state[5],state[6],state[7],state[8])
+
+    if thread_args.log_progress:
+        logging.info(__name__ + ' :: Processing revision data (batch) ' + \
+        '(%s users) by user... (PID = %s)' % (len(user_data), os.getpid()))
+        logging.info(__name__ + ' :: ' + str(thread_args))
+
+    # only proceed if there is user data
+    if not len(user_data): return []
+
+    conn = um.dl.get_connection(instance='slave')
+    results = list()
+    dropped_users = 0
+    for i in xrange(0, len(user_data), USER_BATCH_SIZE):
+
+        # Compute the threshold timestamp of each user in the batch
+        users = list()
+        user_thresholds = list()
+        for r in user_data[i:i + USER_BATCH_SIZE]:
+            try:
+                threshold_ts = um.UserMetric._get_timestamp(
+                    parse_timestamp(r[1]) + timedelta(hours=thread_args.t))
+                user_thresholds.append((long(r[0]), threshold_ts))
+                users.append(r)
+            except IndexError:
+                dropped_users += 1
+                continue
+            except ValueError:
+                dropped_users += 1
+                continue
+        if not users: continue
+
+        rev_query = threshold_rev_batch_query(user_thresholds,
+                                              thread_args.survival,
+                                              thread_args.namespace,
+                                              thread_args.project,
+                                              thread_args.restrict,
+                                              thread_args.ts_start,
+                                              thread_args.ts_end)
+        counts = dict()
+        for row in conn.execute_SQL_stream(rev_query):
+            counts[long(row[0])] = int(row[1])
+
+        for r in users:
+            if counts.get(long(r[0]), 0) < thread_args.n:
+                results.append((r[0],0))
+            else:
+                results.append((r[0],1))
+    um.dl.release_connection(conn)
 
     if thread_args.log_progress: logging.info(
         __name__ + '::Processed PID = %s.  Dropped users = %s.' % (
@@ -178,6 +273,154 @@ def _process_help(args):
 
     return results
 
+# Stores the outcome of a single configuration in a threshold sweep
+ThresholdSweepResult = collections.namedtuple('ThresholdSweepResult',
+                                              'config metric aggregate')
+
+def sweep(user_handle, configurations, **kwargs):
+    """
+        Evaluates several Threshold configurations over the same users in a
+        single pass.  The registration and early revisions (timestamp and
+        namespace) of each user are fetched once, up to the largest `t`
+        among the configurations, and every configuration is then evaluated
+        in memory.
+
+            - Parameters:
+                - **user_handle** - List(int).  List of user ids.
+                - **configurations** - List(tuple).  (t, n, namespace)
+                    configurations to evaluate.
+                - Remaining keyword args are passed to the Threshold
+                    constructor (`date_start`, `date_end`, `project`) and
+                    apply as process options (`num_threads`,
+                    `log_progress`, `restrict`).
+
+            - Return:
+                - List(ThresholdSweepResult).  One result per configuration
+                    and in the same order, storing the configuration, a
+                    Threshold object holding the per-user results and its
+                    `threshold_editors_agg` aggregate.
+
+        e.g. ::
+
+            >>> import src.metrics.threshold as th
+            >>> for r in th.sweep([13234584, 156171],
+                    [(24, 1, 0), (168, 10, 0)]): print r.config, r.aggregate
+            (24, 1, 0) [2, 2, 1.0]
+            (168, 10, 0) [2, 1, 0.5]
+    """
+    if not configurations: return list()
+
+    metrics = [Threshold(t=t, n=n, namespace=namespace, **kwargs)
+               for t, n, namespace in configurations]
+
+    process_kwargs = dict(kwargs)
+    metrics[0].apply_default_kwargs(process_kwargs, 'process')
+    k = process_kwargs['num_threads']
+    log_progress = bool(process_kwargs['log_progress'])
+    restrict = bool(process_kwargs['restrict'])
+
+    # Duck-type the "cohort" ref for a ID generating interface
+    if hasattr(user_handle, 'get_users'):
+        user_handle = [u for u in user_handle.get_users(
+            metrics[0]._start_ts_, metrics[0]._end_ts_)]
+    if not hasattr(user_handle, '__iter__'): user_handle = [user_handle]
+    if not user_handle: user_handle = [-1] # No user is matched
+
+    # Revisions are fetched over the union of namespaces
+    namespace = set()
+    for m in metrics:
+        if m._namespace_ == um.UserMetric.ALL_NAMESPACES:
+            namespace = um.UserMetric.ALL_NAMESPACES
+            break
+        namespace |= m._namespace_
+
+    reg_query = threshold_reg_query(user_handle, metrics[0]._project_)
+    user_data = [r for r in
+                 metrics[0]._data_source_.execute_SQL_stream(reg_query)]
+
+    args = [metrics[0]._project_, namespace,
+            [(m._t_, m._n_, m._namespace_) for m in metrics],
+            log_progress, restrict,
+            metrics[0]._start_ts_, metrics[0]._end_ts_]
+    results = mpw.build_thread_pool(user_data, _sweep_help, k, args,
+        executor=metrics[0]._get_executor(process_kwargs))
+
+    for m in metrics: m._results = list()
+    for idx, user, flag in results: metrics[idx]._results.append((user, flag))
+
+    return [ThresholdSweepResult(configurations[idx], metrics[idx],
+                                 threshold_editors_agg(metrics[idx]))
+            for idx in xrange(len(metrics))]
+
+def _sweep_help(args):
+    """ Used by sweep() for forking.  Fetches the early revisions of each
+        user once and evaluates every configuration over them.
+        Should not be called externally. """
+
+    SweepArgsClass = collections.namedtuple('SweepArgs',
+        'project namespace configs log_progress restrict ts_start ts_end')
+    user_data = args[0]
+    state = args[1]
+    thread_args = SweepArgsClass(state[0],state[1],state[2],state[3],
+                                 state[4],state[5],state[6])
+
+    if thread_args.log_progress:
+        logging.info(__name__ + ' :: Processing threshold sweep ' + \
+        '(%s users, %s configurations)... (PID = %s)' % (
+            len(user_data), len(thread_args.configs), os.getpid()))
+
+    # only proceed if there is user data
+    if not len(user_data): return []
+
+    # Compute the threshold timestamp of each user for every configuration
+    users = list()
+    dropped_users = 0
+    for r in user_data:
+        try:
+            reg_ts = parse_timestamp(r[1])
+            thresholds = [um.UserMetric._get_timestamp(
+                reg_ts + timedelta(hours=config[0]))
+                          for config in thread_args.configs]
+            users.append((r[0], long(r[0]), thresholds))
+        except IndexError:
+            dropped_users += 1
+            continue
+        except ValueError:
+            dropped_users += 1
+            continue
+
+    # Fetch revisions up to the latest threshold of each user
+    revs = collections.defaultdict(list)
+    conn = um.dl.get_connection(instance='slave')
+    for i in xrange(0, len(users), USER_BATCH_SIZE):
+        rev_query = threshold_sweep_rev_query(
+            [(uid, max(thresholds)) for _, uid, thresholds in
+             users[i:i + USER_BATCH_SIZE]],
+            thread_args.namespace, thread_args.project,
+            thread_args.restrict, thread_args.ts_start, thread_args.ts_end)
+        for row in conn.execute_SQL_stream(rev_query):
+            revs[long(row[0])].append((str(row[1]), row[2]))
+    um.dl.release_connection(conn)
+
+    # Evaluate each configuration in memory over the revision timestamps
+    # of each user converted to epoch seconds
+    results = list()
+    for user, uid, thresholds in users:
+        rev_ts = to_epoch_array([rev[0] for rev in revs[uid]])
+        for idx, config in enumerate(thread_args.configs):
+            t, n, namespace = config
+            in_threshold = rev_ts <= to_epoch(thresholds[idx])
+            if namespace != um.UserMetric.ALL_NAMESPACES:
+                in_threshold &= np.array([rev[1] in namespace
+                                          for rev in revs[uid]], dtype=bool)
+            count = int(in_threshold.sum())
+            results.append((idx, user, 0 if count < n else 1))
+
+    if thread_args.log_progress: logging.info(
+        __name__ + '::Processed PID = %s.  Dropped users = %s.' % (
+            os.getpid(), str(dropped_users)))
+
+    return results
 
 # Build "rate" decorator
 threshold_editors_agg = boolean_rate
@@ -190,6 +433,8 @@ setattr(threshold_editors_agg, um.METRIC_AGG_METHOD_NAME,
 setattr(threshold_editors_agg, um.METRIC_AGG_METHOD_HEAD, ['total_users',
                                       'threshold_reached','rate'])
 setattr(threshold_editors_agg, um.METRIC_AGG_METHOD_KWARGS, {'val_idx' : 1})
+setattr(threshold_editors_agg, um.METRIC_AGG_METHOD_PARTIAL,
+    BooleanRatePartial)
 
 # testing
 if __name__ == "__main__":
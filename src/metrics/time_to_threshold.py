@@ -4,8 +4,13 @@ __author__ = "Ryan Faulkner"
 __date__ = "July 27th, 2012"
 __license__ = "GPL (version 2 or later)"
 
-from dateutil.parser import parse as date_parse
+from src.utils.timestamp import to_epoch
+from itertools import groupby
+from operator import itemgetter
+from MySQLdb import ProgrammingError
 import user_metric as um
+import src.utils.multiprocessing_wrapper as mpw
+from query_calls import time_to_threshold_revs_query
 from src.etl.aggregator import weighted_rate, decorator_builder
 
 from config import logging
@@ -13,6 +18,9 @@ from config import logging
 LAST_EDIT = -1
 REGISTRATION = 0
 
+# Number of users whose revisions are fetched by a single query in batch mode
+USER_BATCH_SIZE = 500
+
 class TimeToThreshold(um.UserMetric):
     """
         Produces an integer value representing the number of minutes taken to
@@ -51,7 +59,13 @@ class TimeToThreshold(um.UserMetric):
             'threshold_type_class' : ['str', 'Type of threshold to use.',
                                       'edit_count_threshold'],
             },
-        'process' : {},
+        'process' : {
+            'batch' : ['bool', 'Fetch revisions for batches of users, '
+                               'reading only the edits needed to reach '
+                               'the threshold.', False],
+            'num_threads' : ['int', 'Number of worker processes used in '
+                                    'batch mode.', 1],
+            },
     }
 
     # Define the metrics data model meta
@@ -153,6 +167,10 @@ class TimeToThreshold(um.UserMetric):
                             threshold
             """
 
+            if kwargs.get('batch'):
+                return self._process_batched(user_handle, threshold_obj,
+                    **kwargs)
+
             minutes_to_threshold = list()
 
             # Operate on either user ids or names
@@ -178,6 +196,35 @@ class TimeToThreshold(um.UserMetric):
 
             return minutes_to_threshold
 
+        def _process_batched(self, user_handle, threshold_obj, **kwargs):
+            """
+                Batched version of process().  Users are split among
+                `num_threads` workers, each of which issues one query per
+                USER_BATCH_SIZE users that returns only the leading and
+                trailing revisions required to evaluate the edit indices.
+            """
+            if not hasattr(user_handle, '__iter__'):
+                user_handle = [user_handle]
+            k = int(kwargs['num_threads']) if 'num_threads' in kwargs else 1
+            args = [threshold_obj._project_, self._first_edit_,
+                    self._threshold_edit_]
+            return mpw.build_thread_pool(user_handle, _process_help, k, args,
+                executor=threshold_obj._get_executor(kwargs))
+
+        def _get_rows_needed(self):
+            """
+                Returns the number of revisions needed from the head and
+                tail of a user's ordered revision history to evaluate both
+                the first and threshold edit indices.
+            """
+            head, tail = 0, 0
+            for index in [self._first_edit_, self._threshold_edit_]:
+                if index < 0:
+                    tail = max(tail, -index)
+                else:
+                    head = max(head, index + 1)
+            return head, tail
+
         def _get_minute_diff_result(self, results):
             """
                 Private method for this class.  This computes the minutes
@@ -188,28 +235,77 @@ class TimeToThreshold(um.UserMetric):
                             timestamp for a given user.
             """
             if self._threshold_edit_ == REGISTRATION and len(results):
-                dat_obj_end = date_parse(results[0])
+                dat_obj_end = to_epoch(results[0])
             elif self._threshold_edit_ == LAST_EDIT and len(results):
-                dat_obj_end = date_parse(results[len(results) - 1])
+                dat_obj_end = to_epoch(results[len(results) - 1])
             elif self._threshold_edit_ < len(results):
-                dat_obj_end = date_parse(results[self._threshold_edit_])
+                dat_obj_end = to_epoch(results[self._threshold_edit_])
             else:
                 return -1
 
             if self._first_edit_ == REGISTRATION and len(results) > 0:
-                dat_obj_start = date_parse(results[0])
+                dat_obj_start = to_epoch(results[0])
             elif self._first_edit_ == LAST_EDIT and len(results):
-                dat_obj_start = date_parse(results[len(results) - 1])
+                dat_obj_start = to_epoch(results[len(results) - 1])
             elif self._first_edit_ < len(results):
-                dat_obj_start = date_parse(results[self._first_edit_])
+                dat_obj_start = to_epoch(results[self._first_edit_])
             else:
                 return -1
 
-            time_diff = dat_obj_end - dat_obj_start
-            return int(time_diff.seconds / 60) + abs(time_diff.days) * 24
+            # Split as a timedelta would - seconds in [0, 86400)
+            days, seconds = divmod(dat_obj_end - dat_obj_start, 86400)
+            return int(seconds / 60) + abs(days) * 24
 
     __threshold_types = { 'edit_count_threshold' : EditCountThreshold }
 
+def _get_user_revs(users, project, head, tail, conn):
+    """
+        Generator over (user, timestamps) for `users`.  Timestamps are
+        ordered and hold at most the first `head` and last `tail` revisions
+        of each user - where these overlap the full history is returned.
+    """
+    sql = time_to_threshold_revs_query(users, head, tail, project)
+    try:
+        rows = sorted(set([(str(r[0]), r[2], r[1])
+                           for r in conn.execute_SQL_stream(sql)]))
+    except ProgrammingError:
+        raise um.UserMetric.UserMetricError(
+            message=str(TimeToThreshold) + '::Could not get revisions '
+                                           'for specified users(s) - '
+                                           'Query Failed.')
+    for user, revs in groupby(rows, key=itemgetter(0)):
+        yield user, [rev[1] for rev in revs]
+
+def _process_help(args):
+    """
+        Worker method for batched EditCountThreshold processing.  Each
+        batch of users is resolved with a single query and the minute
+        differences computed in one pass over the returned revisions.
+    """
+
+    users = args[0]
+    state = args[1]
+    project = state[0]
+    threshold = TimeToThreshold.EditCountThreshold(first_edit=state[1],
+        threshold_edit=state[2])
+    head, tail = threshold._get_rows_needed()
+
+    minutes_to_threshold = list()
+    conn = um.dl.get_connection(instance='slave')
+    try:
+        for i in xrange(0, len(users), USER_BATCH_SIZE):
+            batch = users[i:i + USER_BATCH_SIZE]
+            user_revs = dict(_get_user_revs(batch, project, head, tail,
+                                            conn))
+            for user in batch:
+                minutes_to_threshold.append([user,
+                    threshold._get_minute_diff_result(
+                        user_revs.get(str(user), []))])
+    finally:
+        um.dl.release_connection(conn)
+
+    return minutes_to_threshold
+
 # ==========================
 # DEFINE METRIC AGGREGATORS
 # ==========================
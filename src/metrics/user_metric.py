@@ -49,8 +49,13 @@ __date__ = "July 27th, 2012"
 __license__ = "GPL (version 2 or later)"
 
 import src.etl.data_loader as dl
+import src.etl.aggregator as agg
+import src.utils.multiprocessing_wrapper as mpw
+from src.utils.columnar import ColumnarResults
+from query_calls import user_rev_count_query
 from collections import namedtuple
-from dateutil.parser import parse as date_parse
+from itertools import chain
+from src.utils.timestamp import parse_timestamp
 from datetime import datetime, timedelta
 
 def pre_metrics_init(init_f):
@@ -74,37 +79,75 @@ def pre_metrics_init(init_f):
 # 2. header attribute for a type of metric aggregation methods
 # 3. name attribute for a type of metric aggregation methods
 # 4. keyword arg attribute for a type of metric aggregation methods
+# 5. partial aggregate class (see src.etl.aggregator.PartialAggregate) for
+#       a type of metric aggregation methods
 METRIC_AGG_METHOD_FLAG = 'metric_agg_flag'
 METRIC_AGG_METHOD_HEAD = 'metric_agg_head'
 METRIC_AGG_METHOD_NAME = 'metric_agg_name'
 METRIC_AGG_METHOD_KWARGS = 'metric_agg_kwargs'
+METRIC_AGG_METHOD_PARTIAL = 'metric_agg_partial'
 
 # Class for storing aggregate data
 aggregate_data_class = namedtuple("AggregateData", "header data")
 
+def get_aggregator_name(agg_method):
+    """ The name under which an aggregator reports its aggregate data """
+    if hasattr(agg_method, METRIC_AGG_METHOD_FLAG) and getattr(agg_method,
+        METRIC_AGG_METHOD_FLAG):
+        return getattr(agg_method, METRIC_AGG_METHOD_NAME)
+    return agg_method.__name__
+
 def aggregator(agg_method, metric, data_header):
     """ Method for wrapping and executing aggregated data """
 
+    agg_header = _get_aggregate_header(agg_method, metric, data_header)
     if hasattr(agg_method, METRIC_AGG_METHOD_FLAG) and getattr(agg_method,
         METRIC_AGG_METHOD_FLAG):
-        # These are metric specific aggregators.  The method must also define
-        # the header.
-        agg_header = getattr(agg_method, METRIC_AGG_METHOD_HEAD) if hasattr(
-            agg_method, METRIC_AGG_METHOD_HEAD) else 'No header specified.'
-
+        # These are metric specific aggregators.
         kwargs = getattr(agg_method,METRIC_AGG_METHOD_KWARGS) if hasattr(
             agg_method, METRIC_AGG_METHOD_KWARGS) else {}
 
         data = [getattr(agg_method,METRIC_AGG_METHOD_NAME)] + agg_method(
             metric, **kwargs)
     else:
-        # Generic aggregators that are metric agnostic
-        agg_header = ['type'] + [data_header[i] for i in metric._agg_indices[
-                                                         agg_method.__name__]]
-        data = [agg_method.__name__] + agg_method(metric.__iter__(),
+        # Generic aggregators that are metric agnostic.  Columnar results
+        # are passed as they are so that their columns can be read directly
+        rows = metric._results if isinstance(metric._results,
+            ColumnarResults) else metric.__iter__()
+        data = [agg_method.__name__] + agg_method(rows,
             metric._agg_indices[agg_method.__name__])
     return aggregate_data_class(agg_header, data)
 
+def _get_aggregate_header(agg_method, metric, data_header):
+    """ Header of the aggregate data produced by an aggregator """
+    if hasattr(agg_method, METRIC_AGG_METHOD_FLAG) and getattr(agg_method,
+        METRIC_AGG_METHOD_FLAG):
+        # The metric specific aggregators must also define the header.
+        return getattr(agg_method, METRIC_AGG_METHOD_HEAD) if hasattr(
+            agg_method, METRIC_AGG_METHOD_HEAD) else 'No header specified.'
+    return ['type'] + [data_header[i] for i in metric._agg_indices[
+                                                agg_method.__name__]]
+
+def get_partial_aggregate(agg_method, metric):
+    """
+        Returns the partial aggregate (see
+        src.etl.aggregator.PartialAggregate) computing `agg_method` over the
+        results of `metric` or None if the aggregator has none.
+    """
+    if hasattr(agg_method, METRIC_AGG_METHOD_FLAG) and getattr(agg_method,
+        METRIC_AGG_METHOD_FLAG):
+        if not hasattr(agg_method, METRIC_AGG_METHOD_PARTIAL):
+            return None
+        kwargs = getattr(agg_method,METRIC_AGG_METHOD_KWARGS) if hasattr(
+            agg_method, METRIC_AGG_METHOD_KWARGS) else {}
+        return getattr(agg_method, METRIC_AGG_METHOD_PARTIAL)(**kwargs)
+
+    if agg_method.__name__ in agg.PARTIAL_AGGREGATES and \
+            agg_method.__name__ in metric._agg_indices:
+        return agg.PARTIAL_AGGREGATES[agg_method.__name__](
+            metric._agg_indices[agg_method.__name__])
+    return None
+
 class UserMetric(object):
 
     ALL_NAMESPACES =        'all_namespaces'
@@ -113,6 +156,26 @@ class UserMetric(object):
     # Default number of days for a metric computation
     DEFAULT_DATA_RANGE =    14
 
+    # Number of user ids of a cohort (see src/metrics/users.py) that are
+    # processed at a time
+    COHORT_CHUNK_SIZE =     5000
+
+    # Executor backend for worker pools (see
+    # src/utils/multiprocessing_wrapper.py).  Metrics whose workers mostly
+    # wait on the database use threads.
+    EXECUTOR =              mpw.PROCESS
+
+    # Set by metrics that pass `_partial` to their worker pools, whose
+    # workers may then return partial aggregates rather than rows (see
+    # process_aggregate)
+    PARTIAL_AGGREGATES =    False
+
+    # Set by metrics whose process() accepts a generator of users, which
+    # is dispatched to a single worker pool in chunks as it is read (see
+    # _run_pool).  The users of other metrics are processed a chunk at a
+    # time (see pre_process_users)
+    LAZY_USERS =            False
+
     _data_model_meta = dict()
     _agg_indices = dict()
 
@@ -130,7 +193,16 @@ class UserMetric(object):
             'namespace' : ['int|set', 'The namespace over which the '
                                       'metric is computed.', 0],
             },
-        'process' : {}
+        'process' : {
+            'executor' : ['str', 'Executor for worker pools (process, '
+                                 'thread or serial).  Defaults to the '
+                                 'executor of the metric.', ''],
+            'columnar' : ['bool', 'Store the results as typed columns '
+                                  '(see src/utils/columnar.py).', False],
+            'stream' : ['bool', 'Generate the results as the worker '
+                                'chunks complete, in no particular order.  '
+                                'The results may be iterated once.', False],
+            }
     }
 
     def apply_default_kwargs(self, kwargs, arg_type):
@@ -142,8 +214,12 @@ class UserMetric(object):
 
     def __init__(self, **kwargs):
 
+        # The connection of the metric lives as long as the metric, it is
+        # kept out of the connection pool so that metric instances do not
+        # hold slots needed by the workers
         self._data_source_ = dl.Connector(instance='slave')
         self._results = list()      # Stores results of a process request
+        self._partial = None        # Partial aggregate computed by workers
 
         # Set metric time bounds
         self._start_ts_ = self._get_timestamp(kwargs['date_start'])
@@ -182,6 +258,93 @@ class UserMetric(object):
     @property
     def date_end(self): return self._end_ts_
 
+    def _get_executor(self, kwargs):
+        """ Executor for worker pools, the `executor` kwarg of process()
+            overrides the metric default """
+        return kwargs['executor'] if 'executor' in kwargs and \
+            kwargs['executor'] else self.EXECUTOR
+
+    def _is_streaming(self, kwargs):
+        """ Whether the results are generated as they are computed, workers
+            returning partial aggregates take precedence """
+        return 'stream' in kwargs and bool(kwargs['stream']) and \
+            self._partial is None
+
+    def _get_cost(self, users, k):
+        """
+            Cost hint for the worker pool, see
+            src.utils.multiprocessing_wrapper.build_thread_pool.  The cost
+            of a user is the number of revisions of the user in the metric
+            period.  Returns None unless `users` is a list to be shared by
+            more than one worker.
+        """
+        if int(k) < 2 or not hasattr(users, '__len__') or len(users) < 2:
+            return None
+        counts = dict()
+        for chunk in mpw.iter_chunks(users, self.COHORT_CHUNK_SIZE):
+            for row in self._data_source_.execute_SQL_stream(
+                    user_rev_count_query(chunk, self._start_ts_,
+                                         self._end_ts_, self._project_)):
+                counts[str(row[0])] = int(row[1])
+        return lambda user: counts.get(str(user), 0)
+
+    def _run_pool(self, data, callback, k, args, kwargs, cost=None):
+        """
+            Runs the worker `callback` over `data` on the worker pool, see
+            src.utils.multiprocessing_wrapper.build_thread_pool, and returns
+            the results.  When streaming a generator over the result rows is
+            returned, the workers start once it is first iterated.  `data`
+            may be a generator, e.g. of rows streamed from the database, it
+            is then dispatched in chunks of COHORT_CHUNK_SIZE as it is read.
+            `cost` is an optional cost hint for the elements of `data`, see
+            _get_cost.
+        """
+        executor = self._get_executor(kwargs)
+        chunk_size = None if hasattr(data, '__len__') else \
+            self.COHORT_CHUNK_SIZE
+        if self._is_streaming(kwargs):
+            return chain.from_iterable(mpw.iter_thread_pool(data, callback,
+                k, args, chunk_size=chunk_size, cost=cost,
+                executor=executor))
+        return mpw.build_thread_pool(data, callback, k, args,
+            chunk_size=chunk_size, cost=cost, executor=executor,
+            partial=self._partial, results=self._new_results(kwargs))
+
+    def _new_results(self, kwargs):
+        """ Container for the results of process(), typed columns when
+            the `columnar` kwarg is set """
+        if 'columnar' in kwargs and kwargs['columnar'] and \
+                self._partial is None:
+            return ColumnarResults(self._data_model_meta)
+        return list()
+
+    def process_aggregate(self, user_handle, agg_method, **kwargs):
+        """
+            Processes the metric for `user_handle` and returns only the
+            aggregate `agg_method`, as aggregator() does.  Where the metric
+            supports it and the aggregator defines a partial aggregate each
+            worker returns the partial aggregate of its users in place of
+            the rows of the users, and the partials are merged here.  The
+            results of the metric are not retained in that case.
+        """
+        partial = get_partial_aggregate(agg_method, self) if \
+            self.PARTIAL_AGGREGATES else None
+        if partial is None:
+            self.process(user_handle, **kwargs)
+            return aggregator(agg_method, self, self.header())
+
+        self._partial = partial
+        try:
+            self.process(user_handle, **kwargs)
+        finally:
+            self._partial = None
+        state = partial.merge_all(self._results)
+        self._results = list()
+
+        return aggregate_data_class(
+            _get_aggregate_header(agg_method, self, self.header()),
+            [get_aggregator_name(agg_method)] + partial.result(state))
+
     @classmethod
     def _construct_data_point(cls): return namedtuple(cls.__name__,
         cls.header())
@@ -204,7 +367,7 @@ class UserMetric(object):
 
         try:
             # timestamp strings should
-            datetime_obj = date_parse(ts_representation[:19])
+            datetime_obj = parse_timestamp(ts_representation[:19])
         except AttributeError:
             datetime_obj = ts_representation
         except TypeError:
@@ -224,7 +387,7 @@ class UserMetric(object):
         ns_cond = ''
         if hasattr(namespace, '__iter__'):
             if len(namespace) == 1:
-                ns_cond = 'page_namespace = ' + str(namespace.pop())
+                ns_cond = 'page_namespace = ' + str(list(namespace)[0])
             else:
                 ns_cond = 'page_namespace in (' + ",".join(dl.DataLoader().
                     cast_elems_to_string(list(namespace))) + ')'
@@ -233,14 +396,34 @@ class UserMetric(object):
     @staticmethod
     def header(): raise NotImplementedError
 
+    def _process_chunks(self, proc_func, users, kwargs):
+        """ Processes the generated `users` with the process method
+            `proc_func` COHORT_CHUNK_SIZE users at a time and collects the
+            results """
+        results = self._new_results(kwargs)
+        for chunk in mpw.iter_chunks(users, self.COHORT_CHUNK_SIZE):
+            results.extend(proc_func(self, chunk, **kwargs))
+        self._results = results
+        return self
+
     @staticmethod
     def pre_process_users(proc_func):
         def wrapper(self, users, **kwargs):
             # Duck-type the "cohort" ref for a ID generating interface
-            # see src/metrics/users.py
+            # see src/metrics/users.py.  The ids are processed as they are
+            # generated so that neither the ids nor the queries over them
+            # grow with the cohort
             if hasattr(users, 'get_users'):
-                users = [u for u in users.get_users(self._start_ts_, self._end_ts_)]
-            return proc_func(self, users, **kwargs)
+                users = users.get_users(self._start_ts_, self._end_ts_)
+                if not self.LAZY_USERS:
+                    return self._process_chunks(proc_func, users, kwargs)
+            result = proc_func(self, users, **kwargs)
+            # Compact the results of metrics that collect them in a list
+            if 'columnar' in kwargs and kwargs['columnar'] and \
+                    self._partial is None and isinstance(self._results, list):
+                self._results = ColumnarResults(self._data_model_meta,
+                                                self._results)
+            return result
         return wrapper
 
     def process(self, users, **kwargs):
@@ -7,8 +7,8 @@ __author__  = "ryan faulkner"
 __date__    = "01/28/2013"
 __email__   = 'rfaulkner@wikimedia.org'
 
-from src.etl.data_loader import Connector
-from dateutil.parser import parse as date_parse
+from src.etl.data_loader import get_connection, release_connection
+from src.utils.timestamp import format_mediawiki_timestamp
 
 MEDIAWIKI_DB_INSTANCE           = 'slave'
 MEDIAWIKI_TIMESTAMP_FORMAT      = "%Y%m%d%H%M%S"
@@ -61,17 +61,16 @@ class MediaWikiUser(object):
             'date_end': self._format_mediawiki_timestamp(date_end),
             'project' : project,
         }
-        conn = Connector(instance=MEDIAWIKI_DB_INSTANCE)
-        conn._cur_.execute(self.QUERY_TYPES[self._query_type] % param_dict)
-
-        for row in conn._cur_: yield row[0]
+        conn = get_connection(instance=MEDIAWIKI_DB_INSTANCE)
+        try:
+            for row in conn.execute_SQL_stream(
+                self.QUERY_TYPES[self._query_type] % param_dict):
+                yield row[0]
+        finally:
+            release_connection(conn)
 
     def _format_mediawiki_timestamp(self, timestamp_repr):
         """ Convert to mediawiki timestamps """
-        if hasattr(timestamp_repr, 'strftime'):
-            return timestamp_repr.strftime(MEDIAWIKI_TIMESTAMP_FORMAT)
-        else:
-            return date_parse(timestamp_repr).strftime(
-                MEDIAWIKI_TIMESTAMP_FORMAT)
+        return format_mediawiki_timestamp(timestamp_repr)
 
 
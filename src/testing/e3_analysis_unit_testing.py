@@ -7,8 +7,29 @@ __date__ = "September 18, 2012"
 __license__ = "GPL (version 2 or later)"
 
 import sys
+import math
+import os
+import shelve
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import src.etl.experiments_loader as el
+from datetime import datetime, date
+from itertools import izip
+from numpy import array
+import numpy as np
+from src.utils.timestamp import parse_timestamp, to_epoch, to_epoch_array, \
+    format_mediawiki_timestamp, IntervalBuckets
+import src.utils.columnar as col
+import src.etl.aggregator as agg
+import src.api.cache as cache
+import src.api.scheduler as sched
+import src.etl.data_loader as dl
+import src.metrics.revert_rate as rr
+import src.utils.multiprocessing_wrapper as mpw
+import src.etl.interval_store as ist
 # import src.metrics.time_to_threshold as ttt
 
 class TestTimeToThreshold(unittest.TestCase):
@@ -38,6 +59,673 @@ class TestExperimentsLoader(unittest.TestCase):
         self.assertEqual(out['y0'], [1,0,0])
 
 
+class TestTimestamp(unittest.TestCase):
+    """ Class that defines unit tests across the timestamp parsing helpers """
+
+    def setUp(self):
+        self.timestamps = ['20120101000000', '20120229235959',
+                           '19991231120000', '20130115083015']
+
+    def test_parse_formats(self):
+        """ Ensure that MediaWiki and datetime strings parse to the same value """
+
+        for ts in self.timestamps:
+            dt = parse_timestamp(ts)
+            self.assertEqual(dt, datetime.strptime(ts, '%Y%m%d%H%M%S'))
+            self.assertEqual(parse_timestamp(str(dt)), dt)
+            self.assertEqual(parse_timestamp(dt.isoformat()), dt)
+        self.assertEqual(parse_timestamp(date(2012, 1, 2)), datetime(2012, 1, 2))
+        self.assertEqual(parse_timestamp('January 2, 2012'), datetime(2012, 1, 2))
+
+    def test_round_trip(self):
+        """ Ensure that timestamps survive conversion to epoch seconds and back """
+
+        for ts in self.timestamps:
+            epoch = to_epoch(ts)
+            self.assertEqual(format_mediawiki_timestamp(
+                datetime.utcfromtimestamp(epoch)), ts)
+            self.assertEqual(to_epoch(parse_timestamp(ts)), epoch)
+            self.assertEqual(to_epoch(str(parse_timestamp(ts))), epoch)
+        self.assertEqual(to_epoch('19700101000000'), 0)
+        self.assertEqual(list(to_epoch_array(self.timestamps)),
+                         [to_epoch(ts) for ts in self.timestamps])
+        self.assertEqual(list(to_epoch_array(['2012-01-01 00:00:00'])),
+                         [to_epoch('20120101000000')])
+
+    def test_invalid_dates(self):
+        """ Ensure that out of range fields are not silently accepted """
+
+        self.assertRaises(ValueError, parse_timestamp, '20121301000000')
+        self.assertRaises(ValueError, to_epoch, '20120132000000')
+
+    def test_interval_buckets(self):
+        """ Ensure that interval boundaries fall into the right bucket """
+
+        buckets = IntervalBuckets([('20120101000000', '20120102000000'),
+                                   ('20120102000000', '20120103000000')])
+        self.assertEqual(len(buckets), 2)
+        self.assertEqual(buckets.step, 86400)
+        self.assertEqual(buckets.bucket('20120101000000'), 0)
+        self.assertEqual(buckets.bucket('20120101235959'), 0)
+        self.assertEqual(buckets.bucket('20120102000000'), 1)
+        self.assertEqual(buckets.bucket('20120102235959'), 1)
+        self.assertEqual(buckets.bucket('20111231235959'), None)
+        self.assertEqual(buckets.bucket('20120103000000'), None)
+
+        buckets = IntervalBuckets([('20120101000000', '20120102000000'),
+                                   ('20120102000000', '20120103000000')],
+                                  right_closed=True)
+        self.assertEqual(buckets.bucket('20120101000000'), None)
+        self.assertEqual(buckets.bucket('20120101000001'), 0)
+        self.assertEqual(buckets.bucket('20120102000000'), 0)
+        self.assertEqual(buckets.bucket('20120103000000'), 1)
+        self.assertEqual(buckets.bucket('20120103000001'), None)
+
+    def test_interval_buckets_validation(self):
+        """ Ensure that gaps and unequal intervals are rejected """
+
+        self.assertRaises(ValueError, IntervalBuckets,
+                          [('20120101000000', '20120102000000'),
+                           ('20120103000000', '20120104000000')])
+        self.assertRaises(ValueError, IntervalBuckets,
+                          [('20120101000000', '20120102000000'),
+                           ('20120102000000', '20120104000000')])
+        self.assertRaises(ValueError, IntervalBuckets,
+                          [('20120102000000', '20120101000000')])
+
+
+class TestColumnarResults(unittest.TestCase):
+    """ Class that defines unit tests across the ColumnarResults container """
+
+    def setUp(self):
+        self.chunk_rows = col.CHUNK_ROWS
+        col.CHUNK_ROWS = 3
+        self.meta = {'id_fields' : [0], 'integer_fields' : [1, 2],
+                     'float_fields' : [3], 'boolean_fields' : [4]}
+        self.rows = [['%s' % i, i, -i, i / 2.0, i % 2 == 0]
+                     for i in xrange(8)]
+
+    def tearDown(self):
+        col.CHUNK_ROWS = self.chunk_rows
+
+    def test_rows_and_columns_agree(self):
+        """ Ensure that the rows and the columns hold the values added """
+
+        results = col.ColumnarResults(self.meta)
+        results.extend(self.rows[:5])
+        for row in self.rows[5:]: results.append(row)
+
+        self.assertEqual(len(results), len(self.rows))
+        self.assertEqual(list(results), [tuple(r) for r in self.rows])
+        for idx in xrange(5):
+            self.assertEqual(list(results.column(idx)),
+                             [r[idx] for r in self.rows])
+        self.assertEqual(results.column(1).dtype.kind, 'i')
+        self.assertEqual(results.column(3).dtype.kind, 'f')
+        self.assertEqual(results.column(4).dtype.kind, 'b')
+        self.assertEqual(results.columns([1, 2]).tolist(),
+                         [[r[1], r[2]] for r in self.rows])
+
+        # Iteration after compacting the remaining rows is unchanged
+        self.assertEqual(list(results), [tuple(r) for r in self.rows])
+
+    def test_mixed_types(self):
+        """ Ensure that mixed type fields are kept as they were added """
+
+        rows = [['1', 1, 1, 0.5, True], ['2', None, 2L, 1.5, False],
+                ['3', 3, 3, 2.5, True]]
+        results = col.ColumnarResults(self.meta, rows)
+
+        self.assertEqual(list(results), [tuple(r) for r in rows])
+        self.assertEqual(results.column(1), None)
+        self.assertEqual(results.columns([1, 2]), None)
+        self.assertEqual(list(results.column(2)), [1, 2, 3])
+
+    def test_untyped_rows(self):
+        """ Ensure that rows of varying length and dict fields are kept """
+
+        rows = [['1', 1], ['2', 2, 3], ['3']]
+        results = col.ColumnarResults(self.meta, rows)
+        self.assertEqual(list(results), [tuple(r) for r in rows])
+        self.assertEqual(results.column(0), None)
+
+        meta = {'id_fields' : [0], 'dict_fields' : [1]}
+        rows = [['1', {0 : 1, 1 : 2}], ['2', {0 : 3, 1 : 4}],
+                ['3', {0 : 5, 1 : 6}]]
+        results = col.ColumnarResults(meta, rows)
+        self.assertEqual(list(results), [tuple(r) for r in rows])
+        self.assertEqual(col.ColumnarResults(meta).column(0).tolist(), [])
+
+
+class TestPartialAggregates(unittest.TestCase):
+    """ Class that defines unit tests across the partial aggregates of the aggregators """
+
+    def setUp(self):
+        self.rows = [[str(i), i % 3, (i * 7) % 5, i * 0.25, i % 4 == 0]
+                     for i in xrange(20)]
+        self.splits = [self.rows[:7], [], self.rows[7:8], self.rows[8:]]
+
+    def assert_rows_equal(self, x, y):
+        self.assertEqual(len(x), len(y))
+        for a, b in zip(x, y): self.assertAlmostEqual(a, b)
+
+    def merge_splits(self, partial):
+        return partial.result(partial.merge_all(
+            [partial(rows) for rows in self.splits]))
+
+    def test_sum_indices(self):
+        """ Ensure that merged partials of list_sum_indices match the aggregator """
+
+        partial = agg.SumIndicesPartial([1, 2, 3])
+        self.assert_rows_equal(self.merge_splits(partial),
+                               agg.list_sum_indices(self.rows, [1, 2, 3]))
+        self.assertEqual(partial.result(partial.merge_all([])), [0, 0, 0])
+
+    def test_boolean_rate(self):
+        """ Ensure that merged partials of boolean_rate match the aggregator """
+
+        for kwargs in [{'val_idx' : 1}, {'val_idx' : 4},
+                       {'val_idx' : 2, 'cmp_method' : lambda x: x > 2}]:
+            partial = agg.BooleanRatePartial(**kwargs)
+            self.assert_rows_equal(self.merge_splits(partial),
+                                   agg.boolean_rate(self.rows, **kwargs))
+        self.assertEqual(partial.result(partial.merge_all([])),
+                         agg.boolean_rate([], val_idx=1))
+
+    def test_weighted_rate(self):
+        """ Ensure that merged partials of weighted_rate match the aggregator """
+
+        for kwargs in [{'val_idx' : 1}, {'val_idx' : 3, 'weight_idx' : 2}]:
+            partial = agg.WeightedRatePartial(**kwargs)
+            self.assert_rows_equal(self.merge_splits(partial),
+                                   agg.weighted_rate(self.rows, **kwargs))
+
+    def test_unmerge(self):
+        """ Ensure that unmerging a state undoes its merge """
+
+        for partial in [agg.SumIndicesPartial([1, 2, 3]),
+                        agg.BooleanRatePartial(val_idx=1),
+                        agg.WeightedRatePartial(val_idx=3)]:
+            self.assertTrue(partial.INVERTIBLE)
+            states = [partial(rows) for rows in self.splits]
+            state = partial.merge_all(states)
+            state = partial.unmerge(state, states[0])
+            self.assert_rows_equal(partial.result(state), partial.result(
+                partial.merge_all(states[1:])))
+        self.assertFalse(agg.PartialAggregate.INVERTIBLE)
+
+
+class TestResultCache(unittest.TestCase):
+    """ Class that defines unit tests across the bounds of the API response cache """
+
+    class Clock(object):
+        """ Stands in for the time module of the cache """
+        def __init__(self): self.now = 1000.0
+        def time(self): return self.now
+
+    def setUp(self):
+        self.time = cache.time
+        self.clock = cache.time = self.Clock()
+
+    def tearDown(self):
+        cache.time = self.time
+
+    def key(self, i): return ['cohort_expr <==> %s' % i, 'metric <==> m']
+
+    def test_lru(self):
+        """ Ensure that the least recently used entry is evicted """
+
+        c = cache.ResultCache(max_entries=2, max_bytes=0, ttl=0,
+                              policy=cache.LRU)
+        c.set(self.key(1), 'r1')
+        c.set(self.key(2), 'r2')
+        self.assertEqual(c.get(self.key(1)), 'r1')
+        c.set(self.key(3), 'r3')
+        self.assertEqual(c.keys(), [self.key(1), self.key(3)])
+        self.assertEqual(c.get(self.key(2)), None)
+
+    def test_lfu(self):
+        """ Ensure that the least frequently used entry is evicted, but not the newest """
+
+        c = cache.ResultCache(max_entries=2, max_bytes=0, ttl=0,
+                              policy=cache.LFU)
+        c.set(self.key(1), 'r1')
+        c.set(self.key(2), 'r2')
+        c.get(self.key(1)); c.get(self.key(1)); c.get(self.key(2))
+        c.set(self.key(3), 'r3')
+        self.assertEqual(sorted(c.keys()), [self.key(1), self.key(3)])
+        c.set(self.key(4), 'r4')
+        self.assertEqual(sorted(c.keys()), [self.key(1), self.key(4)])
+
+    def test_ttl(self):
+        """ Ensure that entries expire their time to live after being stored """
+
+        c = cache.ResultCache(max_entries=0, max_bytes=0, ttl=10)
+        c.set(self.key(1), 'r1')
+        self.clock.now += 5
+        c.set(self.key(2), 'r2')
+        self.assertEqual(c.get(self.key(1)), 'r1')
+        self.clock.now += 5
+        self.assertEqual(c.get(self.key(1)), None)
+        self.assertEqual(c.keys(), [self.key(2)])
+        self.clock.now += 5
+        c.purge()
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.size, 0)
+
+    def test_max_bytes(self):
+        """ Ensure that the total size of the entries is kept within bounds """
+
+        size = cache.get_size('x' * 100)
+        c = cache.ResultCache(max_entries=0, max_bytes=2 * size, ttl=0)
+        for i in xrange(3): c.set(self.key(i), 'x' * 100)
+        self.assertEqual(c.keys(), [self.key(1), self.key(2)])
+        self.assertEqual(c.size, 2 * size)
+
+        # Responses larger than the cache are not stored
+        c.set(self.key(3), 'x' * 1000)
+        self.assertEqual(c.get(self.key(3)), None)
+        self.assertEqual(len(c), 2)
+
+        # Replacing an entry does not count it twice
+        c.set(self.key(2), 'x' * 100)
+        self.assertEqual(c.size, 2 * size)
+
+
+def _sleep_job(queue, request, progress):
+    """ Job target for the scheduler tests, sleeps for `request` seconds """
+    time.sleep(request)
+    progress.value = 1.0
+    queue.put(request)
+
+class TestJobScheduler(unittest.TestCase):
+    """ Class that defines unit tests across the API job scheduler """
+
+    def setUp(self):
+        self.completed = list()
+        # Jobs are harvested by the tests rather than the harvesting thread
+        self.scheduler = sched.JobScheduler(_sleep_job, self.completed.append,
+            max_jobs=3, metric_limit=1, metric_limits={'b' : 2},
+            harvest_interval=3600)
+
+    def tearDown(self):
+        # Let the remaining jobs run to completion
+        while any(job.status in (sched.QUEUED, sched.PENDING)
+                  for job in self.scheduler.jobs()):
+            self.finish_running()
+
+    def finish_running(self):
+        for job in self.scheduler.jobs():
+            if job.process: job.process.join()
+        self.scheduler.harvest()
+
+    def status(self, jobs): return [job.status for job in jobs]
+
+    def test_metric_limits(self):
+        """ Ensure that jobs of a metric beyond its limit wait in the queue """
+
+        jobs = [self.scheduler.submit(0.2, 'a1', 'a', 'a1'),
+                self.scheduler.submit(0.2, 'a2', 'a', 'a2'),
+                self.scheduler.submit(0.2, 'b1', 'b', 'b1'),
+                self.scheduler.submit(0.2, 'b2', 'b', 'b2'),
+                self.scheduler.submit(0.2, 'c1', 'c', 'c1')]
+        self.assertEqual(self.status(jobs), [sched.PENDING, sched.QUEUED,
+                                             sched.PENDING, sched.PENDING,
+                                             sched.QUEUED])
+
+        self.finish_running()
+        self.assertEqual(self.status(jobs), [sched.SUCCESS, sched.PENDING,
+                                             sched.SUCCESS, sched.SUCCESS,
+                                             sched.PENDING])
+        self.finish_running()
+        self.assertEqual(self.status(jobs), [sched.SUCCESS] * 5)
+        self.assertEqual(sorted(job.url for job in self.completed),
+                         ['a1', 'a2', 'b1', 'b2', 'c1'])
+
+    def test_priorities(self):
+        """ Ensure that queued jobs start by priority """
+
+        self.scheduler = sched.JobScheduler(_sleep_job, self.completed.append,
+            max_jobs=1, metric_limit=0, harvest_interval=3600)
+        first = self.scheduler.submit(0.2, 'c1', 'c', 'c1')
+        low = self.scheduler.submit(0, 'c2', 'c', 'c2',
+                                    priority=sched.LOW_PRIORITY)
+        high = self.scheduler.submit(0, 'c3', 'c', 'c3',
+                                     priority=sched.HIGH_PRIORITY)
+        self.assertEqual(self.status([first, low, high]),
+                         [sched.PENDING, sched.QUEUED, sched.QUEUED])
+        self.finish_running()
+        self.assertEqual(self.status([low, high]),
+                         [sched.QUEUED, sched.PENDING])
+
+    def test_coalescing(self):
+        """ Ensure that identical requests attach to the job in flight """
+
+        self.scheduler = sched.JobScheduler(_sleep_job, self.completed.append,
+            max_jobs=1, metric_limit=0, harvest_interval=3600)
+        running = self.scheduler.submit(0.2, 'a1', 'a', 'a1')
+        queued = self.scheduler.submit(0, 'a2', 'a', 'a2',
+                                       priority=sched.LOW_PRIORITY)
+        self.assertTrue(self.scheduler.submit(0.2, 'a1', 'a', 'a1') is running)
+        self.assertTrue(self.scheduler.submit(0, 'a2', 'a', 'a2',
+            priority=sched.HIGH_PRIORITY) is queued)
+        self.assertEqual(running.requests, 2)
+        self.assertEqual(queued.requests, 2)
+        self.assertEqual(queued.priority, sched.HIGH_PRIORITY)
+        self.assertTrue(self.scheduler.get_job('a1') is running)
+
+        # Each job completes once for all of its requests
+        self.finish_running()
+        self.finish_running()
+        self.assertEqual(self.status([running, queued]),
+                         [sched.SUCCESS, sched.SUCCESS])
+        self.assertEqual([job.url for job in self.completed], ['a1', 'a2'])
+
+        # Requests after completion start a new job
+        self.assertEqual(self.scheduler.get_job('a1'), None)
+        job = self.scheduler.submit(0, 'a1', 'a', 'a1')
+        self.assertFalse(job is running)
+        self.assertEqual(job.requests, 1)
+
+
+class _FakeCursor(object):
+    """ Cursor of _FakeConnector, each user has four revisions """
+
+    def __init__(self): self._rows = []
+
+    def execute(self, sql):
+        time.sleep(0.01)
+        self._rows = [(i, 1, 'sha%s' % i, 'user') for i in xrange(4)] \
+            if 'rev_user =' in sql else []
+
+    def __iter__(self): return iter(self._rows)
+
+    def close(self): pass
+
+class _FakeConnector(object):
+    """ Stands in for data_loader.Connector """
+
+    class DB(object):
+        def ping(self): pass
+        def rollback(self): pass
+        def cursor(self): return _FakeCursor()
+
+    def __init__(self, **kwargs):
+        self._db_ = self.DB()
+        self._cur_ = _FakeCursor()
+
+    def execute_SQL_stream(self, sql):
+        self._cur_.execute(sql)
+        return iter(self._cur_)
+
+    def close_db(self): pass
+
+class TestConnectorPool(unittest.TestCase):
+    """ Class that defines unit tests across the use of the connection pool by the metrics """
+
+    def setUp(self):
+        self.connector = dl.Connector
+        self.wait_timeout = dl.ConnectorPool.WAIT_TIMEOUT
+        dl.Connector = _FakeConnector
+        dl.ConnectorPool.WAIT_TIMEOUT = 5.0
+        dl.ConnectorPool().close_all()
+        dl.ConnectorPool().set_max_size(4)
+
+    def tearDown(self):
+        dl.Connector = self.connector
+        dl.ConnectorPool.WAIT_TIMEOUT = self.wait_timeout
+        dl.ConnectorPool().close_all()
+        dl.ConnectorPool().set_max_size(dl.ConnectorPool.MAX_SIZE)
+
+    def test_revert_rate_threads(self):
+        """ Ensure that more user and revision threads than pooled connections do not exhaust the pool """
+
+        users = range(24)
+        metrics = [rr.RevertRate(date_start='20120101000000',
+                                 date_end='20120110000000')
+                   for i in xrange(6)]
+        results = metrics[0].process(users, num_threads=16, rev_threads=4,
+                                     executor='thread')
+        self.assertEqual(sorted(list(r) for r in results),
+                         [[user, 0.0, 4.0] for user in users])
+
+
+class TestPartition(unittest.TestCase):
+    """ Class that defines unit tests across the partitioning of worker pool data """
+
+    def setUp(self):
+        self.users = range(1000)
+        self.costs = {10 : 500, 20 : 300, 30 : 200}
+
+    def test_even_split(self):
+        """ Ensure that data without cost hints is split into even chunks """
+
+        chunks = mpw._partition(self.users, 4, None, None)
+        self.assertEqual(len(chunks), 4 * mpw.CHUNKS_PER_WORKER)
+        self.assertEqual(sum(chunks, []), self.users)
+        self.assertEqual(len(mpw._partition(self.users, 4, 300, None)), 4)
+
+    def test_mixed_costs(self):
+        """ Ensure that elements without cost are spread over the chunks """
+
+        chunks = mpw._partition(self.users, 4, None, self.costs.get)
+        self.assertEqual(len(chunks), 4 * mpw.CHUNKS_PER_WORKER)
+        self.assertEqual(sorted(sum(chunks, [])), self.users)
+
+        # The costly users are dispatched first, in chunks of their own
+        self.assertEqual(chunks[:3], [[10], [20], [30]])
+        sizes = [len(chunk) for chunk in chunks[3:]]
+        self.assertTrue(max(sizes) - min(sizes) <= 1)
+
+        chunks = mpw._partition(self.users, 4, None, lambda user: 0)
+        sizes = [len(chunk) for chunk in chunks]
+        self.assertEqual(len(chunks), 4 * mpw.CHUNKS_PER_WORKER)
+        self.assertTrue(max(sizes) - min(sizes) <= 1)
+
+
+# Row by row versions of the aggregators, as they were before the
+# aggregators were vectorized, to compare the vectorized versions against
+
+def _rows_list_sum_indices(l, indices):
+    return list(reduce(lambda x,y: x+y,
+        [array([elem.__getitem__(i) for i in indices]) for elem in l]))
+
+def _rows_list_sum_by_group(l, group_index):
+    d=dict()
+    for i in l:
+        summables = i[:group_index] + i[group_index+1:]
+        if d.has_key(i[group_index]):
+            d[i[group_index]] = map(sum, izip(summables,d[i[group_index]]))
+        else:
+            d[i[group_index]] = summables
+    return [d[k][:group_index] + [k] + d[k][group_index:] for k in d]
+
+def _rows_list_average_by_group(l, group_index):
+    d=dict()
+    counts=dict()
+    for i in l:
+        summables = i[:group_index] + i[group_index+1:]
+        if d.has_key(i[group_index]):
+            d[i[group_index]] = map(sum, izip(summables,
+                d[i[group_index]]))
+            counts[i[group_index]] += 1
+        else:
+            d[i[group_index]] = summables
+            counts[i[group_index]] = 1
+    for k in counts: d[k] = list(array(d[k]) / float(counts[k]))
+    return [d[k][:group_index] + [k] + d[k][group_index:] for k in d]
+
+def _rows_boolean_rate(iter, **kwargs):
+    val_idx = kwargs['val_idx'] if 'val_idx' in kwargs else 1
+    cmp_method = kwargs['cmp_method'] if 'cmp_method' in kwargs else \
+        agg.cmp_method_default
+    total=0
+    pos=0
+    for r in iter.__iter__():
+        try:
+            if cmp_method(r[val_idx]): pos+=1
+            total+=1
+        except IndexError: continue
+        except TypeError: continue
+    if total:
+        return [total, pos, float(pos) / total]
+    else:
+        return [total, pos, 0.0]
+
+def _rows_weighted_rate(iter, **kwargs):
+    weight_idx = kwargs['weight_idx'] if 'weight_idx' in kwargs else 1
+    val_idx = kwargs['val_idx'] if 'val_idx' in kwargs else 1
+    weight_method = agg.weight_method_default
+    count=0
+    total_weight=0.0
+    weighted_sum=0.0
+    for r in iter.__iter__():
+        try:
+            count+=1
+            weight = weight_method(r[weight_idx])
+            total_weight += r[weight_idx]
+            weighted_sum += weight * r[val_idx]
+        except IndexError: continue
+        except TypeError: continue
+    if count:
+        return [count, total_weight, weighted_sum / count]
+    else:
+        return [count, total_weight, 0.0]
+
+class TestVectorizedAggregators(unittest.TestCase):
+    """ Class that defines unit tests comparing the vectorized aggregators with the row by row versions """
+
+    def setUp(self):
+        nan = float('nan')
+        self.inputs = {
+            'integers' : [[str(i), i % 3, (i * 7) % 5 - 2, i]
+                          for i in xrange(50)],
+            'floats' : [[str(i), i * 0.1, i / 3.0, -i * 1.7]
+                        for i in xrange(50)],
+            'mixed' : [[str(i), i, i * 0.5, i % 2 == 0]
+                       for i in xrange(50)],
+            'booleans' : [[str(i), i % 3 == 0, i % 2 == 0, True]
+                          for i in xrange(20)],
+            'none' : [['1', 1, 2.0, 3], ['2', None, 1.0, 2],
+                      ['3', 2, None, 1]],
+            'nan' : [['1', 1.0, 2.0, 3.0], ['2', nan, 1.0, 2.0],
+                     ['3', 2.0, nan, 1.0]],
+            'single' : [['1', 4, 0.5, 2]],
+            'empty' : [],
+            }
+        self.groups = [[i % 4, i, i * 0.25] for i in xrange(40)]
+
+    def assert_same(self, x, y):
+        """ Outputs are equal, NaN values matching NaN values """
+        self.assertEqual(len(x), len(y))
+        for a, b in zip(x, y):
+            if hasattr(a, '__iter__'):
+                self.assert_same(a, b)
+            elif isinstance(a, float) and math.isnan(a):
+                self.assertTrue(math.isnan(b))
+            else:
+                self.assertEqual(a, b)
+                self.assertEqual(type(a) in (bool, np.bool_),
+                                 type(b) in (bool, np.bool_))
+
+    def assert_same_call(self, f, g, *args, **kwargs):
+        """ Both functions return the same or raise the same exception """
+        try:
+            expected = f(*args, **kwargs)
+        except Exception as e:
+            self.assertRaises(e.__class__, g, *args, **kwargs)
+            return
+        self.assert_same(expected, g(*args, **kwargs))
+
+    def test_list_sum_indices(self):
+        """ Ensure that list_sum_indices matches the row by row sums """
+
+        for name, rows in self.inputs.iteritems():
+            for indices in [[1], [1, 2], [1, 2, 3]]:
+                self.assert_same_call(_rows_list_sum_indices,
+                                      agg.list_sum_indices, rows, indices)
+
+    def test_rates(self):
+        """ Ensure that boolean_rate and weighted_rate match the row by row rates """
+
+        for name, rows in self.inputs.iteritems():
+            for kwargs in [{}, {'val_idx' : 2}, {'val_idx' : 3},
+                           {'val_idx' : 2, 'weight_idx' : 3}, {'val_idx' : 9}]:
+                self.assert_same_call(_rows_boolean_rate, agg.boolean_rate,
+                                      rows, **kwargs)
+                self.assert_same_call(_rows_weighted_rate,
+                                      agg.weighted_rate, rows, **kwargs)
+
+    def test_group_aggregates(self):
+        """ Ensure that the group sums and averages match the row by row versions """
+
+        inputs = [self.groups, [row[:2] for row in self.groups],
+                  [[1, 2], [1, None], [2, 3]], [[1, 2.5], [1, float('nan')]],
+                  [[1, 2, 3], [1, 2]], []]
+        for rows in inputs:
+            for f, g in [(_rows_list_sum_by_group, agg.list_sum_by_group),
+                         (_rows_list_average_by_group,
+                          agg.list_average_by_group)]:
+                try:
+                    expected = sorted(f(rows, 0))
+                except Exception as e:
+                    self.assertRaises(e.__class__, g, rows, 0)
+                    continue
+                self.assert_same(expected, sorted(g(rows, 0)))
+
+
+class TestIntervalStore(unittest.TestCase):
+    """ Class that defines unit tests across the bounds of the interval store """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'intervals')
+        self.time = ist.time
+        self.clock = ist.time = TestResultCache.Clock()
+        # Results are final once computed well after their interval
+        self.start = to_epoch('20130101000000')
+        self.intervals = [('201201%02d000000' % (i + 1),
+                           '201201%02d000000' % (i + 2)) for i in xrange(8)]
+
+    def tearDown(self):
+        ist.time = self.time
+        shutil.rmtree(self.dir)
+
+    def put(self, store, i, now):
+        self.clock.now = self.start + now
+        store.put('series', self.intervals[i][0], self.intervals[i][1], [i])
+
+    def stored(self, store):
+        return sorted(row[0] for row in
+                      store.get('series', self.intervals).itervalues())
+
+    def test_sweep(self):
+        """ Ensure that expired and excess results are removed on put """
+
+        store = ist.IntervalStore(self.path, max_entries=3, ttl=5000)
+        for i in xrange(5): self.put(store, i, i * 10)
+
+        # Results are only swept every SWEEP_INTERVAL seconds
+        self.assertEqual(self.stored(store), [0, 1, 2, 3, 4])
+        self.put(store, 5, ist.SWEEP_INTERVAL + 40)
+        self.assertEqual(self.stored(store), [3, 4, 5])
+
+        # Expired results are not returned, and are removed by the next sweep
+        self.clock.now = self.start + 5035
+        self.assertEqual(self.stored(store), [4, 5])
+        self.put(store, 6, 2 * ist.SWEEP_INTERVAL + 40)
+        self.assertEqual(self.stored(store), [5, 6])
+        self.assertEqual(len(shelve.open(self.path).keys()), 3)
+
+    def test_unbounded(self):
+        """ Ensure that bounds of 0 keep every result """
+
+        store = ist.IntervalStore(self.path, max_entries=0, ttl=0)
+        for i in xrange(8): self.put(store, i, i * ist.SWEEP_INTERVAL)
+        self.clock.now = self.start + 10 ** 9
+        self.assertEqual(self.stored(store), range(8))
+
+
 def main(args):
     # Execute desired unit tests
     unittest.main()
@@ -0,0 +1,194 @@
+"""
+    Compact, column oriented storage for the results of UserMetric objects.
+    The fields of the rows are laid out by the data model of the metric
+    (see `UserMetric._data_model_meta`) and the id, integer, float and
+    boolean fields are stored as typed numpy arrays rather than as Python
+    objects: ::
+
+        >>> r = ColumnarResults(BytesAdded._data_model_meta)
+        >>> r.extend([['1', 10, 10, 10, 0, 1], ['2', -4, 4, 0, -4, 2]])
+        >>> list(r)
+        [('1', 10, 10, 10, 0, 1), ('2', -4, 4, 0, -4, 2)]
+        >>> r.column(1)
+        array([10, -4])
+
+    Rows are buffered and compacted into typed chunks of CHUNK_ROWS rows.
+    A field is only stored as an array when its values are all of one type
+    so that iteration yields the values that were added, as tuples.  Other
+    fields are kept as lists.
+"""
+
+__author__ = "Ryan Faulkner"
+__date__ = "January 18th, 2013"
+__license__ = "GPL (version 2 or later)"
+
+from itertools import izip, chain
+from operator import itemgetter
+import numpy as np
+
+# Number of rows buffered before they are compacted into typed columns
+CHUNK_ROWS = 10000
+
+# Fields of the data model stored as typed arrays
+TYPED_FIELDS = ['id_fields', 'integer_fields', 'float_fields',
+                'boolean_fields']
+
+# Fields holding a mapping with the same keys in every row, e.g. counts by
+# namespace.  The keys are stored once and the values as a 2-D array.
+DICT_FIELDS = 'dict_fields'
+
+
+class ColumnarResults(object):
+    """ Container of metric result rows stored by column """
+
+    def __init__(self, data_model_meta, rows=None):
+        self._typed = set(idx for key in TYPED_FIELDS
+                          for idx in data_model_meta.get(key, []))
+        self._dicts = set(data_model_meta.get(DICT_FIELDS, []))
+
+        self._chunks = list()       # compacted chunks of columns
+        self._pending = list()      # rows not yet compacted
+        self._count = 0             # number of compacted rows
+
+        if rows: self.extend(rows)
+
+    def __len__(self): return self._count + len(self._pending)
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            for row in chunk.rows():
+                yield row
+        for row in self._pending:
+            yield tuple(row)
+
+    def append(self, row):
+        self._pending.append(row)
+        if len(self._pending) >= CHUNK_ROWS:
+            self._compact(CHUNK_ROWS)
+
+    def extend(self, rows):
+        self._pending.extend(rows)
+        while len(self._pending) >= CHUNK_ROWS:
+            self._compact(CHUNK_ROWS)
+
+    def flush(self):
+        """ Compacts any buffered rows """
+        if self._pending:
+            self._compact(len(self._pending))
+
+    def column(self, idx):
+        """
+            Returns the field `idx` of all rows as a numpy array, or None if
+            the field is not stored as typed arrays.
+        """
+        self.flush()
+        arrays = [chunk.columns[idx] if chunk.columns else None
+                  for chunk in self._chunks]
+        if not arrays:
+            return np.array([])
+        if any(not isinstance(a, np.ndarray) or a.ndim != 1
+               for a in arrays):
+            return None
+        return np.concatenate(arrays)
+
+    def columns(self, indices):
+        """
+            Returns the fields `indices` of all rows as a 2-D numpy array
+            with a row for each result, or None if any of the fields is not
+            stored as typed arrays.
+        """
+        columns = [self.column(idx) for idx in indices]
+        if any(column is None for column in columns):
+            return None
+        return np.column_stack(columns).reshape(len(self), len(indices))
+
+    def _compact(self, n):
+        rows = self._pending[:n]
+        del self._pending[:n]
+        self._chunks.append(_Chunk(rows, self._typed, self._dicts))
+        self._count += len(rows)
+
+
+class _Chunk(object):
+    """
+        A block of rows stored as columns.  Rows of varying length are kept
+        as they are.
+    """
+
+    def __init__(self, rows, typed, dicts):
+        self.columns = None
+        self._rows = None
+        try:
+            widths = set(map(len, rows))
+        except TypeError:
+            widths = None
+        if not widths or len(widths) != 1:
+            self._rows = rows
+            return
+
+        self.columns = list()
+        for idx in xrange(widths.pop()):
+            values = map(itemgetter(idx), rows)
+            column = None
+            if idx in typed:
+                column = _typed_array(values)
+            elif idx in dicts:
+                column = _DictColumn.build(values)
+            self.columns.append(column if column is not None else values)
+
+    def rows(self):
+        if self._rows is not None:
+            return (tuple(row) for row in self._rows)
+        return izip(*[c.values() if isinstance(c, _DictColumn) else
+                      c.tolist() if isinstance(c, np.ndarray) else c
+                      for c in self.columns])
+
+
+class _DictColumn(object):
+    """ Mappings with common keys stored as a key list and a value array """
+
+    def __init__(self, mapping_type, keys, values):
+        self.mapping_type = mapping_type
+        self.keys = keys
+        self.array = values
+
+    @classmethod
+    def build(cls, mappings):
+        """ Returns a _DictColumn for `mappings` or None if not possible """
+        types = set(map(type, mappings))
+        if len(types) != 1 or not hasattr(mappings[0], 'keys'):
+            return None
+        keys = mappings[0].keys()
+        if any(m.keys() != keys for m in mappings):
+            return None
+        values = _typed_array([m.values() for m in mappings], nested=True)
+        if values is None:
+            return None
+        return cls(types.pop(), keys, values)
+
+    def values(self):
+        return [self.mapping_type(izip(self.keys, row))
+                for row in self.array.tolist()]
+
+
+def _typed_array(values, nested=False):
+    """
+        Converts values that are all booleans, all integers, all floats or
+        all strings to a numpy array.  Returns None for any other values.
+    """
+    types = set(map(type, chain.from_iterable(values) if nested
+                    else values))
+    if types == set([bool]):
+        dtype = bool
+    elif types and types <= set([int, long]):
+        dtype = np.int64
+    elif types == set([float]):
+        dtype = np.float64
+    elif types == set([str]) and not nested:
+        dtype = str
+    else:
+        return None
+    try:
+        return np.array(values, dtype=dtype)
+    except (OverflowError, ValueError):
+        return None
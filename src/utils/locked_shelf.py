@@ -0,0 +1,37 @@
+"""
+    Shelves shared by processes.  A LockedShelf is a shelve opened under an
+    exclusive lock on a companion lock file, `<path>.lock`, which is held
+    until the shelve is closed: ::
+
+        >>> store = LockedShelf(path)
+        >>> try:
+        ...     store[key] = value
+        ... finally:
+        ...     store.close()
+"""
+
+__author__ = "ryan faulkner"
+__date__ = "01/25/2013"
+__license__ = "GPL (version 2 or later)"
+
+import fcntl
+import shelve
+
+
+class LockedShelf(shelve.DbfilenameShelf):
+    """ Shelve at `path` held under an exclusive lock until closed """
+
+    def __init__(self, path, protocol=None):
+        self._lock = open(path + '.lock', 'a')
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX)
+            shelve.DbfilenameShelf.__init__(self, path, protocol=protocol)
+        except Exception:
+            self._lock.close()
+            raise
+
+    def close(self):
+        try:
+            shelve.DbfilenameShelf.close(self)
+        finally:
+            self._lock.close()
@@ -1,46 +1,403 @@
-
 """
     This module provides a set of methods for handling multi-threading patterns more easily.
 
     >>> import src.utils.multiprocessing_wrapper as mpw
     >>> mpw.build_thread_pool(['one','two'],len,2,[])
     [2,2]
+
+    Work is executed on a long-lived pool of worker processes shared by all
+    callers in a process (see `WorkerPool`).  Calls to `build_thread_pool`
+    made from inside one of those workers run on a thread pool owned by the
+    worker rather than forking further processes.
+
+    The data is split into more chunks than there are workers and each
+    worker picks up the next chunk as soon as it is done with the previous
+    one.  Where the cost of elements varies widely a cost hint can be given
+    to balance the chunks:
+
+    >>> revision_counts = {'156171' : 40000, '13234584' : 12, ...}
+    >>> mpw.build_thread_pool(users, _process_help, 10, args,
+            cost=revision_counts.get)
+
+    Work that mostly waits on the database can run on threads of the
+    calling process instead, or serially, by choosing another executor: ::
+
+    >>> mpw.build_thread_pool(users, _process_help, 200, args,
+            executor=mpw.THREAD)
 """
 
 import multiprocessing as mp
 import multiprocessing.pool as mp_pool
 import math
+import os
+import atexit
+import threading
+import heapq
+import Queue
+from itertools import islice
 
 __author__ = "ryan faulkner"
 __date__ = "12/12/2012"
 __license__ = "GPL (version 2 or later)"
 
-def build_thread_pool(data, callback, k, args):
-    """
-        Handles initializing, executing, and cleanup for thread pools
+# Executor backends for build_thread_pool
+PROCESS = 'process'
+THREAD = 'thread'
+SERIAL = 'serial'
+EXECUTORS = [PROCESS, THREAD, SERIAL]
+
+# Set in processes started by the shared worker pool
+_in_worker = False
+
+# Flags the threads of pools started by WorkerPool
+_thread_state = threading.local()
+
+# Number of chunks per worker when no chunk size is given
+CHUNKS_PER_WORKER = 4
+
+# Number of elements per chunk of data without a length
+ITER_CHUNK_SIZE = 1000
+
+# Seconds between checks for failed tasks while waiting on results
+RESULT_POLL_INTERVAL = 1.0
+
+def build_thread_pool(data, callback, k, args, chunk_size=None, cost=None,
+                      executor=PROCESS, partial=None, results=None):
     """
+        Handles partitioning the data and executing callback on the shared
+        worker pool.  The callback is called with `[chunk, args]` for each
+        chunk of data, with at most `k` chunks processed at a time.  Results
+        are returned in chunk order.
 
-    # partition data
-    n = int(math.ceil(float(len(data)) / k))
-    arg_list = list()
+        - Parameters:
+            - **data** - list or iterable.  Elements to process.  An
+                iterable without a length is read as chunks are dispatched
+                so that it need not fit in memory.
+            - **callback** - function.  Module level worker method.
+            - **k** - int.  Number of workers.
+            - **args** - list.  State passed to each call of `callback`.
+            - **chunk_size** - int.  Number of elements per chunk, defaults
+                to splitting the data into `k * CHUNKS_PER_WORKER` chunks.
+            - **cost** - function.  Estimated cost of an element of `data`
+                (e.g. the revision count of a user).  When given, the
+                chunks are packed to equal total cost and the most costly
+                chunks are dispatched first.
+            - **executor** - str.  One of PROCESS (worker processes),
+                THREAD (threads of the calling process) or SERIAL.
+            - **partial** - callable.  Picklable reduction applied by the
+                worker to the results of each chunk, e.g. a partial
+                aggregate.  When given the list of reduced chunk results is
+                returned.
+            - **results** - list like.  Container, with an extend method,
+                the results are collected in and returned.  Defaults to a
+                list.
+    """
 
-    for i in xrange(k):
-        arg_list.append([data[i * n : (i + 1) * n], args])
-    arg_list = filter(lambda x: len(x[0]), arg_list) # remove any args with empty revision lists
-    if not arg_list: return []
+    if results is None: results = list()
+    arg_list = ([chunk, args] for chunk in
+                _partition(data, k, chunk_size, cost))
+    if partial:
+        callback = _PartialCallback(callback, partial)
 
-    pool = NonDaemonicPool(processes=len(arg_list))
-    results = list()
     # Call worker threads and aggregate results
-    if arg_list:
-        for elem in pool.map(callback, arg_list):
-            if hasattr(elem, '__iter__'):
-                results.extend(elem)
-            else:
-                results.extend([elem])
-    pool.terminate()
+    for elem in WorkerPool().map(callback, arg_list, k, executor=executor):
+        if partial:
+            results.append(elem)
+        else:
+            results.extend(_as_list(elem))
     return results
 
+def iter_thread_pool(data, callback, k, args, chunk_size=None, cost=None,
+                     executor=PROCESS):
+    """
+        Generator version of build_thread_pool.  The results of each chunk
+        are yielded, as a list, as soon as the chunk completes, chunks
+        therefore arrive in order of completion.
+    """
+    arg_list = ([chunk, args] for chunk in
+                _partition(data, k, chunk_size, cost))
+    for idx, elem in WorkerPool().imap_unordered(callback, arg_list, k,
+                                                 executor=executor):
+        yield _as_list(elem)
+
+def _as_list(elem):
+    if hasattr(elem, '__iter__'):
+        return list(elem)
+    return [elem]
+
+class _PartialCallback(object):
+    """ Worker callback that reduces the chunk results of `callback` """
+    def __init__(self, callback, partial):
+        self.callback = callback
+        self.partial = partial
+
+    def __call__(self, args):
+        return self.partial(_as_list(self.callback(args)))
+
+def _partition(data, k, chunk_size, cost):
+    """
+        Split `data` into chunks for build_thread_pool.  Data without a
+        length, e.g. a generator, is split lazily into chunks of
+        `chunk_size` elements (ITER_CHUNK_SIZE by default) as it is read,
+        the cost hint is then ignored.
+    """
+    if not hasattr(data, '__len__'):
+        return iter_chunks(data, chunk_size or ITER_CHUNK_SIZE)
+
+    if chunk_size:
+        num_chunks = int(math.ceil(float(len(data)) / chunk_size))
+    else:
+        num_chunks = k * CHUNKS_PER_WORKER
+    num_chunks = max(1, min(num_chunks, len(data)))
+
+    if not cost:
+        n = int(math.ceil(float(len(data)) / num_chunks))
+        return [data[i * n : (i + 1) * n] for i in xrange(num_chunks)
+                if data[i * n : (i + 1) * n]]
+
+    # Greedily assign the most costly elements to the least loaded chunk.
+    # Every element weighs at least 1 so that elements without cost are
+    # spread over the chunks as well
+    weights = [(max(1, cost(elem) or 0), elem) for elem in data]
+    weights.sort(key=lambda item: item[0], reverse=True)
+    chunks = [list() for i in xrange(num_chunks)]
+    totals = [0] * num_chunks
+    heap = [(0, i) for i in xrange(num_chunks)]
+    for weight, elem in weights:
+        total, i = heapq.heappop(heap)
+        chunks[i].append(elem)
+        totals[i] = total + weight
+        heapq.heappush(heap, (totals[i], i))
+
+    order = sorted(xrange(num_chunks), key=lambda i: totals[i], reverse=True)
+    return [chunks[i] for i in order if chunks[i]]
+
+def iter_chunks(iterable, n):
+    """ Generates lists of `n` consecutive elements of `iterable` """
+    iterable = iter(iterable)
+    chunk = list(islice(iterable, n))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterable, n))
+
+def _call_indexed(task):
+    """ Executes a task from WorkerPool._bounded_imap """
+    idx, func, arg = task
+    return idx, func(arg)
+
+def _init_thread():
+    """ Initializer for threads of the pools started by WorkerPool """
+    _thread_state.in_pool = True
+
+def _in_pool_thread():
+    return getattr(_thread_state, 'in_pool', False)
+
+def _init_worker(instances):
+    """
+        Initializer for processes of the shared pool.  Flags the process as
+        a worker and opens a pooled DB connection to each of `instances`
+        so that the first task does not pay for the connection.
+    """
+    global _in_worker
+    _in_worker = True
+
+    # Imported here to keep this module free of DB dependencies
+    import src.etl.data_loader as dl
+    for instance in instances:
+        try:
+            dl.release_connection(dl.get_connection(instance=instance))
+        except Exception:
+            # The connection is opened again on first use
+            pass
+
+class WorkerPool(object):
+    """
+        Singleton class that maintains a long-lived pool of worker processes
+        for the current process.  The pool is started on first use and grows
+        to the largest number of workers requested while it is idle, the
+        workers then remain available for subsequent calls: ::
+
+            >>> import src.utils.multiprocessing_wrapper as mpw
+            >>> mpw.WorkerPool().map(len, ['one', 'three'], 2)
+            [3, 5]
+
+        Tasks can also be run on a thread pool of the current process
+        (executor THREAD) or serially (executor SERIAL).  Inside a worker
+        process, or from a thread of one of the pools, process tasks are
+        served by threads as well so that nested submissions never fork.
+        Nested submissions from a pool thread get a thread pool of their
+        own so that they cannot wait on their own pool.  Like the
+        connection pool in src.etl.data_loader the pool is safe to use
+        after fork, a child process starts its own pool and leaves the
+        inherited one alone.  All workers are shut down at interpreter
+        exit.
+    """
+
+    # Minimum number of worker processes started with the pool
+    MIN_SIZE = mp.cpu_count()
+
+    # DB instances that each worker connects to on start
+    WARM_INSTANCES = ['slave']
+
+    __instance = None   # Singleton instance
+
+    def __new__(cls, *args, **kwargs):
+        """ This class is Singleton, return only one instance """
+        if not cls.__instance:
+            cls.__instance = super(WorkerPool, cls).__new__(cls)
+            cls.__instance._lock = threading.Lock()
+            cls.__instance._reset()
+            cls.__instance._inherited = list()
+            atexit.register(cls.__instance.shutdown)
+        return cls.__instance
+
+    def _reset(self):
+        """ Initialize pool state for the current process """
+        self._pid = os.getpid()
+        self._pool = None
+        self._size = 0
+        self._active = 0
+        self._threads = None
+        self._thread_size = 0
+        self._thread_active = 0
+
+    def _check_pid(self):
+        """ Drop the pools (and the lock) inherited from a parent process.
+            This must be called before acquiring the lock. """
+        if self._pid != os.getpid():
+            self._inherited.extend([self._pool, self._threads])
+            self._lock = threading.Lock()
+            self._reset()
+
+    def map(self, func, arg_list, k, executor=PROCESS):
+        """ Apply `func` to each element of `arg_list` using up to `k`
+            workers of `executor`, results are returned in order """
+        if not executor in EXECUTORS:
+            raise ValueError('Unknown executor: %s' % str(executor))
+
+        results = dict(self.imap_unordered(func, arg_list, k,
+                                           executor=executor))
+        return [results[idx] for idx in xrange(len(results))]
+
+    def imap_unordered(self, func, arg_list, k, executor=PROCESS):
+        """ Generator over (index, result) pairs of `func` applied to each
+            element of `arg_list`, in order of completion """
+        if not executor in EXECUTORS:
+            raise ValueError('Unknown executor: %s' % str(executor))
+
+        self._check_pid()
+        if executor == SERIAL:
+            for idx, arg in enumerate(arg_list):
+                yield idx, func(arg)
+            return
+        if executor == THREAD or _in_worker or _in_pool_thread():
+            for item in self._thread_imap(func, arg_list, k):
+                yield item
+            return
+
+        with self._lock:
+            pool = self._get_pool(k)
+            self._active += 1
+        try:
+            for item in self._bounded_imap(pool, func, arg_list, k):
+                yield item
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    @staticmethod
+    def _bounded_imap(pool, func, arg_list, k):
+        """
+            Runs the tasks on `pool` with at most `k` in flight.  The caller
+            submits a new task once a result comes back so that free workers
+            take the remaining tasks in turn rather than being handed a
+            fixed share up front.  Nothing blocks inside the pool, tasks of
+            other callers sharing it are served alongside these ones.
+            `arg_list` may be any iterable, it is read as tasks are
+            submitted.
+        """
+        done = Queue.Queue()
+        pending = dict()    # index -> AsyncResult of the tasks in flight
+        tasks = enumerate(arg_list)
+
+        def submit(n):
+            for idx, arg in islice(tasks, n):
+                pending[idx] = pool.apply_async(_call_indexed,
+                                                ((idx, func, arg),),
+                                                callback=done.put)
+
+        submit(max(1, k))
+        while pending:
+            try:
+                idx, result = done.get(timeout=RESULT_POLL_INTERVAL)
+            except Queue.Empty:
+                # The callback is not called for failed tasks, raise their
+                # exception
+                for async_result in pending.values():
+                    if async_result.ready() and \
+                            not async_result.successful():
+                        async_result.get()
+                continue
+            del pending[idx]
+            submit(1)
+            yield idx, result
+
+    def _get_pool(self, k):
+        """ Returns a process pool with at least `k` workers if the current
+            pool is idle, otherwise the current pool.  Call with the lock
+            held. """
+        if self._pool and (k <= self._size or self._active):
+            return self._pool
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+        self._size = max(k, self.MIN_SIZE, self._size)
+        self._pool = NonDaemonicPool(processes=self._size,
+                                     initializer=_init_worker,
+                                     initargs=(self.WARM_INSTANCES,))
+        return self._pool
+
+    def _thread_imap(self, func, arg_list, k):
+        """ Runs the tasks on threads of the current process """
+        if _in_pool_thread():
+            pool = mp_pool.ThreadPool(processes=max(1, k),
+                                      initializer=_init_thread)
+            try:
+                for item in self._bounded_imap(pool, func, arg_list, k):
+                    yield item
+            finally:
+                pool.close()
+                pool.join()
+            return
+
+        with self._lock:
+            if not self._threads or (k > self._thread_size and
+                                     not self._thread_active):
+                if self._threads:
+                    self._threads.close()
+                    self._threads.join()
+                self._thread_size = max(k, self._thread_size)
+                self._threads = mp_pool.ThreadPool(
+                    processes=self._thread_size, initializer=_init_thread)
+            pool = self._threads
+            self._thread_active += 1
+        try:
+            for item in self._bounded_imap(pool, func, arg_list, k):
+                yield item
+        finally:
+            with self._lock:
+                self._thread_active -= 1
+
+    def shutdown(self):
+        """ Stop the workers owned by this process """
+        self._check_pid()
+        with self._lock:
+            for pool in [self._pool, self._threads]:
+                if pool:
+                    pool.close()
+                    pool.join()
+            self._reset()
+
 # From http://stackoverflow.com/questions/6974695/python-process-pool-non-daemonic
 # courtesy of stackoverflow user Chris Arndt - chrisarndt.de
 
@@ -0,0 +1,213 @@
+"""
+    Helpers for parsing the timestamps handled by the metrics.  MediaWiki
+    stores timestamps as fixed-format 14 digit strings, "YYYYMMDDHHMMSS", and
+    request parameters mostly arrive as "YYYY-MM-DD HH:MM:SS".  Both formats
+    are parsed directly by slicing, only unusual representations are passed
+    on to `dateutil.parser.parse`.
+
+        e.g. ::
+
+            >>> import src.utils.timestamp as ts
+            >>> ts.parse_timestamp('20120101120000')
+            datetime.datetime(2012, 1, 1, 12, 0)
+            >>> ts.to_epoch('20120101120000')
+            1325419200
+            >>> ts.to_epoch_array(['20120101120000', '20120102120000'])
+            array([1325419200, 1325505600])
+"""
+
+__author__ = "Ryan Faulkner"
+__date__ = "January 14th, 2013"
+__license__ = "GPL (version 2 or later)"
+
+from datetime import datetime, date
+from dateutil.parser import parse as date_parse
+import numpy as np
+
+MEDIAWIKI_TIMESTAMP_FORMAT = "%Y%m%d%H%M%S"
+
+MEDIAWIKI_TIMESTAMP_LENGTH = 14
+DATETIME_STR_LENGTH = 19
+
+SECONDS_PER_DAY = 86400
+
+# Separator positions and accepted values in "YYYY-MM-DD HH:MM:SS"
+_DATETIME_STR_SEPARATORS = [(4, '-'), (7, '-'), (10, ' T'), (13, ':'),
+                            (16, ':')]
+
+
+def _split_timestamp(ts_str):
+    """
+        Returns the fields (year, month, day, hour, minute, second) of a
+        string in one of the fixed formats or None if the string does not
+        match either of them.
+    """
+    n = len(ts_str)
+    if n == MEDIAWIKI_TIMESTAMP_LENGTH and ts_str.isdigit():
+        return (int(ts_str[0:4]), int(ts_str[4:6]), int(ts_str[6:8]),
+                int(ts_str[8:10]), int(ts_str[10:12]), int(ts_str[12:14]))
+    elif n == DATETIME_STR_LENGTH:
+        for idx, sep in _DATETIME_STR_SEPARATORS:
+            if not ts_str[idx] in sep:
+                return None
+        digits = ts_str[0:4] + ts_str[5:7] + ts_str[8:10] + \
+            ts_str[11:13] + ts_str[14:16] + ts_str[17:19]
+        if digits.isdigit():
+            return _split_timestamp(digits)
+    return None
+
+
+def parse_timestamp(ts_representation):
+    """
+        Convert a timestamp representation to a datetime object.
+
+        - Parameters:
+            - **ts_representation** - String or datetime.  datetime and date
+                objects are returned as datetime objects, MediaWiki and
+                "YYYY-MM-DD HH:MM:SS" strings are parsed directly and any
+                other value is handed to dateutil.
+
+        - Return:
+            - datetime.
+    """
+    if isinstance(ts_representation, datetime):
+        return ts_representation
+    elif isinstance(ts_representation, date):
+        return datetime(ts_representation.year, ts_representation.month,
+                        ts_representation.day)
+
+    if isinstance(ts_representation, basestring):
+        fields = _split_timestamp(ts_representation)
+        if fields:
+            try:
+                return datetime(*fields)
+            except ValueError:
+                pass
+
+    return date_parse(ts_representation)
+
+
+def _days_from_civil(year, month, day):
+    """
+        Number of days since 1970-01-01 of a proleptic Gregorian date.  Works
+        on integers as well as numpy integer arrays.
+    """
+    year = year - (month <= 2)
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month + 12 * (month <= 2) - 3) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def to_epoch(ts_representation):
+    """
+        Convert a timestamp representation to integer seconds since the
+        epoch (UTC, no timezone handling).  See `parse_timestamp` for the
+        accepted representations.  Fixed-format strings are only checked
+        for field ranges, not for calendar validity.
+    """
+    fields = None
+    if isinstance(ts_representation, basestring):
+        fields = _split_timestamp(ts_representation)
+        if fields and not (1 <= fields[1] <= 12 and 1 <= fields[2] <= 31):
+            fields = None
+    if not fields:
+        dt = parse_timestamp(ts_representation)
+        fields = (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
+
+    return _days_from_civil(fields[0], fields[1], fields[2]) * \
+        SECONDS_PER_DAY + fields[3] * 3600 + fields[4] * 60 + fields[5]
+
+
+def to_epoch_array(timestamps):
+    """
+        Vectorized conversion of a column of timestamps to a numpy array of
+        integer epoch seconds.  A column made up entirely of MediaWiki
+        timestamps is converted without visiting the elements in Python,
+        otherwise each element goes through `to_epoch`.
+
+        - Parameters:
+            - **timestamps** - iterable.  Timestamp representations.
+
+        - Return:
+            - numpy.ndarray(int64).
+    """
+    column = list(timestamps)
+    if not column:
+        return np.zeros(0, dtype=np.int64)
+
+    if all(isinstance(t, str) and len(t) == MEDIAWIKI_TIMESTAMP_LENGTH
+           for t in column):
+        digits = np.array(column, dtype='S%s' % MEDIAWIKI_TIMESTAMP_LENGTH).\
+            view(np.uint8).reshape(-1, MEDIAWIKI_TIMESTAMP_LENGTH).\
+            astype(np.int64) - ord('0')
+
+        if ((digits >= 0) & (digits <= 9)).all():
+            f = lambda i, j: (digits[:, i:j] * 10 ** np.arange(
+                j - i - 1, -1, -1)).sum(axis=1)
+            month = f(4, 6)
+            day = f(6, 8)
+            if ((month >= 1) & (month <= 12) & (day >= 1) &
+                    (day <= 31)).all():
+                return _days_from_civil(f(0, 4), month, day) * \
+                    SECONDS_PER_DAY + f(8, 10) * 3600 + f(10, 12) * 60 + \
+                    f(12, 14)
+
+    return np.array([to_epoch(t) for t in column], dtype=np.int64)
+
+
+def format_mediawiki_timestamp(ts_representation):
+    """ Convert a timestamp representation to a MediaWiki timestamp """
+    return parse_timestamp(ts_representation).strftime(
+        MEDIAWIKI_TIMESTAMP_FORMAT)
+
+
+class IntervalBuckets(object):
+    """
+        Maps timestamps onto a list of consecutive, equal length intervals
+        [(ts_0, ts_1), (ts_1, ts_2), ...] with integer arithmetic on epoch
+        seconds.  Intervals include their start and exclude their end unless
+        `right_closed` is set, in which case the reverse holds.
+
+        e.g. ::
+
+            >>> b = IntervalBuckets([('20120101000000', '20120102000000'),
+                                     ('20120102000000', '20120103000000')])
+            >>> b.bucket('20120102120000')
+            1
+            >>> b.bucket('20120103000000') is None
+            True
+    """
+
+    def __init__(self, intervals, right_closed=False):
+        bounds = [to_epoch(ts_s) for ts_s, ts_e in intervals]
+        bounds.append(to_epoch(intervals[-1][1]))
+
+        self._start = bounds[0]
+        self._step = bounds[1] - bounds[0]
+        self._count = len(intervals)
+        self._right_closed = right_closed
+
+        if self._step <= 0 or any(bounds[i + 1] - bounds[i] != self._step
+                                  for i in xrange(self._count)):
+            raise ValueError('Intervals must be consecutive and of equal '
+                             'length.')
+
+    def __len__(self): return self._count
+
+    @property
+    def step(self): return self._step
+
+    @property
+    def start(self): return self._start
+
+    def bucket(self, ts_representation):
+        """ Index of the interval containing the timestamp or None """
+        offset = to_epoch(ts_representation) - self._start
+        if self._right_closed:
+            offset -= 1
+        idx = offset // self._step
+        if 0 <= idx < self._count:
+            return idx
+        return None